@@ -0,0 +1,204 @@
+"""
+Micro-benchmark da conversão Overpass -> features (api/main.py).
+
+Compara, sobre o mesmo payload:
+  - "anterior": listas [lon, lat] por vértice + bbox percorrendo o GeoJSON ponto a ponto
+    (funções copiadas abaixo como referência);
+  - "atual": `main._element_to_category_pair` / `main._geojson_bbox` (bbox por coluna com zip);
+  - "array('d')": coordenadas em arrays contíguos, com as listas GeoJSON criadas no fim.
+e confirma que o GeoJSON e os bboxes produzidos são iguais.
+
+Uso (a partir de api/):
+    python bench/bench_geometry.py                       # payload sintético
+    python bench/bench_geometry.py --payload resp.json   # resposta Overpass gravada (JSON com "elements")
+    python bench/bench_geometry.py --ways 5000 --vertices 80 --repeat 5
+"""
+import argparse
+import json
+import operator
+import os
+import random
+import sys
+import time
+from array import array
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+
+# ---------- referência: conversão anterior (listas por vértice) ----------
+def _legacy_coords_to_polygon(coords: List[Dict[str, float]]) -> Optional[List[List[float]]]:
+    if not coords or len(coords) < 4:
+        return None
+    ring = [[pt["lon"], pt["lat"]] for pt in coords]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    if len(ring) < 4:
+        return None
+    return ring
+
+def _legacy_category_geojson(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    t = el.get("type")
+    gj = None
+    if t == "way":
+        geom = el.get("geometry")
+        ring = _legacy_coords_to_polygon(geom) if isinstance(geom, list) else None
+        if ring:
+            gj = {"type": "Polygon", "coordinates": [ring]}
+    elif t == "relation":
+        geom = el.get("geometry")
+        if isinstance(geom, list):
+            ring = _legacy_coords_to_polygon(geom)
+            if ring:
+                gj = {"type": "Polygon", "coordinates": [ring]}
+        if gj is None:
+            polys = []
+            for m in el.get("members") or []:
+                mg = m.get("geometry")
+                if isinstance(mg, list):
+                    ring = _legacy_coords_to_polygon(mg)
+                    if ring:
+                        polys.append(ring)
+            if polys:
+                gj = {"type": "MultiPolygon", "coordinates": [[ring] for ring in polys]}
+    return gj
+
+def _legacy_geojson_bbox(gj: Dict[str, Any]) -> Optional[Tuple[float, float, float, float]]:
+    xs: List[float] = []
+    ys: List[float] = []
+    stack = [gj.get("coordinates")]
+    while stack:
+        c = stack.pop()
+        if not isinstance(c, list) or not c:
+            continue
+        if isinstance(c[0], (int, float)):
+            xs.append(c[0]); ys.append(c[1])
+        else:
+            stack.extend(c)
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def _legacy_category_pair(el: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Tuple[float, float, float, float]]]:
+    gj = _legacy_category_geojson(el)
+    if gj is None:
+        return None
+    bb = _legacy_geojson_bbox(gj)
+    return ({"osm_id": el.get("id"), "geojson": gj}, bb) if bb is not None else None
+
+
+# ---------- variante com array('d') (medida, não adotada) ----------
+_LONLAT = operator.itemgetter("lon", "lat")
+
+def _packed_ring(points: Any) -> Optional["array[float]"]:
+    if not isinstance(points, list) or len(points) < 4:
+        return None
+    ring = array("d", chain.from_iterable(map(_LONLAT, points)))
+    if ring[0] != ring[-2] or ring[1] != ring[-1]:
+        ring.extend(ring[:2])
+    return ring
+
+def _array_category_pair(el: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], Tuple[float, float, float, float]]]:
+    t = el.get("type")
+    rings = []
+    ring = _packed_ring(el.get("geometry")) if t in ("way", "relation") else None
+    if ring is not None:
+        rings, kind = [ring], "Polygon"
+    elif t == "relation":
+        rings, kind = [r for r in (_packed_ring(m.get("geometry")) for m in el.get("members") or []) if r is not None], "MultiPolygon"
+    if not rings:
+        return None
+    bb = (min(min(r[0::2]) for r in rings), min(min(r[1::2]) for r in rings),
+          max(max(r[0::2]) for r in rings), max(max(r[1::2]) for r in rings))
+    # GeoJSON só no fim: cada float sai do array como um objeto novo
+    coords = [list(map(list, zip(r[0::2], r[1::2]))) for r in rings]
+    gj = {"type": "Polygon", "coordinates": coords} if kind == "Polygon" else {"type": kind, "coordinates": [[c] for c in coords]}
+    return {"osm_id": el.get("id"), "geojson": gj}, bb
+
+
+# ---------- payload ----------
+def synthetic_payload(ways: int, vertices: int, relations: int, seed: int = 7) -> Dict[str, Any]:
+    """Ways fechados/abertos, relações multipolígono e nós, dentro do bbox de Lisboa."""
+    rnd = random.Random(seed)
+    minx, miny, maxx, maxy = main.LISBON_BBOX
+
+    def ring(n: int, closed: bool) -> List[Dict[str, float]]:
+        cx, cy, r = rnd.uniform(minx, maxx), rnd.uniform(miny, maxy), rnd.uniform(0.0003, 0.005)
+        pts = [{"lat": round(cy + r * rnd.uniform(0.7, 1.0) * main.math.sin(2 * main.math.pi * i / n), 7),
+                "lon": round(cx + r * rnd.uniform(0.7, 1.0) * main.math.cos(2 * main.math.pi * i / n), 7)}
+               for i in range(n)]
+        return pts + [dict(pts[0])] if closed else pts
+
+    elements: List[Dict[str, Any]] = []
+    for i in range(ways):
+        elements.append({"type": "way", "id": 10_000 + i, "tags": {"leisure": "park", "name": f"Parque {i}"},
+                         "geometry": ring(max(4, int(rnd.gauss(vertices, vertices / 3))), closed=rnd.random() < 0.85)})
+    for i in range(relations):
+        members = [{"type": "way", "role": "outer", "geometry": ring(max(4, vertices), closed=rnd.random() < 0.7)}
+                   for _ in range(rnd.randint(1, 6))]
+        elements.append({"type": "relation", "id": 900_000 + i, "tags": {"historic": "monument"}, "members": members})
+    for i in range(ways // 5):
+        elements.append({"type": "node", "id": 5_000_000 + i, "tags": {"amenity": "school"},
+                         "lat": rnd.uniform(miny, maxy), "lon": rnd.uniform(minx, maxx)})
+    return {"elements": elements}
+
+
+# ---------- medição ----------
+def _best_of(fn, items: List[Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for it in items:
+            fn(it)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--payload", help="resposta Overpass gravada (JSON)")
+    ap.add_argument("--ways", type=int, default=3000)
+    ap.add_argument("--vertices", type=int, default=60)
+    ap.add_argument("--relations", type=int, default=300)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    if args.payload:
+        with open(args.payload, "r", encoding="utf-8") as fh:
+            payload = json.load(fh)
+    else:
+        payload = synthetic_payload(args.ways, args.vertices, args.relations)
+    elements = payload.get("elements", [])
+    n_vertices = sum(len(el.get("geometry") or []) + sum(len(m.get("geometry") or []) for m in el.get("members") or [])
+                     for el in elements)
+
+    # mesma saída antes de medir
+    pk = ["leisure", "historic", "amenity"]
+    converted = []
+    for el in elements:
+        old, new, arr = _legacy_category_pair(el), main._element_to_category_pair(el, pk), _array_category_pair(el)
+        assert (old is None) == (new is None) == (arr is None), el.get("id")
+        if old is not None:
+            assert old[0]["geojson"] == new[0]["geojson"] == arr[0]["geojson"], el.get("id")
+            assert tuple(old[1]) == tuple(new[1]) == tuple(arr[1]), el.get("id")
+            converted.append(new[0]["geojson"])
+    for gj in converted:
+        assert _legacy_geojson_bbox(gj) == main._geojson_bbox(gj)
+
+    rows = [
+        ("elementos -> feature + bbox", elements,
+         _legacy_category_pair, lambda el: main._element_to_category_pair(el, pk), _array_category_pair),
+        ("bbox de features (snapshot)", converted, _legacy_geojson_bbox, main._geojson_bbox, None),
+    ]
+    print(f"{len(elements)} elementos, {n_vertices} vértices, melhor de {args.repeat}")
+    print(f"{'':<30} {'anterior':>10} {'atual':>10} {'ganho':>7} {'array(d)':>10}")
+    for label, items, old_fn, new_fn, arr_fn in rows:
+        t_old = _best_of(old_fn, items, args.repeat)
+        t_new = _best_of(new_fn, items, args.repeat)
+        t_arr = f"{_best_of(arr_fn, items, args.repeat) * 1000:>8.1f}ms" if arr_fn else f"{'-':>10}"
+        print(f"{label:<30} {t_old * 1000:>8.1f}ms {t_new * 1000:>8.1f}ms {t_old / t_new:>6.2f}x {t_arr}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,331 @@
+"""
+Gerador de carga para a API (utilizadores virtuais em ciclo fechado, httpx assíncrono).
+
+Mistura ponderada de pedidos realistas:
+  - geocode: nomes de sítios de Lisboa, muitas vezes incompletos (como quem ainda está a escrever);
+  - category: viewports aleatórios dentro de Lisboa, com e sem ?zoom=;
+  - tiles: tiles MVT de zoom 14–16 (peso 0 por omissão);
+  - profile / submit: perfil sociodemográfico e seleções com os temas do questionário,
+    reutilizando features devolvidos por geocode/category e polígonos desenhados à mão.
+
+Relata, por endpoint, pedidos/s, p50/p95/p99/máx e erros; guarda o resultado em JSON
+(bench/results/) para comparar execuções com --compare.
+
+Uso (a partir de api/, com a API já a correr):
+    python bench/loadgen.py --base-url http://127.0.0.1:8000 --duration 60 --concurrency 20 \\
+        --mix geocode=50,category=35,profile=5,submit=10 --label antes
+    python bench/loadgen.py ... --label depois --compare bench/results/antes-<data>.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LISBON_BBOX = (-9.23, 38.69, -9.09, 38.79)
+THEMES = ["identity", "cultural_change", "cost_sense"]
+PLACES = [
+    "Alfama", "Mouraria", "Graça", "Castelo de São Jorge", "Baixa", "Chiado", "Bairro Alto",
+    "Príncipe Real", "Rossio", "Praça do Comércio", "Cais do Sodré", "Avenida da Liberdade",
+    "Marquês de Pombal", "Parque Eduardo VII", "Estrela", "Jardim da Estrela", "Campo de Ourique",
+    "Alcântara", "LX Factory", "Belém", "Torre de Belém", "Mosteiro dos Jerónimos", "Ajuda",
+    "Parque das Nações", "Oceanário", "Marvila", "Beato", "Arroios", "Anjos", "Intendente",
+    "Alvalade", "Campo Grande", "Benfica", "Lumiar", "Telheiras", "Areeiro", "Avenidas Novas",
+    "Santos", "Madragoa", "Lapa", "São Bento", "Martim Moniz", "Penha de França", "Olivais",
+]
+PROFILE_CHOICES = {
+    "age_band": ["18-24", "25-34", "35-44", "45-54", "55-64", "65+"],
+    "gender": ["f", "m", "o", "na"],
+    "tenure": ["owner", "tenant", "other"],
+    "years_in_lisbon": ["<1", "1-5", "6-10", "11-20", ">20"],
+}
+DEFAULT_CATEGORIES = ["parks", "public_buildings", "schools", "hospitals", "museums",
+                      "heritage", "sports", "retail_areas", "neighborhoods"]
+
+
+def _percentile(sorted_vals: List[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(math.ceil(p * len(sorted_vals))) - 1))
+    return sorted_vals[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.lat: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self.active = False
+
+    def add(self, name: str, elapsed: float, status: Optional[str]) -> None:
+        if not self.active:
+            return
+        self.lat.setdefault(name, []).append(elapsed)
+        if status is not None:
+            errs = self.errors.setdefault(name, {})
+            errs[status] = errs.get(status, 0) + 1
+
+    def summary(self, wall_s: float) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        total = 0
+        for name in sorted(self.lat):
+            vals = sorted(self.lat[name])
+            total += len(vals)
+            out[name] = {
+                "requests": len(vals),
+                "errors": sum(self.errors.get(name, {}).values()),
+                "errors_by_status": self.errors.get(name, {}),
+                "rps": round(len(vals) / wall_s, 2) if wall_s else 0.0,
+                "mean_ms": round(1000 * sum(vals) / len(vals), 1),
+                "p50_ms": round(1000 * _percentile(vals, 0.50), 1),
+                "p95_ms": round(1000 * _percentile(vals, 0.95), 1),
+                "p99_ms": round(1000 * _percentile(vals, 0.99), 1),
+                "max_ms": round(1000 * vals[-1], 1),
+            }
+        return {"total_requests": total, "rps": round(total / wall_s, 2) if wall_s else 0.0, "endpoints": out}
+
+
+class Workload:
+    """Gera os pedidos; guarda features vistos para montar submissões plausíveis."""
+
+    def __init__(self, rnd: random.Random, categories: List[str], prefix: str):
+        self.rnd = rnd
+        self.categories = categories
+        self.prefix = prefix
+        self.seen: List[Dict[str, Any]] = []
+
+    def remember(self, results: Any) -> None:
+        if not isinstance(results, list):
+            return
+        for f in results[:20]:
+            gj = (f or {}).get("geojson") or {}
+            if gj.get("type") in ("Polygon", "MultiPolygon") and f.get("osm_id") is not None:
+                self.seen.append(f)
+        if len(self.seen) > 2000:
+            del self.seen[:1000]
+
+    def geocode(self) -> Tuple[str, Dict[str, Any]]:
+        name = self.rnd.choice(PLACES)
+        if self.rnd.random() < 0.5:
+            name = name[:self.rnd.randint(min(3, len(name)), len(name))]
+        if self.rnd.random() < 0.2:
+            name = name.lower()
+        params: Dict[str, Any] = {"q": name}
+        if self.rnd.random() < 0.5:
+            params["zoom"] = self.rnd.randint(12, 17)
+        return f"{self.prefix}/geocode", params
+
+    def _viewport(self) -> Tuple[float, float, float, float]:
+        w, s, e, n = LISBON_BBOX
+        span = self.rnd.uniform(0.01, 0.06)
+        x0 = self.rnd.uniform(w, e - span)
+        y0 = self.rnd.uniform(s, n - span * 0.78)
+        return (round(x0, 5), round(y0, 5), round(x0 + span, 5), round(y0 + span * 0.78, 5))
+
+    def category(self) -> Tuple[str, Dict[str, Any]]:
+        code = self.rnd.choice(self.categories)
+        params: Dict[str, Any] = {"bbox": ",".join(str(v) for v in self._viewport())}
+        if self.rnd.random() < 0.4:
+            params["zoom"] = self.rnd.randint(13, 17)
+        return f"{self.prefix}/category/{code}", params
+
+    def tile(self) -> str:
+        z = self.rnd.randint(14, 16)
+        w, s, e, n = LISBON_BBOX
+        lon, lat = self.rnd.uniform(w, e), self.rnd.uniform(s, n)
+        x = int((lon + 180.0) / 360.0 * 2 ** z)
+        y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * 2 ** z)
+        return f"{self.prefix}/tiles/{self.rnd.choice(self.categories)}/{z}/{x}/{y}.mvt"
+
+    def profile(self) -> Dict[str, Any]:
+        return {k: self.rnd.choice(v) for k, v in PROFILE_CHOICES.items()}
+
+    def _manual_polygon(self) -> Dict[str, Any]:
+        w, s, e, n = LISBON_BBOX
+        cx, cy = self.rnd.uniform(w, e), self.rnd.uniform(s, n)
+        r = self.rnd.uniform(0.001, 0.006)
+        pts = [[cx + r * math.cos(2 * math.pi * i / 7), cy + r * 0.78 * math.sin(2 * math.pi * i / 7)] for i in range(7)]
+        return {
+            "name": f"Zona desenhada {self.rnd.randint(1, 999)}",
+            "importance_1_5": self.rnd.randint(1, 5),
+            "comment": self.rnd.choice([None, "", "Sítio onde passo muito tempo."]),
+            "geojson": {"type": "Polygon", "coordinates": [pts + [pts[0]]]},
+        }
+
+    def submit(self, participant_id: str) -> Dict[str, Any]:
+        selections = []
+        for _ in range(self.rnd.randint(1, 6)):
+            theme = self.rnd.choice(THEMES)
+            if self.seen and self.rnd.random() < 0.7:
+                f = self.rnd.choice(self.seen)
+                selections.append({
+                    "theme_code": theme, "osm_id": f.get("osm_id"), "osm_type": f.get("osm_type"),
+                    "display_name": f.get("display_name"), "osm_class": f.get("class"),
+                    "osm_feature_type": f.get("type"), "geojson": f.get("geojson"),
+                    "importance_1_5": self.rnd.randint(1, 5), "comment": None,
+                })
+            else:
+                selections.append({"theme_code": theme, "manual_polygon": self._manual_polygon()})
+        return {"participant_id": participant_id, "selections": selections}
+
+
+async def _timed(rec: Recorder, name: str, coro) -> Optional[httpx.Response]:
+    t0 = time.perf_counter()
+    try:
+        r = await coro
+    except Exception as e:
+        rec.add(name, time.perf_counter() - t0, type(e).__name__)
+        return None
+    rec.add(name, time.perf_counter() - t0, None if r.status_code < 400 else str(r.status_code))
+    return r
+
+
+async def _user(client: httpx.AsyncClient, wl: Workload, rec: Recorder, mix: List[Tuple[str, float]],
+                stop_at: float, prefix: str) -> None:
+    names = [m[0] for m in mix]
+    weights = [m[1] for m in mix]
+    participant_id: Optional[str] = None
+    while time.perf_counter() < stop_at:
+        kind = wl.rnd.choices(names, weights)[0]
+        if kind in ("profile", "submit") and participant_id is None:
+            r = await _timed(rec, "consent", client.post(f"{prefix}/consent"))
+            if r is None or r.status_code >= 400:
+                continue
+            participant_id = r.json().get("participant_id")
+        if kind == "geocode":
+            path, params = wl.geocode()
+            r = await _timed(rec, kind, client.get(path, params=params))
+            if r is not None and r.status_code < 400:
+                wl.remember(r.json().get("results"))
+        elif kind == "category":
+            path, params = wl.category()
+            r = await _timed(rec, kind, client.get(path, params=params))
+            if r is not None and r.status_code < 400:
+                wl.remember(r.json().get("results"))
+        elif kind == "tiles":
+            await _timed(rec, kind, client.get(wl.tile()))
+        elif kind == "profile":
+            await _timed(rec, kind, client.post(f"{prefix}/profile", params={"participant_id": participant_id},
+                                                json=wl.profile()))
+        elif kind == "submit":
+            r = await _timed(rec, kind, client.post(f"{prefix}/submit", json=wl.submit(participant_id)))
+            if r is not None and r.status_code < 400 and wl.rnd.random() < 0.5:
+                participant_id = None  # novo participante de vez em quando
+
+
+def _parse_mix(spec: str) -> List[Tuple[str, float]]:
+    out = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in ("geocode", "category", "tiles", "profile", "submit"):
+            raise SystemExit(f"endpoint desconhecido na mistura: {name}")
+        if float(w or 1) > 0:
+            out.append((name, float(w or 1)))
+    if not out:
+        raise SystemExit("mistura vazia")
+    return out
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def _print_summary(summary: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    base_eps = (baseline or {}).get("summary", {}).get("endpoints", {})
+    print(f"{'endpoint':<10} {'n':>7} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, s in summary["endpoints"].items():
+        print(f"{name:<10} {s['requests']:>7} {s['errors']:>5} {s['rps']:>8} "
+              f"{s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9} {s['max_ms']:>9}")
+        b = base_eps.get(name)
+        if b:
+            def _delta(key: str) -> str:
+                return f"{(s[key] - b[key]) / b[key] * 100:+.0f}%" if b[key] else "n/a"
+            print(f"{'  vs base':<10} {'':>7} {s['errors'] - b['errors']:>+5} {_delta('rps'):>8} "
+                  f"{_delta('p50_ms'):>9} {_delta('p95_ms'):>9} {_delta('p99_ms'):>9} {_delta('max_ms'):>9}")
+    print(f"total: {summary['total_requests']} pedidos, {summary['rps']} pedidos/s")
+    if baseline:
+        print(f"(comparado com {baseline.get('label')} @ {baseline.get('commit')}, {baseline.get('started_at')})")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    rnd = random.Random(args.seed)
+    mix = _parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        categories = DEFAULT_CATEGORIES
+        try:
+            r = await client.get(f"{args.prefix}/categories")
+            categories = [c["code"] for c in r.json().get("categories", [])] or categories
+        except Exception:
+            pass
+        rec = Recorder()
+        loop_end = time.perf_counter() + args.warmup + args.duration
+        users = [
+            asyncio.create_task(_user(client, Workload(random.Random(rnd.random()), categories, args.prefix),
+                                      rec, mix, loop_end, args.prefix))
+            for _ in range(args.concurrency)
+        ]
+        if args.warmup:
+            await asyncio.sleep(args.warmup)
+        rec.active = True
+        started = time.perf_counter()
+        await asyncio.gather(*users)
+        wall = time.perf_counter() - started
+    return {
+        "label": args.label,
+        "commit": _git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: getattr(args, k) for k in ("base_url", "prefix", "duration", "warmup", "concurrency", "mix", "seed", "timeout")},
+        "wall_s": round(wall, 2),
+        "summary": rec.summary(wall),
+    }
+
+
+def main_cli(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base-url", default="http://127.0.0.1:8000")
+    ap.add_argument("--prefix", default="", help='"" ou "/api" (rotas espelho)')
+    ap.add_argument("--duration", type=float, default=30.0, help="segundos medidos")
+    ap.add_argument("--warmup", type=float, default=5.0, help="segundos iniciais não contabilizados")
+    ap.add_argument("--concurrency", type=int, default=10, help="utilizadores virtuais")
+    ap.add_argument("--mix", default="geocode=50,category=35,profile=5,submit=10")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--label", default="run")
+    ap.add_argument("--results-dir", default=os.path.join(HERE, "results"))
+    ap.add_argument("--compare", help="JSON de uma execução anterior")
+    args = ap.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    _print_summary(result["summary"], baseline)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, f"{args.label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(result, fh, ensure_ascii=False, indent=2)
+    print(f"resultado guardado em {path}", file=sys.stderr)
+    return result
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,144 @@
+"""
+Executa um benchmark completo e reprodutível, sem tocar em serviços externos:
+  1. arranca bench/upstream_stub.py (Nominatim + Overpass locais, com a latência/erros pedidos);
+  2. arranca a API (uvicorn main:app) apontada para o stub, sem os mirrors Overpass por omissão;
+  3. espera por /health, corre bench/loadgen.py e pára os dois processos.
+
+Sem --database-url (nem DATABASE_URL no ambiente) só são medidos os endpoints que não usam BD
+(profile/submit saem da mistura). Uma BD local com o schema: bench/docker-compose.yml + bench/load_schema.py.
+
+Uso (a partir de api/):
+    python bench/run_bench.py --duration 60 --concurrency 20 --stub-latency-ms 400 --label antes
+    python bench/run_bench.py ... --label depois --compare bench/results/antes-<data>.json
+    python bench/run_bench.py --api-env CATEGORY_SNAPSHOT=1 --api-env FAST_RESPONSES=1 ...
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import loadgen  # noqa: E402
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"processo terminou antes de ficar pronto ({url}), código {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"tempo esgotado à espera de {url}")
+
+
+def _stop(proc: Optional[subprocess.Popen]) -> None:
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def _mix_without_db(mix: str) -> str:
+    parts = [p for p in mix.split(",") if p.split("=")[0].strip() not in ("profile", "submit")]
+    return ",".join(parts)
+
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--api-port", type=int, default=8765)
+    ap.add_argument("--stub-port", type=int, default=8766)
+    ap.add_argument("--workers", type=int, default=1, help="workers uvicorn da API")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""))
+    ap.add_argument("--api-env", action="append", default=[], metavar="NOME=VALOR",
+                    help="variável de ambiente extra para a API (repetível)")
+    ap.add_argument("--stub-latency-ms", type=float, default=300.0)
+    ap.add_argument("--stub-jitter-ms", type=float, default=100.0)
+    ap.add_argument("--stub-error-rate", type=float, default=0.0)
+    ap.add_argument("--stub-hang-rate", type=float, default=0.0)
+    ap.add_argument("--stub-kbps", type=float, default=0.0)
+    ap.add_argument("--recordings", default=os.path.join(HERE, "recordings"))
+    ap.add_argument("--duration", type=float, default=30.0)
+    ap.add_argument("--warmup", type=float, default=5.0)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--mix", default="geocode=50,category=35,profile=5,submit=10")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--label", default="run")
+    ap.add_argument("--results-dir", default=os.path.join(HERE, "results"))
+    ap.add_argument("--compare")
+    args = ap.parse_args()
+
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    mix = args.mix
+    if not args.database_url:
+        mix = _mix_without_db(mix)
+        print("sem DATABASE_URL: profile/submit fora da mistura", file=sys.stderr)
+
+    workdir = tempfile.mkdtemp(prefix="lp-bench-")
+    env: Dict[str, str] = dict(os.environ)
+    env.update({
+        "OVERPASS_URL": f"{stub_url}/api/interpreter",
+        "OVERPASS_URL_ALTS": "",
+        "OVERPASS_DEFAULT_FALLBACKS": "0",
+        "NOMINATIM_URL": stub_url,
+        "DATABASE_URL": args.database_url,
+        # cache em disco nova a cada execução: resultados comparáveis entre execuções
+        "OVERPASS_CACHE_PATH": os.path.join(workdir, "overpass_cache.sqlite3"),
+    })
+    for item in args.api_env:
+        key, _, value = item.partition("=")
+        env[key.strip()] = value
+
+    stub_cmd: List[str] = [
+        sys.executable, os.path.join(HERE, "upstream_stub.py"), "--port", str(args.stub_port),
+        "--recordings", args.recordings, "--seed", str(args.seed),
+        "--latency-ms", str(args.stub_latency_ms), "--jitter-ms", str(args.stub_jitter_ms),
+        "--error-rate", str(args.stub_error_rate), "--hang-rate", str(args.stub_hang_rate),
+        "--kbps", str(args.stub_kbps),
+    ]
+    api_cmd: List[str] = [
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.api_port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ]
+
+    stub = api = None
+    try:
+        stub = subprocess.Popen(stub_cmd, cwd=API_DIR)
+        _wait_ready(f"{stub_url}/_stub/stats", stub, 30)
+        api = subprocess.Popen(api_cmd, cwd=API_DIR, env=env)
+        _wait_ready(f"{api_url}/health", api, 60)
+
+        lg_args = [
+            "--base-url", api_url, "--duration", str(args.duration), "--warmup", str(args.warmup),
+            "--concurrency", str(args.concurrency), "--mix", mix, "--seed", str(args.seed), "--label", args.label,
+            "--results-dir", args.results_dir,
+        ]
+        if args.compare:
+            lg_args += ["--compare", args.compare]
+        loadgen.main_cli(lg_args)
+        try:
+            print(f"stub: {httpx.get(f'{stub_url}/_stub/stats', timeout=2).json()}", file=sys.stderr)
+        except httpx.HTTPError:
+            pass
+    finally:
+        _stop(api)
+        _stop(stub)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,241 @@
+"""
+Servidor local que substitui o Nominatim e o Overpass nos benchmarks.
+
+Responde a partir de respostas gravadas (bench/recordings/<nominatim|overpass>/<sha1>.json).
+Numa falta:
+  - com --record-overpass/--record-nominatim, pede ao serviço real, grava e devolve;
+  - senão, gera uma resposta sintética determinística (mesmo pedido -> mesma resposta).
+Latência e erros configuráveis: --latency-ms/--jitter-ms, --error-rate (429/502/503/504),
+--hang-rate (não responde durante --hang-s, para testar timeouts) e --kbps (envio do corpo aos bocados).
+
+Uso (a partir de api/):
+    python bench/upstream_stub.py --port 8081 --latency-ms 400 --jitter-ms 200 --error-rate 0.02
+A API aponta para ele com OVERPASS_URL=http://127.0.0.1:8081/api/interpreter e
+NOMINATIM_URL=http://127.0.0.1:8081 (ver bench/run_bench.py).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LISBON_BBOX = (-9.25, 38.69, -9.05, 38.80)
+
+
+class StubConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.recordings = args.recordings
+        self.record_overpass: Optional[str] = args.record_overpass
+        self.record_nominatim: Optional[str] = args.record_nominatim
+        self.latency_s = args.latency_ms / 1000.0
+        self.jitter_s = args.jitter_ms / 1000.0
+        self.error_rate = args.error_rate
+        self.hang_rate = args.hang_rate
+        self.hang_s = args.hang_s
+        self.kbps = args.kbps
+        self.density = args.density
+        self.rnd = random.Random(args.seed)
+
+
+CONF: Optional[StubConfig] = None
+STATS: Dict[str, int] = {"overpass": 0, "nominatim": 0, "replayed": 0, "recorded": 0, "synthetic": 0, "errors": 0, "hangs": 0}
+app = FastAPI(title="upstream stub (benchmark)")
+
+
+# ---------- gravações ----------
+def _recording_path(kind: str, key: str) -> str:
+    return os.path.join(CONF.recordings, kind, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+def _load_recording(kind: str, key: str) -> Optional[bytes]:
+    path = _recording_path(kind, key)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fh:
+        return fh.read()
+
+def _save_recording(kind: str, key: str, body: bytes) -> None:
+    path = _recording_path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(body)
+
+
+# ---------- respostas sintéticas ----------
+def _seeded(key: str) -> random.Random:
+    return random.Random(int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:12], 16))
+
+def _ring(rnd: random.Random, cx: float, cy: float, r: float, n: int) -> List[Tuple[float, float]]:
+    pts = []
+    for i in range(n):
+        a = 2 * math.pi * i / n
+        k = rnd.uniform(0.6, 1.0)
+        pts.append((round(cx + r * k * math.cos(a), 7), round(cy + r * k * math.sin(a) * 0.78, 7)))
+    return pts + [pts[0]]
+
+def _synthetic_overpass(ql: str) -> Dict[str, Any]:
+    rnd = _seeded(ql)
+    m = re.search(r"\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*,\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)", ql)
+    if m:
+        s, w, n, e = map(float, m.groups())
+    else:
+        w, s, e, n = LISBON_BBOX
+    name_m = re.search(r'\["name"~"([^"]*)"', ql)
+    base_name = re.sub(r"\\(.)", r"\1", name_m.group(1)) if name_m else None
+    km2 = max(0.0, (e - w) * 87.0) * max(0.0, (n - s) * 111.0)
+    count = 12 if base_name else int(km2 * CONF.density)
+    tag_m = re.search(r'(?:way|relation)\["(\w+)"(?:[=~]"([^"]*)")?\]', ql)
+    tag_k, tag_v = ("leisure", "park")
+    if tag_m:
+        tag_k, tag_v = tag_m.group(1), (tag_m.group(2) or "").split("|")[0].strip("^$")
+        if not tag_v or tag_v == ".*":
+            tag_v = "yes"
+    elements = []
+    for i in range(count):
+        cx, cy = rnd.uniform(w, e), rnd.uniform(s, n)
+        name = f"{base_name.title()} {i}" if base_name else f"{tag_v.replace('_', ' ').title()} {rnd.randint(1, 9999)}"
+        if base_name and i % 3 == 0:
+            elements.append({"type": "node", "id": 8_000_000 + rnd.randint(0, 10**7), "lat": cy, "lon": cx,
+                             "tags": {"name": name, "place": "neighbourhood"}})
+            continue
+        pts = _ring(rnd, cx, cy, rnd.uniform(0.0003, 0.004), rnd.randint(8, 120))
+        geometry = [{"lat": y, "lon": x} for x, y in pts]
+        el_id = rnd.randint(10**6, 10**9)
+        if rnd.random() < 0.1:
+            elements.append({"type": "relation", "id": el_id, "tags": {tag_k: tag_v, "name": name},
+                             "members": [{"type": "way", "ref": el_id + 1, "role": "outer", "geometry": geometry}]})
+        else:
+            elements.append({"type": "way", "id": el_id, "tags": {tag_k: tag_v, "name": name}, "geometry": geometry})
+    return {"version": 0.6, "generator": "upstream_stub", "osm3s": {"copyright": "synthetic"}, "elements": elements}
+
+def _synthetic_nominatim(params: Dict[str, str]) -> List[Dict[str, Any]]:
+    q = (params.get("q") or "").strip()
+    rnd = _seeded(json.dumps(params, sort_keys=True))
+    w, s, e, n = LISBON_BBOX
+    if q.lower() in ("lisboa", "lisbon", "lisboa, portugal"):
+        ring = [[w, s], [e, s], [e, n], [w, n], [w, s]]
+        return [{"osm_type": "relation", "osm_id": 5400890, "class": "boundary", "type": "administrative",
+                 "display_name": "Lisboa, Portugal", "lat": str((s + n) / 2), "lon": str((w + e) / 2),
+                 "boundingbox": [str(s), str(n), str(w), str(e)],
+                 "geojson": {"type": "Polygon", "coordinates": [ring]}}]
+    out = []
+    for i in range(rnd.randint(0, min(int(params.get("limit") or 10), 12))):
+        cx, cy = rnd.uniform(w + 0.01, e - 0.01), rnd.uniform(s + 0.01, n - 0.01)
+        if rnd.random() < 0.6:
+            pts = _ring(rnd, cx, cy, rnd.uniform(0.0005, 0.006), rnd.randint(8, 200))
+            gj = {"type": "Polygon", "coordinates": [[list(p) for p in pts]]}
+        else:
+            gj = {"type": "Point", "coordinates": [cx, cy]}
+        out.append({"osm_type": rnd.choice(["way", "relation", "node"]), "osm_id": rnd.randint(10**6, 10**9),
+                    "class": "place", "type": rnd.choice(["suburb", "neighbourhood", "square", "park"]),
+                    "display_name": f"{q.title()} {i}, Lisboa, Portugal", "lat": str(cy), "lon": str(cx),
+                    "boundingbox": [str(cy - 0.005), str(cy + 0.005), str(cx - 0.005), str(cx + 0.005)], "geojson": gj})
+    return out
+
+
+# ---------- latência / erros ----------
+async def _inject() -> Optional[Response]:
+    if CONF.hang_rate and CONF.rnd.random() < CONF.hang_rate:
+        STATS["hangs"] += 1
+        await asyncio.sleep(CONF.hang_s)
+    delay = max(0.0, CONF.rnd.gauss(CONF.latency_s, CONF.jitter_s)) if CONF.jitter_s else CONF.latency_s
+    if delay:
+        await asyncio.sleep(delay)
+    if CONF.error_rate and CONF.rnd.random() < CONF.error_rate:
+        STATS["errors"] += 1
+        return Response(status_code=CONF.rnd.choice([429, 502, 503, 504]), content=b"stub error")
+    return None
+
+def _body_response(body: bytes) -> Response:
+    if not CONF.kbps:
+        return Response(content=body, media_type="application/json")
+    chunk = 16 * 1024
+
+    async def _drip():
+        for i in range(0, len(body), chunk):
+            yield body[i:i + chunk]
+            await asyncio.sleep(chunk / (CONF.kbps * 1024.0))
+    return StreamingResponse(_drip(), media_type="application/json")
+
+async def _replay(kind: str, key: str, upstream: Optional[str], fetch, synth) -> Response:
+    failure = await _inject()
+    if failure is not None:
+        return failure
+    body = _load_recording(kind, key)
+    if body is not None:
+        STATS["replayed"] += 1
+    elif upstream:
+        body = await fetch(upstream)
+        _save_recording(kind, key, body)
+        STATS["recorded"] += 1
+    else:
+        body = json.dumps(synth()).encode("utf-8")
+        STATS["synthetic"] += 1
+    return _body_response(body)
+
+
+# ---------- endpoints ----------
+@app.api_route("/api/interpreter", methods=["GET", "POST"])
+async def overpass(request: Request):
+    STATS["overpass"] += 1
+    form = dict(parse_qsl((await request.body()).decode("utf-8"))) if request.method == "POST" else dict(request.query_params)
+    ql = form.get("data", "")
+
+    async def _fetch(url: str) -> bytes:
+        async with httpx.AsyncClient(timeout=90) as client:
+            r = await client.post(url, data={"data": ql})
+            r.raise_for_status()
+            return r.content
+    return await _replay("overpass", ql, CONF.record_overpass, _fetch, lambda: _synthetic_overpass(ql))
+
+@app.get("/search")
+async def nominatim(request: Request):
+    STATS["nominatim"] += 1
+    params = dict(request.query_params)
+    key = json.dumps(params, sort_keys=True)
+
+    async def _fetch(base: str) -> bytes:
+        async with httpx.AsyncClient(timeout=30, headers={"User-Agent": "lisboa-percepcoes-bench/1.0"}) as client:
+            r = await client.get(f"{base.rstrip('/')}/search", params=params)
+            r.raise_for_status()
+            return r.content
+    return await _replay("nominatim", key, CONF.record_nominatim, _fetch, lambda: _synthetic_nominatim(params))
+
+@app.get("/_stub/stats")
+def stub_stats():
+    return JSONResponse(STATS)
+
+
+def main_cli() -> None:
+    global CONF
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--recordings", default=os.path.join(HERE, "recordings"))
+    ap.add_argument("--record-overpass", help="URL Overpass real para gravar respostas em falta")
+    ap.add_argument("--record-nominatim", help="URL Nominatim real para gravar respostas em falta")
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--hang-rate", type=float, default=0.0)
+    ap.add_argument("--hang-s", type=float, default=60.0)
+    ap.add_argument("--kbps", type=float, default=0.0, help="largura de banda simulada (0 = sem limite)")
+    ap.add_argument("--density", type=float, default=6.0, help="features sintéticos por km² nas queries de categoria")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    CONF = StubConfig(args)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
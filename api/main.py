@@ -1,19 +1,38 @@
 import os
 import uuid
+import asyncio
 import json
 import time
 import re
-from typing import Any, Dict, List, Optional, Tuple
+import math
+import sqlite3
+import zlib
+import functools
+import codecs
+import bisect
+import heapq
+import unicodedata
+import gzip
+import hashlib
+import hmac
+import random
+import sys
+import contextvars
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-import requests
+import httpx
 from fastapi import FastAPI, APIRouter, Query, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.errors
 import psycopg2.extras
-from threading import Lock
+from threading import Condition, Event, Lock, Thread, get_ident
+from contextlib import contextmanager
 
 # (opcional) .env
 try:
@@ -27,23 +46,150 @@ NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org"
 USER_AGENT = os.getenv("USER_AGENT", "lisboa-percepcoes/1.0 (academic use)")
 ALLOWED_ORIGIN = os.getenv("ALLOWED_ORIGIN", "http://localhost:5173")
 
+# Pool de ligações PostgreSQL (por processo/worker)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_IDLE_S = float(os.getenv("DB_POOL_IDLE_S", "300"))
+DB_POOL_MAX_LIFETIME_S = float(os.getenv("DB_POOL_MAX_LIFETIME_S", "3600"))
+DB_POOL_CHECK_AFTER_S = float(os.getenv("DB_POOL_CHECK_AFTER_S", "30"))
+
+# Registo de temas em memória: validade confirmada contra a BD no máximo a cada N segundos
+THEME_REGISTRY_CHECK_S = float(os.getenv("THEME_REGISTRY_CHECK_S", "30"))
+
 # Overpass (com fallbacks)
 PRIMARY_OVERPASS = os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
 ALT_ENV = [u.strip() for u in os.getenv("OVERPASS_URL_ALTS", "").split(",") if u.strip()]
 DEFAULT_FALLBACKS = [
     "https://overpass.kumi.systems/api/interpreter",
     "https://overpass.openstreetmap.ru/api/interpreter",
-]
+] if os.getenv("OVERPASS_DEFAULT_FALLBACKS", "1") == "1" else []
 OVERPASS_ENDPOINTS: List[str] = [PRIMARY_OVERPASS, *ALT_ENV, *DEFAULT_FALLBACKS]
 
-# Anti-rajada simples para Overpass
-OVERPASS_LOCK = Lock()
-LAST_OVERPASS_CALL = 0.0
+# Mirrors ordenados por saúde recente; pedido duplicado ("hedge") para o 2.º mirror
+# quando o 1.º passa o percentil de latência, e pausa para mirrors que falham seguido
+OVERPASS_HEDGE_PERCENTILE = float(os.getenv("OVERPASS_HEDGE_PERCENTILE", "0.9"))
+OVERPASS_HEDGE_MIN_S = float(os.getenv("OVERPASS_HEDGE_MIN_S", "2.0"))
+OVERPASS_HEDGE_MAX_S = float(os.getenv("OVERPASS_HEDGE_MAX_S", "12.0"))
+OVERPASS_COOLDOWN_S = float(os.getenv("OVERPASS_COOLDOWN_S", "60"))
+OVERPASS_FAILS_TO_COOLDOWN = int(os.getenv("OVERPASS_FAILS_TO_COOLDOWN", "3"))
+
+# Leitura da resposta Overpass em streaming (bytes por bocado)
+OVERPASS_STREAM_CHUNK = 64 * 1024
+
+# Anti-rajada simples para Overpass (intervalo mínimo entre chamadas + nº máximo em paralelo)
 MIN_INTERVAL_S = float(os.getenv("OVERPASS_MIN_INTERVAL", "0.8"))
+OVERPASS_MAX_CONCURRENCY = int(os.getenv("OVERPASS_MAX_CONCURRENCY", "2"))
+
+# Cliente HTTP upstream: pool keep-alive partilhado; HTTP/2 se o pacote "h2" estiver instalado
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+try:
+    import h2  # type: ignore  # noqa: F401
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
 
-# Cache simples em memória (TTL curto)
-OVERPASS_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+# Cache de respostas upstream (TTL por entrada, limitada em tamanho):
+#   "memory" -> LRU por processo; "sqlite" -> ficheiro em disco partilhado pelos workers do host
 CACHE_TTL_S = int(os.getenv("OVERPASS_CACHE_TTL", "300"))
+CACHE_BACKEND = os.getenv("OVERPASS_CACHE_BACKEND", "memory").lower()
+CACHE_PATH = os.getenv("OVERPASS_CACHE_PATH", "overpass_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("OVERPASS_CACHE_MAX_ENTRIES", "5000"))
+CACHE_MAX_BYTES = int(os.getenv("OVERPASS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Categorias em cache por tiles de grelha fixa (graus), independentes do bbox pedido
+CATEGORY_TILE_DEG = float(os.getenv("CATEGORY_TILE_DEG", "0.02"))
+
+# Modo snapshot: cada categoria é carregada para Lisboa inteira e servida de um índice em memória
+CATEGORY_SNAPSHOT = os.getenv("CATEGORY_SNAPSHOT", "0") == "1"
+CATEGORY_SNAPSHOT_PATH = os.getenv("CATEGORY_SNAPSHOT_PATH", "")
+CATEGORY_SNAPSHOT_REFRESH_S = int(os.getenv("CATEGORY_SNAPSHOT_REFRESH", "86400"))
+SNAPSHOT_GRID_DEG = float(os.getenv("CATEGORY_SNAPSHOT_GRID_DEG", "0.005"))
+
+# Simplificação opcional por zoom (?zoom=) em /category e /geocode: tolerância em píxeis de ecrã
+SIMPLIFY_PX = float(os.getenv("SIMPLIFY_PX", "0.5"))
+SIMPLIFY_CACHE_MAX = int(os.getenv("SIMPLIFY_CACHE_MAX", "20000"))
+SIMPLIFY_CACHE_TTL_S = int(os.getenv("SIMPLIFY_CACHE_TTL", "3600"))
+SIMPLIFY_CHECK_MAX_VERTICES = 400  # acima disto não se verifica auto-interseção (O(n²))
+
+# Tiles vetoriais (MVT) das categorias
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+MVT_MIN_ZOOM = int(os.getenv("MVT_MIN_ZOOM", "11"))
+MVT_CACHE_MAX = int(os.getenv("MVT_CACHE_MAX", "5000"))
+MVT_CACHE_TTL_S = int(os.getenv("MVT_CACHE_TTL", "3600"))
+MVT_MAX_AGE_S = int(os.getenv("MVT_MAX_AGE", "3600"))
+
+# Respostas rápidas (opt-in) em /category e /geocode: JSON direto para bytes, gzip/brotli
+# conforme Accept-Encoding e cache dos bytes já comprimidos; orjson/brotli são opcionais
+FAST_RESPONSES = os.getenv("FAST_RESPONSES", "0") == "1"
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", "500"))
+RESPONSE_CACHE_TTL_S = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+FAST_MIN_COMPRESS_BYTES = int(os.getenv("FAST_MIN_COMPRESS_BYTES", "1024"))
+FAST_GZIP_LEVEL = int(os.getenv("FAST_GZIP_LEVEL", "5"))
+FAST_BROTLI_QUALITY = int(os.getenv("FAST_BROTLI_QUALITY", "5"))
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+try:
+    import brotli  # type: ignore
+except Exception:
+    brotli = None
+
+# Índice local de nomes para o /geocode: responde sem ir ao Nominatim/Overpass quando há pelo menos
+# NAME_INDEX_MIN_RESULTS resultados locais exatos ou por prefixo (os aproximados só se juntam aos de fora)
+NAME_INDEX_MAX = int(os.getenv("NAME_INDEX_MAX", "50000"))
+NAME_INDEX_MIN_RESULTS = int(os.getenv("NAME_INDEX_MIN_RESULTS", "5"))
+NAME_INDEX_MIN_SIMILARITY = float(os.getenv("NAME_INDEX_MIN_SIMILARITY", "0.3"))
+NAME_INDEX_MAX_POSTING = 2000  # trigramas presentes em mais nomes do que isto não contam na busca aproximada
+
+# Polígonos OSM já mostrados aos clientes (categorias, /geocode), por osm_id: o /submit aceita seleções
+# só com osm_id/osm_type e vai buscar a geometria aqui ou a public.osm_cache
+FEATURE_REGISTRY_MAX = int(os.getenv("FEATURE_REGISTRY_MAX", "20000"))
+
+# Prazo global do /geocode (Nominatim e Overpass correm em paralelo)
+GEOCODE_DEADLINE_S = float(os.getenv("GEOCODE_DEADLINE_S", "6.0"))
+
+# Resposta completa do /geocode em cache pela pesquisa normalizada (sem acentos/maiúsculas/espaços a mais);
+# vazios e erros ficam pouco tempo; uma pesquisa mais curta pode reutilizar a de uma mais longa
+GEOCODE_CACHE_TTL_S = int(os.getenv("GEOCODE_CACHE_TTL", "86400"))
+GEOCODE_NEGATIVE_TTL_S = int(os.getenv("GEOCODE_NEGATIVE_TTL", "60"))
+GEOCODE_PREFIX_MIN_RESULTS = int(os.getenv("GEOCODE_PREFIX_MIN_RESULTS", "5"))
+
+# Escrita diferida (opt-in) de /submit e /profile: o pedido validado vai para um diário local
+# (SQLite WAL com fsync) e é confirmado logo; uma task passa-o à BD em lotes, uma só vez por entrada
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_PATH = os.getenv("WRITE_BEHIND_PATH", "write_behind.sqlite3")
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+WRITE_BEHIND_INTERVAL_S = float(os.getenv("WRITE_BEHIND_INTERVAL", "1.0"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+WRITE_BEHIND_LEASE_S = 120.0  # entrada reservada por um worker; volta à fila se ele morrer a meio
+
+# Manutenção incremental (opt-in) da tabela de análise public.selections_profile_themegeom_inc
+# (mesmas colunas da vista materializada): /submit e /profile registam os participantes/osm_ids
+# tocados em public.spt_delta e uma task recalcula só essas linhas a cada SPT_INTERVAL segundos;
+# POST /spt/refresh (cabeçalho X-Spt-Secret) força uma passagem ou, com full=true, a reconstrução
+SPT_INCREMENTAL = os.getenv("SPT_INCREMENTAL", "0") == "1"
+SPT_INTERVAL_S = float(os.getenv("SPT_INTERVAL", "60"))
+SPT_BATCH = int(os.getenv("SPT_BATCH", "5000"))
+SPT_SECRET = os.getenv("SPT_SECRET", "")
+
+# /aggregate/{theme}: densidade e importância média numa grelha hexagonal (EPSG:3763, lado AGGREGATE_HEX_M
+# metros) a partir de um índice seleção -> células mantido com a tabela de análise (requer SPT_INCREMENTAL=1);
+# resultados em cache por tema + filtros, com a versão do tema (sobe quando o tema muda) na chave
+AGGREGATE_HEX_M = float(os.getenv("AGGREGATE_HEX_M", "250"))
+AGGREGATE_CACHE_MAX = int(os.getenv("AGGREGATE_CACHE_MAX", "512"))
+AGGREGATE_CACHE_TTL_S = int(os.getenv("AGGREGATE_CACHE_TTL", "86400"))
+AGGREGATE_VERSION_CHECK_S = float(os.getenv("AGGREGATE_VERSION_CHECK_S", "2"))
+
+# Perfis por pedido (opt-in): uma fração dos pedidos ao acaso e/ou os que trazem X-Profile-Secret;
+# ficam em PROFILE_DIR (os PROFILE_KEEP mais recentes) e são listados em /profiles com o mesmo segredo
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_S = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
 
 # BBOX Lisboa
 LISBON_BBOX = (-9.25, 38.69, -9.05, 38.80)
@@ -72,11 +218,372 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ===================== MÉTRICAS (formato Prometheus) ======================
+# Por processo: com vários workers cada um tem os seus contadores (como em /stats).
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _metric_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    parts = []
+    for k, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+class _Counter:
+    """Contador com etiquetas (só sobe)."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values: Dict[Tuple[Any, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, *labels: Any, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f"{self.name}{_metric_labels(self.labels, k)} {v:g}" for k, v in items)
+        return lines
+
+class _Histogram:
+    """Histograma cumulativo com etiquetas (buckets fixos, em segundos)."""
+
+    def __init__(
+        self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = METRICS_BUCKETS,
+        phase: Optional[str] = None,
+    ):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.phase = phase  # também somado à fase do perfil do pedido em curso (se houver)
+        self._series: Dict[Tuple[Any, ...], List[float]] = {}  # etiquetas -> [contagem por bucket..., soma, total]
+        self._lock = Lock()
+
+    def observe(self, value: float, *labels: Any) -> None:
+        if self.phase is not None:
+            _profile_add(self.phase, value)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels: Any):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        names = self.labels + ("le",)
+        for key, series in items:
+            acc = 0.0
+            for b, n in zip(self.buckets, series):
+                acc += n
+                lines.append(f"{self.name}_bucket{_metric_labels(names, key + (f'{b:g}',))} {acc:g}")
+            lines.append(f"{self.name}_bucket{_metric_labels(names, key + ('+Inf',))} {series[-1]:g}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, key)} {series[-1]:g}")
+        return lines
+
+HTTP_LATENCY = _Histogram(
+    "http_request_duration_seconds", "Duração dos pedidos HTTP até ao fim da resposta, por rota.",
+    ("method", "route", "status"),
+)
+HTTP_EXCEPTIONS = _Counter("http_exceptions_total", "Exceções não tratadas, por rota e tipo.", ("route", "exception"))
+UPSTREAM_LATENCY = _Histogram(
+    "upstream_request_duration_seconds", "Duração das chamadas ao Overpass/Nominatim, por endpoint e resultado.",
+    ("service", "endpoint", "outcome"), phase="upstream",
+)
+UPSTREAM_RETRIES = _Counter(
+    "upstream_retries_total", "Repetições após 429/5xx, por endpoint e estado.", ("service", "endpoint", "status"),
+)
+OVERPASS_WAIT = _Histogram(
+    "overpass_limiter_wait_seconds",
+    "Espera antes de chamar o Overpass: slot de concorrência (slot) e intervalo mínimo (interval).", ("stage",),
+    phase="limiter",
+)
+DB_TIME = _Histogram(
+    "db_statement_duration_seconds", "Tempo na BD por grupo de instruções.", ("endpoint", "group"), phase="db",
+)
+_METRICS = [HTTP_LATENCY, HTTP_EXCEPTIONS, UPSTREAM_LATENCY, UPSTREAM_RETRIES, OVERPASS_WAIT, DB_TIME]
+
+def _upstream_outcome(exc: BaseException) -> str:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"http_{exc.response.status_code}"
+    if isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(exc, httpx.TransportError):
+        return "connection_error"
+    if isinstance(exc, ValueError):
+        return "invalid_response"
+    return "error"
+
+def _route_label(scope: Dict[str, Any]) -> str:
+    route = scope.get("route")
+    # só o molde da rota ("/api/category/{code}"): caminhos sem rota não criam séries novas
+    return getattr(route, "path", None) or "unmatched"
+
+class _MetricsMiddleware:
+    """Mede cada pedido até ao último byte da resposta (inclui respostas em streaming)."""
+
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            HTTP_LATENCY.observe(time.perf_counter() - t0, scope["method"], _route_label(scope), status["code"])
+
+app.add_middleware(_MetricsMiddleware)
+
+# ===================== PERFIS POR PEDIDO ===================================
+class _RequestProfile:
+    """
+    Perfil de um pedido: amostras de pilha (formato "folded", para flame graphs) e tempo somado
+    por fase (upstream, limiter, conversion, serialization, db). As fases podem sobrepor-se
+    (chamadas em paralelo), por isso a soma pode passar a duração total.
+    """
+
+    def __init__(self, scope: Dict[str, Any], reason: str):
+        self.id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        self.method = scope.get("method")
+        self.path = scope.get("path")
+        self.query = (scope.get("query_string") or b"").decode("latin-1")
+        self.reason = reason
+        self.started_at = time.time()
+        self.t0 = time.perf_counter()
+        self.duration_s = 0.0
+        self.route = None
+        self.status = None
+        self.phases: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def sample(self, stack: str) -> None:
+        with self._lock:
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "query": self.query, "route": self.route,
+            "status": self.status, "reason": self.reason, "started_at": self.started_at,
+            "duration_s": round(self.duration_s, 6), "phases": {k: round(v, 6) for k, v in sorted(self.phases.items())},
+            "samples": sum(self.samples.values()), "interval_s": PROFILE_INTERVAL_S,
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            folded = dict(sorted(self.samples.items(), key=lambda kv: -kv[1]))
+        return {**self.summary(), "folded": folded}
+
+_PROFILE_CTX: "contextvars.ContextVar[Optional[_RequestProfile]]" = contextvars.ContextVar("request_profile", default=None)
+
+def _profile_add(phase: str, seconds: float) -> None:
+    prof = _PROFILE_CTX.get()
+    if prof is not None:
+        prof.add(phase, seconds)
+
+# folha da pilha do event loop quando está parado à espera de I/O (asyncio puro ou uvloop)
+_IDLE_LEAVES = {
+    ("select", "selectors.py"), ("_run_once", "base_events.py"), ("run_forever", "base_events.py"),
+    ("run_until_complete", "base_events.py"), ("run", "runners.py"),
+}
+
+def _fold_stack(frame, role: str) -> str:
+    names: List[str] = []
+    f = frame
+    while f is not None and len(names) < 80:
+        code = f.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        f = f.f_back
+    if role == "loop" and (frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)) in _IDLE_LEAVES:
+        return "loop;(idle)"  # event loop à espera de I/O (upstream, BD noutra thread, ...)
+    return ";".join([role, *reversed(names)])
+
+class _StackSampler:
+    """
+    Thread que, enquanto houver perfis ativos, lê a pilha (sys._current_frames) das threads
+    associadas a cada perfil: a do event loop e as threads de trabalho (to_thread/threadpool)
+    enquanto correm código desse pedido. A pilha do event loop é partilhada com pedidos concorrentes.
+    """
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self._threads: Dict[int, Dict[_RequestProfile, str]] = {}
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._stop = Event()
+
+    def attach(self, ident: int, prof: _RequestProfile, role: str) -> None:
+        with self._lock:
+            self._threads.setdefault(ident, {})[prof] = role
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+
+    def detach(self, ident: int, prof: _RequestProfile) -> None:
+        with self._lock:
+            profs = self._threads.get(ident)
+            if profs is not None:
+                profs.pop(prof, None)
+                if not profs:
+                    del self._threads[ident]
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._threads:
+                    self._thread = None
+                    return
+                targets = [(ident, list(profs.items())) for ident, profs in self._threads.items()]
+            frames = sys._current_frames()
+            for ident, profs in targets:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stacks: Dict[str, str] = {}
+                for prof, role in profs:
+                    stack = stacks.get(role) or stacks.setdefault(role, _fold_stack(frame, role))
+                    prof.sample(stack)
+            del frames
+            self._stop.wait(self.interval_s)
+
+STACK_SAMPLER = _StackSampler(PROFILE_INTERVAL_S)
+
+@contextmanager
+def _profiled_thread():
+    """Associa a thread atual ao perfil do pedido em curso (se houver) enquanto o bloco corre."""
+    prof = _PROFILE_CTX.get()
+    if prof is None:
+        yield
+        return
+    ident = get_ident()
+    STACK_SAMPLER.attach(ident, prof, "worker")
+    try:
+        yield
+    finally:
+        STACK_SAMPLER.detach(ident, prof)
+
+def _profiled_sync(fn):
+    """Para endpoints síncronos (correm no threadpool): a thread conta para o perfil do pedido."""
+    @functools.wraps(fn)
+    def _wrapper(*args, **kwargs):
+        with _profiled_thread():
+            return fn(*args, **kwargs)
+    return _wrapper
+
+async def _to_thread(fn, *args, phase: Optional[str] = None):
+    """asyncio.to_thread com o tempo de fn somado à fase do perfil em curso e a thread amostrada."""
+    if _PROFILE_CTX.get() is None:
+        return await asyncio.to_thread(fn, *args)
+
+    def _job():
+        t0 = time.perf_counter()
+        try:
+            with _profiled_thread():
+                return fn(*args)
+        finally:
+            if phase is not None:
+                _profile_add(phase, time.perf_counter() - t0)
+    return await asyncio.to_thread(_job)
+
+def _save_profile(prof: _RequestProfile) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp = os.path.join(PROFILE_DIR, f".{prof.id}.tmp")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(prof.to_dict(), fh, ensure_ascii=False)
+    os.replace(tmp, os.path.join(PROFILE_DIR, f"{prof.id}.json"))
+    names = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))
+    for old in names[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass
+
+class _ProfileMiddleware:
+    """Perfila os pedidos escolhidos (amostragem ou cabeçalho com o segredo) e guarda o perfil no fim."""
+
+    def __init__(self, app_):
+        self.app = app_
+
+    def _reason(self, scope) -> Optional[str]:
+        if PROFILE_SECRET:
+            for k, v in scope.get("headers") or []:
+                if k == b"x-profile-secret":
+                    if hmac.compare_digest(v, PROFILE_SECRET.encode()):
+                        return "header"
+                    break
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].rstrip("/").endswith("/profiles") or "/profiles/" in scope["path"]:
+            await self.app(scope, receive, send)
+            return
+        reason = self._reason(scope)
+        if reason is None:
+            await self.app(scope, receive, send)
+            return
+
+        prof = _RequestProfile(scope, reason)
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                prof.status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", prof.id.encode())]}
+            await send(message)
+
+        token = _PROFILE_CTX.set(prof)
+        loop_ident = get_ident()
+        STACK_SAMPLER.attach(loop_ident, prof, "loop")
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            STACK_SAMPLER.detach(loop_ident, prof)
+            _PROFILE_CTX.reset(token)
+            prof.duration_s = time.perf_counter() - prof.t0
+            prof.route = _route_label(scope)
+            _keep_in_background(asyncio.ensure_future(asyncio.to_thread(_save_profile, prof)))
+
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_SECRET:
+    app.add_middleware(_ProfileMiddleware)
+
 # ===================== Handler global p/ JSON legível =====================
 @app.exception_handler(Exception)
 async def all_exceptions_handler(request: Request, exc: Exception):
     print("\n=== Unhandled Exception ===")
     print(repr(exc))
+    HTTP_EXCEPTIONS.inc(_route_label(request.scope), type(exc).__name__)
     return JSONResponse(
         status_code=500,
         content={"ok": False, "error": f"{type(exc).__name__}: {str(exc)}"},
@@ -111,6 +618,136 @@ class SubmitPayload(BaseModel):
 def health():
     return {"status": "ok"}
 
+@app.get("/stats")
+def stats():
+    return {
+        "cache": OVERPASS_CACHE.stats(),
+        "overpass_mirrors": [m.snapshot() for m in _ranked_mirrors()],
+        "db_pool": DB_POOL.stats(),
+        "themes": THEME_REGISTRY.stats(),
+        "responses": RESPONSE_CACHE.stats(),
+        "names": NAME_INDEX.stats(),
+        "feature_registry": FEATURE_REGISTRY.stats(),
+        **({"write_behind": WRITE_JOURNAL.stats()} if WRITE_BEHIND else {}),
+        **({"spt": _spt_stats(), "aggregate": AGGREGATE_CACHE.stats()} if SPT_INCREMENTAL else {}),
+        "osm_cache_writes": dict(_OSM_CACHE_COUNTERS),
+    }
+
+def _sample_lines(name: str, help_text: str, kind: str, samples: List[Tuple[Dict[str, Any], Any]]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_metric_labels(tuple(labels), tuple(labels.values()))} {float(value or 0):g}")
+    return lines
+
+def _metrics_text() -> str:
+    lines: List[str] = []
+    for m in _METRICS:
+        lines.extend(m.render())
+
+    # caches, pool e índice de nomes: lidos dos mesmos contadores que o /stats
+    caches = {"overpass": OVERPASS_CACHE, "responses": RESPONSE_CACHE, "simplified": SIMPLIFIED_CACHE, "mvt": MVT_CACHE,
+              "aggregate": AGGREGATE_CACHE}
+    cache_stats = {name: c.stats() for name, c in caches.items()}
+    for key, kind, help_text in [
+        ("hits", "counter", "Leituras da cache com resultado."),
+        ("misses", "counter", "Leituras da cache sem resultado."),
+        ("expired", "counter", "Entradas encontradas já expiradas."),
+        ("sets", "counter", "Escritas na cache."),
+        ("evictions", "counter", "Entradas expulsas por limite de tamanho."),
+    ]:
+        lines += _sample_lines(f"cache_{key}_total", help_text, kind,
+                               [({"cache": n}, st.get(key)) for n, st in cache_stats.items()])
+    lines += _sample_lines("cache_entries", "Entradas em cache.", "gauge",
+                           [({"cache": n}, st.get("entries")) for n, st in cache_stats.items()])
+
+    pool = DB_POOL.stats()
+    lines += _sample_lines("db_pool_connections", "Ligações do pool por estado.", "gauge",
+                           [({"state": "in_use"}, pool["in_use"]), ({"state": "idle"}, pool["idle"])])
+    for key in ("checkouts", "waits", "timeouts", "created", "recycled", "broken"):
+        lines += _sample_lines(f"db_pool_{key}_total", f"Pool de ligações: {key}.", "counter", [({}, pool[key])])
+    lines += _sample_lines("db_pool_wait_seconds_total", "Tempo total à espera de uma ligação do pool.", "counter",
+                           [({}, pool["wait_total_s"])])
+
+    names = NAME_INDEX.stats()
+    lines += _sample_lines("name_index_entries", "Nomes no índice local.", "gauge", [({}, names["entries"])])
+    lines += _sample_lines("name_index_searches_total", "Pesquisas no índice local.", "counter", [({}, names["searches"])])
+    lines += _sample_lines("name_index_local_answers_total", "Pesquisas /geocode respondidas só com o índice local.",
+                           "counter", [({}, names["local_answers"])])
+
+    if WRITE_BEHIND:
+        wb = WRITE_JOURNAL.stats()
+        lines += _sample_lines("write_behind_pending", "Entradas do diário por passar à BD.", "gauge", [({}, wb["pending"])])
+        lines += _sample_lines("write_behind_dead", "Entradas recusadas pela BD demasiadas vezes.", "gauge",
+                               [({}, wb["dead_entries"])])
+        lines += _sample_lines("write_behind_oldest_pending_seconds", "Idade da entrada pendente mais antiga.", "gauge",
+                               [({}, wb["oldest_pending_s"])])
+        for key in ("appended", "flushed", "duplicates", "failures"):
+            lines += _sample_lines(f"write_behind_{key}_total", f"Diário: {key}.", "counter", [({}, wb[key])])
+
+    lines += _sample_lines("osm_cache_upserts_total", "Registos enviados para public.osm_cache, por resultado.", "counter",
+                           [({"result": k}, v) for k, v in _OSM_CACHE_COUNTERS.items()])
+
+    if SPT_INCREMENTAL:
+        for key in ("runs", "deltas", "rows", "full_rebuilds", "errors", "missed"):
+            lines += _sample_lines(f"spt_{key}_total", f"Tabela de análise incremental: {key}.", "counter",
+                                   [({}, _SPT_COUNTERS[key])])
+
+    now = time.time()
+    lines += _sample_lines("overpass_mirror_cooling_down", "1 se o mirror Overpass está em pausa.", "gauge",
+                           [({"endpoint": m.url}, int(now < m.cooldown_until)) for m in OVERPASS_HEALTH.values()])
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=_metrics_text(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ---------- perfis guardados ----------
+_PROFILE_ID = re.compile(r"^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$")
+
+def _check_profile_secret(request: Request) -> None:
+    # sem segredo configurado os perfis ficam só em PROFILE_DIR (podem conter parâmetros dos pedidos)
+    if not PROFILE_SECRET:
+        raise HTTPException(status_code=404, detail="Perfis desativados (PROFILE_SECRET não configurado).")
+    given = request.headers.get("x-profile-secret", "")
+    if not hmac.compare_digest(given.encode(), PROFILE_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Segredo inválido.")
+
+def _list_profiles(limit: int) -> List[Dict[str, Any]]:
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True)[:limit]
+    out = []
+    for name in names:
+        try:
+            with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            continue  # apagado entretanto ou ainda a ser escrito
+        data.pop("folded", None)
+        out.append(data)
+    return out
+
+@app.get("/profiles")
+async def profiles(request: Request, limit: int = Query(50, ge=1, le=1000)):
+    _check_profile_secret(request)
+    return {"profiles": await asyncio.to_thread(_list_profiles, limit)}
+
+@app.get("/profiles/{profile_id}")
+async def profile_download(profile_id: str, request: Request, format: str = Query("json", pattern="^(json|folded)$")):
+    """format=folded: uma linha "pilha contagem" por pilha, para flamegraph.pl / speedscope."""
+    _check_profile_secret(request)
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.json")
+    if not _PROFILE_ID.match(profile_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Perfil não encontrado.")
+    with open(path, "rb") as fh:
+        raw = fh.read()
+    if format == "json":
+        return Response(content=raw, media_type="application/json",
+                        headers={"Content-Disposition": f'attachment; filename="{profile_id}.json"'})
+    folded = json.loads(raw).get("folded") or {}
+    return Response(content="".join(f"{stack} {n}\n" for stack, n in folded.items()), media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'})
+
 @app.api_route("/consent", methods=["GET", "POST"])
 def consent():
     pid = str(uuid.uuid4())
@@ -142,15 +779,199 @@ async def _safe_json_from_request(request: Request) -> Dict[str, Any]:
     return {}
 
 # ---------- helpers DB ----------
+class _PgPool:
+    """
+    Pool de ligações psycopg2 por processo: tamanho min/max, espera limitada quando esgotado,
+    verificação de saúde no checkout (ligações paradas há algum tempo) e reciclagem por
+    inatividade/idade. Regista tempo de espera e saturação para /stats.
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(1, maxconn)
+        self._cond = Condition(Lock())
+        self._idle: "deque[Tuple[Any, float, float]]" = deque()  # (conn, criada_em, última_utilização)
+        self._created_at: Dict[int, float] = {}  # id(conn) -> instante de criação
+        self._size = 0
+        self._pid = os.getpid()
+        self.counters = {
+            "checkouts": 0, "waits": 0, "timeouts": 0, "created": 0, "recycled": 0, "broken": 0,
+            "wait_total_s": 0.0, "wait_max_s": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_client_encoding("UTF8")
+        except Exception:
+            pass
+        self.counters["created"] += 1
+        return conn
+
+    def _close(self, conn) -> None:
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _reset_after_fork(self) -> None:
+        # ligações herdadas de outro processo não podem ser usadas (nem fechadas) aqui
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._created_at.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+    def _prune_idle(self, now: float) -> None:
+        keep: "deque[Tuple[Any, float, float]]" = deque()
+        while self._idle:
+            conn, created, used = self._idle.popleft()
+            expired = now - created > DB_POOL_MAX_LIFETIME_S
+            too_idle = now - used > DB_POOL_IDLE_S and self._size > self.minconn
+            if conn.closed or expired or too_idle:
+                self._close(conn)
+                self._size -= 1
+                self.counters["recycled"] += 1
+            else:
+                keep.append((conn, created, used))
+        self._idle = keep
+
+    def acquire(self, timeout: Optional[float] = None):
+        timeout = DB_POOL_TIMEOUT_S if timeout is None else timeout
+        t0 = time.perf_counter()
+        waited = False
+        while True:
+            with self._cond:
+                self._reset_after_fork()
+                self._prune_idle(time.time())
+                entry = None
+                if self._idle:
+                    entry = self._idle.pop()  # LIFO: a mais recente tem menos hipótese de ter expirado
+                elif self._size < self.maxconn:
+                    self._size += 1
+                else:
+                    remaining = timeout - (time.perf_counter() - t0)
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise HTTPException(status_code=503, detail="Base de dados ocupada, tente novamente.")
+                    waited = True
+                    self._cond.wait(remaining)
+                    continue
+            if entry is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                self._created_at[id(conn)] = time.time()
+            else:
+                conn, _, used = entry
+                if not self._healthy(conn, used):
+                    self.counters["broken"] += 1
+                    self._discard(conn)
+                    continue
+            wait = time.perf_counter() - t0
+            self.counters["checkouts"] += 1
+            if waited:
+                self.counters["waits"] += 1
+            self.counters["wait_total_s"] += wait
+            self.counters["wait_max_s"] = max(self.counters["wait_max_s"], wait)
+            return conn
+
+    def _healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.time() - last_used < DB_POOL_CHECK_AFTER_S:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn) -> None:
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, conn, broken: bool = False) -> None:
+        if broken or conn.closed:
+            self.counters["broken"] += 1 if broken else 0
+            self._discard(conn)
+            return
+        try:
+            if conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.append((conn, self._created_at.get(id(conn), time.time()), time.time()))
+            self._cond.notify()
+
+    def warm(self) -> None:
+        conns = [self.acquire() for _ in range(min(self.minconn, self.maxconn))]
+        for c in conns:
+            self.release(c)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            size, idle = self._size, len(self._idle)
+        checkouts = self.counters["checkouts"] or 1
+        return {
+            "size": size, "idle": idle, "in_use": size - idle, "min": self.minconn, "max": self.maxconn,
+            "saturation": round((size - idle) / self.maxconn, 3),
+            "wait_avg_ms": round(1000 * self.counters["wait_total_s"] / checkouts, 2),
+            **{k: (round(v, 4) if isinstance(v, float) else v) for k, v in self.counters.items()},
+        }
+
+DB_POOL = _PgPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX)
+
+@contextmanager
 def get_conn():
+    """Ligação do pool: commit no fim, rollback em erro, devolvida ao pool em qualquer caso."""
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL não configurada.")
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = DB_POOL.acquire()
+    broken = False
     try:
-        conn.set_client_encoding("UTF8")
-    except Exception:
-        pass
-    return conn
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except BaseException:
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        DB_POOL.release(conn, broken=broken)
+
+async def run_db(fn, *args):
+    """Variante para handlers async: corre fn(conn, *args) numa thread com uma ligação do pool."""
+    def _job():
+        with get_conn() as conn:
+            return fn(conn, *args)
+    return await _to_thread(_job, phase="db")
+
+@app.on_event("startup")
+async def _warm_db_pool():
+    if DATABASE_URL and DB_POOL_MIN > 0:
+        try:
+            await asyncio.to_thread(DB_POOL.warm)
+        except Exception as e:
+            print(f"[db] falha a aquecer o pool: {e!r}")
 
 def ensure_participant(cur, participant_id: str):
     try:
@@ -236,32 +1057,217 @@ def ensure_profile_min(cur, participant_id: str):
         (participant_id, "NA", "na", False),
     )
 
-def fetch_theme_id(cur, code: str) -> Optional[int]:
-    cur.execute("SELECT id FROM public.themes WHERE code=%s", (code,))
-    row = cur.fetchone()
-    return int(row[0]) if row else None
+def resolve_theme_ids(cur, codes: List[str]) -> Dict[str, int]:
+    """code -> id para todos os temas pedidos, criando os que faltam (uma query em regra)."""
+    wanted = sorted(set(codes))
+    if not wanted:
+        return {}
+    cur.execute("SELECT code, id FROM public.themes WHERE code = ANY(%s)", (wanted,))
+    ids = {code: int(tid) for code, tid in cur.fetchall()}
+    missing = [c for c in wanted if c not in ids]
+    if missing:
+        rows = psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO public.themes (code) VALUES %s ON CONFLICT (code) DO NOTHING RETURNING code, id",
+            [(c,) for c in missing],
+            fetch=True,
+        )
+        ids.update({code: int(tid) for code, tid in rows})
+        # criados entretanto por outro pedido (ON CONFLICT não devolve a linha)
+        still = [c for c in missing if c not in ids]
+        if still:
+            cur.execute("SELECT code, id FROM public.themes WHERE code = ANY(%s)", (still,))
+            ids.update({code: int(tid) for code, tid in cur.fetchall()})
+    return ids
+
+class _ThemeRegistry:
+    """
+    code -> id de public.themes em memória, carregado no arranque e atualizado quando o /submit
+    cria temas. Entre workers, a validade é confirmada por uma versão da tabela (hash de id:code,
+    barato numa tabela deste tamanho) no máximo a cada THEME_REGISTRY_CHECK_S segundos.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+        self._lock = Lock()
+
+    @staticmethod
+    def _read_version(cur) -> str:
+        cur.execute("SELECT COALESCE(md5(string_agg(id::text || ':' || code, ',' ORDER BY id)), '') FROM public.themes")
+        return cur.fetchone()[0]
+
+    def load(self, cur) -> None:
+        version = self._read_version(cur)
+        cur.execute("SELECT code, id FROM public.themes")
+        ids = {code: int(tid) for code, tid in cur.fetchall()}
+        with self._lock:
+            self._ids = ids
+            self._version = version
+            self._checked_at = time.time()
+
+    def _ensure_fresh(self, cur) -> None:
+        if time.time() - self._checked_at < THEME_REGISTRY_CHECK_S:
+            return
+        if self._read_version(cur) != self._version:
+            self.load(cur)
+        else:
+            self._checked_at = time.time()
+
+    def remember(self, ids: Dict[str, int]) -> None:
+        with self._lock:
+            self._ids.update(ids)
+
+    def resolve(self, cur, codes: List[str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """
+        Como resolve_theme_ids(), mas só vai à BD para códigos desconhecidos. Devolve também os
+        que vieram da BD, para remember() depois do commit: um tema criado numa transação que
+        acaba em rollback não pode ficar no registo (a FK de theme_id falharia até reiniciar).
+        """
+        self._ensure_fresh(cur)
+        ids = {c: self._ids[c] for c in set(codes) if c in self._ids}
+        missing = [c for c in set(codes) if c not in ids]
+        found = resolve_theme_ids(cur, missing) if missing else {}
+        ids.update(found)
+        return ids, found
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._ids), "checked_at": self._checked_at}
+
+THEME_REGISTRY = _ThemeRegistry()
+
+def _load_theme_registry(conn) -> None:
+    with conn.cursor() as cur:
+        THEME_REGISTRY.load(cur)
+
+@app.on_event("startup")
+async def _preload_theme_registry():
+    if DATABASE_URL:
+        try:
+            await run_db(_load_theme_registry)
+        except Exception as e:
+            print(f"[themes] falha a pré-carregar temas: {e!r}")
+
+# geom/bbox guardados na escrita (MultiPolygon válido em 4326) para o índice GiST e as vistas não
+# reinterpretarem o GeoJSON; content_hash evita reescrever (e revalidar) o que já lá está
+_OSM_CACHE_STATE: Dict[str, Any] = {"ddl": False}
+_OSM_CACHE_COUNTERS = {"written": 0, "unchanged": 0}
+
+def _ensure_osm_cache_ddl() -> None:
+    """Só no arranque: nunca com uma transação de pedido aberta sobre osm_cache."""
+    if _OSM_CACHE_STATE["ddl"]:
+        return
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # ALTER TABLE pede um lock exclusivo mesmo com IF NOT EXISTS: só quando a coluna falta
+            cur.execute(
+                "SELECT 1 FROM information_schema.columns"
+                " WHERE table_schema = 'public' AND table_name = 'osm_cache' AND column_name = 'content_hash'"
+            )
+            if cur.fetchone() is None:
+                cur.execute("ALTER TABLE public.osm_cache ADD COLUMN IF NOT EXISTS content_hash text")
+    _OSM_CACHE_STATE["ddl"] = True
+
+@app.on_event("startup")
+async def _prepare_osm_cache():
+    if DATABASE_URL:
+        try:
+            await asyncio.to_thread(_ensure_osm_cache_ddl)
+        except Exception as e:
+            print(f"[osm_cache] content_hash por confirmar ({e!r}); escrita sem hash")
+
+def _osm_cache_row(osm_id: int, rec: Dict[str, Any]) -> Tuple[Any, ...]:
+    osm_type = rec.get("osm_type") or ""
+    display_name = rec.get("display_name") or ""
+    geojson = json.dumps(rec.get("geojson"), sort_keys=True, separators=(",", ":"))
+    body = json.dumps([osm_type, display_name, rec.get("class"), rec.get("type"), geojson], ensure_ascii=False)
+    content_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    return (osm_id, osm_type, display_name, rec.get("class"), rec.get("type"), geojson, content_hash)
 
 def upsert_osm_cache(cur, rec: Dict[str, Any]):
+    upsert_osm_cache_many(cur, [rec])
+
+def upsert_osm_cache_many(cur, recs: List[Dict[str, Any]]) -> List[int]:
+    """Devolve os osm_id inseridos ou alterados (linhas com o mesmo content_hash não são reescritas)."""
+    # um osm_id só pode aparecer uma vez por INSERT ... ON CONFLICT: fica o último
+    by_id: Dict[int, Dict[str, Any]] = {int(r.get("osm_id")): r for r in recs}
+    if not by_id:
+        return []
+    rows = [_osm_cache_row(osm_id, rec) for osm_id, rec in by_id.items()]
+    if not _OSM_CACHE_STATE["ddl"]:
+        return _upsert_osm_cache_unhashed(cur, rows)
     cur.execute(
+        "SELECT osm_id, content_hash FROM public.osm_cache WHERE osm_id = ANY(%s::bigint[])",
+        (list(by_id),),
+    )
+    stored = dict(cur.fetchall())
+    todo = [r for r in rows if stored.get(r[0]) != r[6]]
+    _OSM_CACHE_COUNTERS["unchanged"] += len(rows) - len(todo)
+    if not todo:
+        return []
+    written = psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO public.osm_cache
+          (osm_id, osm_type, display_name, class, type, geojson, content_hash, geom, bbox, updated_at)
+        SELECT v.osm_id, v.osm_type, v.display_name, v.class, v.type, v.geojson::jsonb, v.content_hash,
+               g.geom, ST_Envelope(g.geom), now()
+        FROM (VALUES %s) AS v (osm_id, osm_type, display_name, class, type, geojson, content_hash)
+        CROSS JOIN LATERAL (
+          SELECT ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_SetSRID(ST_GeomFromGeoJSON(v.geojson), 4326)), 3)) AS geom
+        ) g
+        ON CONFLICT (osm_id) DO UPDATE SET
+            osm_type = EXCLUDED.osm_type,
+            display_name = EXCLUDED.display_name,
+            class = EXCLUDED.class,
+            type = EXCLUDED.type,
+            geojson = EXCLUDED.geojson,
+            content_hash = EXCLUDED.content_hash,
+            geom = EXCLUDED.geom,
+            bbox = EXCLUDED.bbox,
+            updated_at = EXCLUDED.updated_at
+        WHERE osm_cache.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+        RETURNING osm_id
+        """,
+        todo,
+        template="(%s::bigint, %s::text, %s::text, %s::text, %s::text, %s::text, %s::text)",
+        page_size=500,
+        fetch=True,
+    )
+    _OSM_CACHE_COUNTERS["written"] += len(written)
+    return [r[0] for r in written]
+
+def _upsert_osm_cache_unhashed(cur, rows: List[Tuple[Any, ...]]) -> List[int]:
+    # content_hash não confirmada no arranque: reescreve tudo, sem tocar na coluna
+    written = psycopg2.extras.execute_values(
+        cur,
         """
-        INSERT INTO public.osm_cache (osm_id, osm_type, display_name, class, type, geojson)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        INSERT INTO public.osm_cache (osm_id, osm_type, display_name, class, type, geojson, geom, bbox, updated_at)
+        SELECT v.osm_id, v.osm_type, v.display_name, v.class, v.type, v.geojson::jsonb,
+               g.geom, ST_Envelope(g.geom), now()
+        FROM (VALUES %s) AS v (osm_id, osm_type, display_name, class, type, geojson)
+        CROSS JOIN LATERAL (
+          SELECT ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_SetSRID(ST_GeomFromGeoJSON(v.geojson), 4326)), 3)) AS geom
+        ) g
         ON CONFLICT (osm_id) DO UPDATE SET
             osm_type = EXCLUDED.osm_type,
             display_name = EXCLUDED.display_name,
             class = EXCLUDED.class,
             type = EXCLUDED.type,
-            geojson = EXCLUDED.geojson
+            geojson = EXCLUDED.geojson,
+            geom = EXCLUDED.geom,
+            bbox = EXCLUDED.bbox,
+            updated_at = EXCLUDED.updated_at
+        RETURNING osm_id
         """,
-        (
-            int(rec.get("osm_id")),
-            rec.get("osm_type") or "",
-            rec.get("display_name") or "",
-            rec.get("class"),
-            rec.get("type"),
-            json.dumps(rec.get("geojson")),
-        ),
+        [r[:6] for r in rows],
+        template="(%s::bigint, %s::text, %s::text, %s::text, %s::text, %s::text)",
+        page_size=500,
+        fetch=True,
     )
+    _OSM_CACHE_COUNTERS["written"] += len(written)
+    return [r[0] for r in written]
 
 # ===================== /profile ============================================
 @app.post("/profile")
@@ -270,12 +1276,20 @@ async def profile(request: Request, participant_id: Optional[str] = Query(None))
     if not isinstance(data, dict):
         data = {"payload": data}
 
-    with get_conn() as conn:
+    if WRITE_BEHIND and participant_id:
+        if not _valid_participant_id(participant_id):
+            return {"ok": False, "error": "participant_id inválido"}
+        await _to_thread(WRITE_JOURNAL.append, "profile", participant_id, data, phase="journal")
+        return {"ok": True, "participant_id": participant_id, "received": data, "queued": True}
+
+    def _save(conn):
         with conn.cursor() as cur:
             if participant_id:
                 ensure_participant(cur, participant_id)
                 upsert_profile(cur, participant_id, data)
-        conn.commit()
+                _record_spt_delta(cur, [participant_id])
+
+    await run_db(_save)
 
     return {"ok": True, "participant_id": participant_id, "received": data}
 
@@ -304,242 +1318,1075 @@ def _normalize_geojson(item: Dict[str, Any]) -> Dict[str, Any]:
     except Exception:
         return {}
 
-def _cache_get(key: str) -> Optional[Dict[str, Any]]:
-    now = time.time()
-    hit = OVERPASS_CACHE.get(key)
-    if not hit:
-        return None
-    ts, data = hit
-    if now - ts > CACHE_TTL_S:
-        OVERPASS_CACHE.pop(key, None)
-        return None
-    return data
+class _MemoryCache:
+    """LRU em memória (por processo) com TTL por entrada."""
 
-def _cache_set(key: str, data: Dict[str, Any]) -> None:
-    OVERPASS_CACHE[key] = (time.time(), data)
-
-def _overpass_request(ql: str) -> Dict[str, Any]:
-    global LAST_OVERPASS_CALL
-    headers = {"User-Agent": USER_AGENT}
-    with OVERPASS_LOCK:
-        delay = time.perf_counter() - LAST_OVERPASS_CALL
-        if delay < MIN_INTERVAL_S:
-            time.sleep(MIN_INTERVAL_S - delay)
-        last_exc: Optional[Exception] = None
-        for url in OVERPASS_ENDPOINTS:
-            try:
-                r = requests.post(url, data={"data": ql}, headers=headers, timeout=45)
-                if r.status_code in (429, 502, 503, 504):
-                    time.sleep(1.2)
-                    r = requests.post(url, data={"data": ql}, headers=headers, timeout=45)
-                r.raise_for_status()
-                LAST_OVERPASS_CALL = time.perf_counter()
-                return r.json()
-            except Exception as e:
-                last_exc = e
-                continue
-        raise HTTPException(status_code=502, detail=f"Overpass indisponível: {type(last_exc).__name__}")
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = Lock()
+        self.counters = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
 
-def _way_geojson(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    geom = el.get("geometry")
-    if not isinstance(geom, list) or len(geom) < 2:
-        return None
-    coords = [[pt["lon"], pt["lat"]] for pt in geom]
-    # Se for anel fechado (>=4 e primeiro==último) -> Polígono
-    if len(coords) >= 4 and coords[0] == coords[-1]:
-        return {"type": "Polygon", "coordinates": [coords]}
-    # Caso contrário, é LineString
-    return {"type": "LineString", "coordinates": coords}
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                self.counters["misses"] += 1
+                return None
+            expires_at, data = hit
+            if time.time() > expires_at:
+                self._data.pop(key, None)
+                self.counters["expired"] += 1
+                self.counters["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.counters["hits"] += 1
+            return data
 
-def _relation_geojson(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    # 1) tenta montar MultiPolygon a partir de members com anéis fechados
-    members = el.get("members") or []
-    polys: List[List[List[float]]] = []
-    for m in members:
-        mg = m.get("geometry")
-        if isinstance(mg, list) and len(mg) >= 4:
-            ring = [[p["lon"], p["lat"]] for p in mg]
-            if ring[0] == ring[-1]:
-                polys.append(ring)
-    if polys:
-        return {"type": "MultiPolygon", "coordinates": [[ring] for ring in polys]}
-    # 2) fallback: juntar geometria como MultiLineString
-    geom = el.get("geometry")
-    if isinstance(geom, list) and len(geom) >= 2:
-        line = [[p["lon"], p["lat"]] for p in geom]
-        return {"type": "MultiLineString", "coordinates": [line]}
-    return None
+    def set(self, key: str, data: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + (CACHE_TTL_S if ttl is None else ttl), data)
+            self._data.move_to_end(key)
+            self.counters["sets"] += 1
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.counters["evictions"] += 1
 
-def _elements_to_features_any(elements: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    feats: List[Dict[str, Any]] = []
-    seen = set()
-    for el in elements:
-        t = el.get("type")
-        osm_id = el.get("id")
-        if (t, osm_id) in seen:
-            continue
+    def keys_with_prefix(self, prefix: str) -> List[str]:
+        with self._lock:
+            return [k for k in self._data if k.startswith(prefix)]
 
-        tags = el.get("tags", {}) or {}
-        display = tags.get("name") or f"osm:{t}"
-        cls, typ = None, None
-        for k in ["place", "building", "amenity", "leisure", "tourism", "historic", "landuse", "highway", "railway"]:
-            if k in tags:
-                cls, typ = k, tags.get(k)
-                break
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "entries": len(self._data), "max_entries": self.max_entries, **self.counters}
 
-        gj = None
-        if t == "node":
-            lat = el.get("lat"); lon = el.get("lon")
-            if isinstance(lat, (float, int)) and isinstance(lon, (float, int)):
-                gj = {"type": "Point", "coordinates": [float(lon), float(lat)]}
-        elif t == "way":
-            gj = _way_geojson(el)
-        elif t == "relation":
-            gj = _relation_geojson(el)
+class _SQLiteCache:
+    """
+    Cache em disco (SQLite, WAL) partilhada pelos workers do mesmo host.
+    Valores em JSON comprimido (zlib); expulsão LRU por nº de entradas e por bytes.
+    Os contadores são por processo.
+    """
 
-        if not isinstance(gj, dict) or "type" not in gj:
-            continue
+    def __init__(self, path: str, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        self._lock = Lock()
+        self.counters = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
 
-        feats.append({
-            "osm_id": int(osm_id) if isinstance(osm_id, int) else osm_id,
-            "osm_type": t,
-            "display_name": display,
-            "class": cls,
-            "type": typ,
-            "geojson": gj,
-            "geometry_type": gj.get("type"),
-        })
-        seen.add((t, osm_id))
-    return feats
+    def _db(self) -> sqlite3.Connection:
+        # ligação aberta de forma preguiçosa e por processo (workers fazem fork depois do import)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY, expires_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " size INTEGER NOT NULL, value BLOB NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
 
-def _build_overpass_name_query(q: str) -> str:
-    # usa regex case-insensitive, escapando caracteres especiais do overpass
-    patt = re.escape(q)
-    # procurar também por place=suburb/neighbourhood/quarter
-    return f"""
-[out:json][timeout:45];
-area["name"="Lisboa"]["boundary"="administrative"]["admin_level"~"^(7|8)$"]->.searchArea;
-(
-  node(area.searchArea)["name"~"{patt}", i];
-  way(area.searchArea)["name"~"{patt}", i];
-  relation(area.searchArea)["name"~"{patt}", i];
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT expires_at, accessed_at, value FROM cache WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            expires_at, accessed_at, blob = row
+            if now > expires_at:
+                db.execute("DELETE FROM cache WHERE key=?", (key,))
+                self.counters["expired"] += 1
+                self.counters["misses"] += 1
+                return None
+            if now - accessed_at > 30:  # evita uma escrita por leitura
+                db.execute("UPDATE cache SET accessed_at=? WHERE key=?", (now, key))
+            self.counters["hits"] += 1
+        return json.loads(zlib.decompress(blob))
 
-  node(area.searchArea)["place"~"suburb|neighbourhood|quarter", i]["name"~"{patt}", i];
-  way(area.searchArea)["place"~"suburb|neighbourhood|quarter", i]["name"~"{patt}", i];
+    def set(self, key: str, data: Any, ttl: Optional[float] = None) -> None:
+        blob = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 6)
+        now = time.time()
+        expires_at = now + (CACHE_TTL_S if ttl is None else ttl)
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO cache (key, expires_at, accessed_at, size, value) VALUES (?, ?, ?, ?, ?)",
+                (key, expires_at, now, len(blob), sqlite3.Binary(blob)),
+            )
+            self.counters["sets"] += 1
+            self._evict(db, now)
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        self.counters["expired"] += db.execute("DELETE FROM cache WHERE expires_at < ?", (now,)).rowcount
+        count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        while count > self.max_entries or total > self.max_bytes:
+            n = max(1, count - self.max_entries, count // 10 if total > self.max_bytes else 0)
+            removed = db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (n,)
+            ).rowcount
+            if not removed:
+                break
+            self.counters["evictions"] += removed
+            count, total = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+
+    def keys_with_prefix(self, prefix: str) -> List[str]:
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT key FROM cache WHERE key LIKE ? ESCAPE '\\' AND expires_at >= ?", (pattern, time.time())
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return {
+            "backend": "sqlite", "path": self.path, "entries": count, "bytes": total,
+            "max_entries": self.max_entries, "max_bytes": self.max_bytes, **self.counters,
+        }
+
+def _make_cache():
+    if CACHE_BACKEND == "sqlite":
+        return _SQLiteCache(CACHE_PATH)
+    return _MemoryCache()
+
+OVERPASS_CACHE = _make_cache()
+
+async def _cache_call(fn: Callable[..., Any], *args: Any) -> Any:
+    # backend sqlite: I/O bloqueante (e lock partilhado entre workers, até 10 s) fora do event loop
+    if isinstance(OVERPASS_CACHE, _SQLiteCache):
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+async def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    return await _cache_call(OVERPASS_CACHE.get, key)
+
+async def _cache_set(key: str, data: Dict[str, Any], ttl: Optional[float] = None) -> None:
+    await _cache_call(OVERPASS_CACHE.set, key, data, ttl)
+
+async def _cache_get_many(keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+    return await _cache_call(lambda: [OVERPASS_CACHE.get(k) for k in keys])
+
+async def _cache_set_many(items: List[Tuple[str, Dict[str, Any]]]) -> None:
+    await _cache_call(lambda: [OVERPASS_CACHE.set(k, v) for k, v in items])
+
+# ---------- respostas rápidas: JSON pré-serializado + compressão (opt-in) ----------
+RESPONSE_CACHE = _MemoryCache(RESPONSE_CACHE_MAX)
+
+def _dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _pick_encoding(request: Request) -> str:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    if "br" in accepted and brotli is not None:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+def _response_key(request: Request, encoding: str) -> str:
+    # /x e /api/x partilham a mesma entrada
+    path = request.url.path
+    if path.startswith("/api/"):
+        path = path[4:]
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    return f"{encoding}|{path}?{query}"
+
+def _compress(raw: bytes, encoding: str) -> Tuple[str, bytes]:
+    if len(raw) < FAST_MIN_COMPRESS_BYTES or encoding == "identity":
+        return "identity", raw
+    if encoding == "br":
+        return "br", brotli.compress(raw, quality=FAST_BROTLI_QUALITY)
+    return "gzip", gzip.compress(raw, compresslevel=FAST_GZIP_LEVEL)
+
+def _bytes_response(encoding: str, body: bytes) -> Response:
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def _cached_response(request: Request) -> Optional[Response]:
+    """Bytes já serializados (e comprimidos) para este pedido, se existirem; nunca volta a gerar JSON."""
+    if not FAST_RESPONSES:
+        return None
+    encoding = _pick_encoding(request)
+    hit = RESPONSE_CACHE.get(_response_key(request, encoding))
+    if hit is not None:
+        return _bytes_response(*hit)
+    if encoding == "identity":
+        return None
+    raw = RESPONSE_CACHE.get(_response_key(request, "identity"))
+    if raw is None:
+        return None
+    hit = await _to_thread(_compress, raw[1], encoding, phase="serialization")
+    RESPONSE_CACHE.set(_response_key(request, encoding), hit, RESPONSE_CACHE_TTL_S)
+    return _bytes_response(*hit)
+
+async def _fast_response(request: Request, payload: Dict[str, Any], cache: bool = True) -> Any:
+    """
+    Com FAST_RESPONSES=1 serializa diretamente para bytes (orjson se instalado, sem passar
+    pelo jsonable_encoder), comprime conforme Accept-Encoding e guarda os bytes em cache.
+    Sem a opção devolve o dict tal como antes.
+    """
+    if not FAST_RESPONSES:
+        return payload
+    encoding = _pick_encoding(request)
+
+    def _encode() -> Tuple[bytes, Tuple[str, bytes]]:
+        raw = _dumps(payload)
+        return raw, _compress(raw, encoding)
+
+    raw, hit = await _to_thread(_encode, phase="serialization")
+    if cache:
+        RESPONSE_CACHE.set(_response_key(request, "identity"), ("identity", raw), RESPONSE_CACHE_TTL_S)
+        if encoding != "identity":
+            RESPONSE_CACHE.set(_response_key(request, encoding), hit, RESPONSE_CACHE_TTL_S)
+    return _bytes_response(*hit)
+
+class _SingleFlight:
+    """
+    Junta chamadas concorrentes com a mesma chave numa única chamada upstream:
+    quem chega enquanto há uma em curso espera e recebe o mesmo resultado (ou o mesmo erro).
+    A chamada partilhada corre numa task própria; cancelar um dos interessados não a cancela.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: str, fn):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda t, k=key: self._flights.pop(k, None) if self._flights.get(k) is t else None)
+        return await asyncio.shield(task)
+
+UPSTREAM_FLIGHTS = _SingleFlight()
+
+class _RateLimiter:
+    """
+    Intervalo mínimo entre chamadas sem bloquear o event loop: cada chamada reserva
+    o próximo slot livre e aguarda (asyncio.sleep) só até lá.
+    """
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self._next = 0.0
+
+    async def wait(self) -> float:
+        now = time.perf_counter()
+        slot = max(now, self._next)
+        self._next = slot + self.interval_s
+        delay = slot - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+OVERPASS_LIMITER = _RateLimiter(MIN_INTERVAL_S)
+
+# tasks em segundo plano (referência forte até terminarem)
+_BACKGROUND_TASKS: set = set()
+
+# cliente HTTP partilhado (keep-alive) + semáforo Overpass, recriados se o event loop mudar
+_HTTP_STATE: Dict[str, Any] = {}
+
+def _http() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    if _HTTP_STATE.get("loop") is not loop:
+        _HTTP_STATE["loop"] = loop
+        _HTTP_STATE["client"] = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(45.0, connect=10.0),
+        )
+        _HTTP_STATE["overpass_slots"] = asyncio.Semaphore(OVERPASS_MAX_CONCURRENCY)
+    return _HTTP_STATE["client"]
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    client = _HTTP_STATE.pop("client", None)
+    _HTTP_STATE.pop("loop", None)
+    if client is not None:
+        await client.aclose()
+
+async def _overpass_request(
+    ql: str, convert: Callable[[Dict[str, Any]], Any], on_batch: Optional[Callable[[List[Any]], None]] = None,
+) -> List[Any]:
+    """
+    Executa a query e devolve os elementos já convertidos por convert (None = descartado).
+    on_batch recebe cada lote convertido assim que chega (só o de quem iniciou a chamada partilhada).
+    A mesma query é sempre convertida da mesma forma, por isso a chave partilhada é só a query.
+    """
+    return await UPSTREAM_FLIGHTS.do(f"overpass|{ql}", lambda: _overpass_request_upstream(ql, convert, on_batch))
+
+class _MirrorHealth:
+    """Latência e erros recentes de um mirror Overpass."""
+
+    def __init__(self, url: str, order: int):
+        self.url = url
+        self.order = order
+        self.latencies: "deque[float]" = deque(maxlen=50)
+        self.outcomes: "deque[bool]" = deque(maxlen=50)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record(self, ok: bool, latency_s: float) -> None:
+        self.latencies.append(latency_s)
+        self.outcomes.append(ok)
+        if ok:
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= OVERPASS_FAILS_TO_COOLDOWN:
+            self.cooldown_until = time.time() + OVERPASS_COOLDOWN_S
+            self.consecutive_failures = 0
+
+    def record_abandoned(self, elapsed_s: float) -> None:
+        # pedido cancelado por ter perdido o hedge: conta como amostra de latência (limite inferior)
+        self.latencies.append(elapsed_s)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(p * len(xs)))]
+
+    def error_rate(self) -> float:
+        return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+    def score(self) -> float:
+        p50 = self.percentile(0.5)
+        return (p50 if p50 is not None else 1.0) * (1.0 + 4.0 * self.error_rate())
+
+    def hedge_delay(self) -> float:
+        p = self.percentile(OVERPASS_HEDGE_PERCENTILE) if len(self.latencies) >= 5 else None
+        if p is None:
+            return OVERPASS_HEDGE_MAX_S
+        return min(OVERPASS_HEDGE_MAX_S, max(OVERPASS_HEDGE_MIN_S, p))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "p50_s": self.percentile(0.5),
+            "p90_s": self.percentile(0.9),
+            "error_rate": round(self.error_rate(), 3),
+            "cooling_down": time.time() < self.cooldown_until,
+        }
+
+OVERPASS_HEALTH: Dict[str, _MirrorHealth] = {u: _MirrorHealth(u, i) for i, u in enumerate(OVERPASS_ENDPOINTS)}
+
+def _ranked_mirrors() -> List[_MirrorHealth]:
+    now = time.time()
+    mirrors = list(OVERPASS_HEALTH.values())
+    healthy = [m for m in mirrors if now >= m.cooldown_until]
+    if not healthy:  # todos em pausa: tenta mesmo assim, pelo fim de pausa mais próximo
+        return sorted(mirrors, key=lambda m: m.cooldown_until)
+    return sorted(healthy, key=lambda m: (m.score(), m.order))
+
+class _OverpassElementStream:
+    """
+    Lê a resposta JSON do Overpass aos bocados e converte cada elemento de "elements"
+    assim que chega completo, sem montar o documento inteiro (nem a lista de elementos) em memória.
+    """
+
+    _ELEMENTS_START = re.compile(r'"elements"\s*:\s*\[')
+
+    def __init__(self, convert: Callable[[Dict[str, Any]], Any]):
+        self.convert = convert
+        self.elements = 0
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._in_array = False
+        self._done = False
+        self._retry_at = 0
+
+    def feed(self, chunk: bytes, final: bool = False) -> List[Any]:
+        """Converte os elementos que ficaram completos com este bocado; final=True no fim da resposta."""
+        out: List[Any] = []
+        if self._done:
+            return out
+        self._buf += self._text.decode(chunk, final)
+        if not self._in_array:
+            m = self._ELEMENTS_START.search(self._buf)
+            if m is None:
+                if final:
+                    json.loads(self._buf)  # resposta sem "elements": erro de JSON se não for JSON
+                return out
+            self._buf = self._buf[m.end():]
+            self._in_array = True
+        # elemento grande a meio: só se volta a tentar quando o buffer duplicar (custo linear)
+        if not final and len(self._buf) < self._retry_at:
+            return out
+
+        buf, pos, n = self._buf, 0, len(self._buf)
+        incomplete = False
+        while True:
+            while pos < n and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= n:
+                break
+            if buf[pos] == "]":
+                self._done = True
+                break
+            try:
+                el, pos = self._json.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                incomplete = True
+                break
+            self.elements += 1
+            item = self.convert(el)
+            if item is not None:
+                out.append(item)
+        self._buf = "" if self._done else buf[pos:]
+        self._retry_at = 2 * len(self._buf) if incomplete else 0
+        if final and not self._done:
+            raise ValueError("Resposta Overpass truncada.")
+        return out
+
+async def _overpass_attempt(
+    client: httpx.AsyncClient, mirror: _MirrorHealth, ql: str,
+    convert: Callable[[Dict[str, Any]], Any], on_batch: Optional[Callable[[List[Any]], None]],
+) -> List[Any]:
+    t0 = time.perf_counter()
+    try:
+        for attempt in range(2):
+            async with client.stream("POST", mirror.url, data={"data": ql}, timeout=45) as r:
+                if attempt == 0 and r.status_code in (429, 502, 503, 504):
+                    retry = True
+                    UPSTREAM_RETRIES.inc("overpass", mirror.url, r.status_code)
+                else:
+                    retry = False
+                    r.raise_for_status()
+                    # elementos convertidos à medida que chegam; conversão (CPU) fora do event loop
+                    parser = _OverpassElementStream(convert)
+                    items: List[Any] = []
+                    async for chunk in r.aiter_bytes(OVERPASS_STREAM_CHUNK):
+                        batch = await _to_thread(parser.feed, chunk, phase="conversion")
+                        if batch:
+                            items.extend(batch)
+                            if on_batch is not None:
+                                on_batch(batch)
+                    batch = await _to_thread(parser.feed, b"", True, phase="conversion")
+                    if batch:
+                        items.extend(batch)
+                        if on_batch is not None:
+                            on_batch(batch)
+            if not retry:
+                break
+            await asyncio.sleep(1.2)
+    except asyncio.CancelledError:
+        mirror.record_abandoned(time.perf_counter() - t0)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - t0, "overpass", mirror.url, "cancelled")
+        raise
+    except Exception as e:
+        mirror.record(False, time.perf_counter() - t0)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - t0, "overpass", mirror.url, _upstream_outcome(e))
+        raise
+    mirror.record(True, time.perf_counter() - t0)
+    UPSTREAM_LATENCY.observe(time.perf_counter() - t0, "overpass", mirror.url, "ok")
+    return items
+
+async def _overpass_request_upstream(
+    ql: str, convert: Callable[[Dict[str, Any]], Any], on_batch: Optional[Callable[[List[Any]], None]] = None,
+) -> List[Any]:
+    """
+    Tenta o mirror mais saudável; se não responder dentro do seu percentil de latência,
+    lança um pedido duplicado no seguinte e fica com o primeiro que responder (o outro é cancelado).
+    Em caso de erro passa ao próximo mirror da lista.
+    """
+    client = _http()
+    t0 = time.perf_counter()
+    async with _HTTP_STATE["overpass_slots"]:
+        OVERPASS_WAIT.observe(time.perf_counter() - t0, "slot")
+        OVERPASS_WAIT.observe(await OVERPASS_LIMITER.wait(), "interval")
+        queue = _ranked_mirrors()
+        running: Dict["asyncio.Task[List[Any]]", _MirrorHealth] = {}
+        last_exc: Optional[BaseException] = None
+
+        def _launch() -> None:
+            m = queue.pop(0)
+            running[asyncio.create_task(_overpass_attempt(client, m, ql, convert, on_batch))] = m
+        _launch()
+        try:
+            while running:
+                timeout = None
+                if queue and len(running) == 1:
+                    timeout = next(iter(running.values())).hedge_delay()
+                done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    _launch()  # hedge
+                    continue
+                for t in done:
+                    running.pop(t)
+                    if t.exception() is None:
+                        return t.result()
+                    last_exc = t.exception()
+                if not running and queue:
+                    _launch()
+        finally:
+            for t in running:
+                t.cancel()
+        raise HTTPException(status_code=502, detail=f"Overpass indisponível: {type(last_exc).__name__}")
+
+def _way_geojson(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    geom = el.get("geometry")
+    if not isinstance(geom, list) or len(geom) < 2:
+        return None
+    coords = [[pt["lon"], pt["lat"]] for pt in geom]
+    # Se for anel fechado (>=4 e primeiro==último) -> Polígono
+    if len(coords) >= 4 and coords[0] == coords[-1]:
+        return {"type": "Polygon", "coordinates": [coords]}
+    # Caso contrário, é LineString
+    return {"type": "LineString", "coordinates": coords}
+
+def _relation_geojson(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # 1) tenta montar MultiPolygon a partir de members com anéis fechados
+    members = el.get("members") or []
+    polys: List[List[List[float]]] = []
+    for m in members:
+        mg = m.get("geometry")
+        if isinstance(mg, list) and len(mg) >= 4:
+            ring = [[p["lon"], p["lat"]] for p in mg]
+            if ring[0] == ring[-1]:
+                polys.append(ring)
+    if polys:
+        return {"type": "MultiPolygon", "coordinates": [[ring] for ring in polys]}
+    # 2) fallback: juntar geometria como MultiLineString
+    geom = el.get("geometry")
+    if isinstance(geom, list) and len(geom) >= 2:
+        line = [[p["lon"], p["lat"]] for p in geom]
+        return {"type": "MultiLineString", "coordinates": [line]}
+    return None
+
+def _element_to_feature_any(el: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    t = el.get("type")
+    osm_id = el.get("id")
+    tags = el.get("tags", {}) or {}
+    display = tags.get("name") or f"osm:{t}"
+    cls, typ = None, None
+    for k in ["place", "building", "amenity", "leisure", "tourism", "historic", "landuse", "highway", "railway"]:
+        if k in tags:
+            cls, typ = k, tags.get(k)
+            break
+
+    gj = None
+    if t == "node":
+        lat = el.get("lat"); lon = el.get("lon")
+        if isinstance(lat, (float, int)) and isinstance(lon, (float, int)):
+            gj = {"type": "Point", "coordinates": [float(lon), float(lat)]}
+    elif t == "way":
+        gj = _way_geojson(el)
+    elif t == "relation":
+        gj = _relation_geojson(el)
+
+    if not isinstance(gj, dict) or "type" not in gj:
+        return None
+    return {
+        "osm_id": int(osm_id) if isinstance(osm_id, int) else osm_id,
+        "osm_type": t,
+        "display_name": display,
+        "class": cls,
+        "type": typ,
+        "geojson": gj,
+        "geometry_type": gj.get("type"),
+    }
+
+def _dedupe_features_any(feats: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    seen = set()
+    for f in feats:
+        key = (f["osm_type"], f["osm_id"])
+        if key not in seen:
+            seen.add(key)
+            out.append(f)
+    return out
+
+def _build_overpass_name_query(q: str) -> str:
+    # usa regex case-insensitive, escapando caracteres especiais do overpass
+    patt = re.escape(q)
+    # procurar também por place=suburb/neighbourhood/quarter
+    return f"""
+[out:json][timeout:45];
+area["name"="Lisboa"]["boundary"="administrative"]["admin_level"~"^(7|8)$"]->.searchArea;
+(
+  node(area.searchArea)["name"~"{patt}", i];
+  way(area.searchArea)["name"~"{patt}", i];
+  relation(area.searchArea)["name"~"{patt}", i];
+
+  node(area.searchArea)["place"~"suburb|neighbourhood|quarter", i]["name"~"{patt}", i];
+  way(area.searchArea)["place"~"suburb|neighbourhood|quarter", i]["name"~"{patt}", i];
   relation(area.searchArea)["place"~"suburb|neighbourhood|quarter", i]["name"~"{patt}", i];
 );
 out tags geom;
 """.strip()
 
-@app.get("/geocode")
-def geocode(q: str = Query(..., min_length=2)):
-    """
-    Busca combinada:
-      1) Nominatim ancorado em Lisboa (+ fallback "q Lisboa"), aceitando Point/Line/Polygon.
-      2) Overpass por nome dentro da área administrativa de Lisboa (fallback enriquecedor).
-    Junta, remove duplicados e devolve geometry_type para a UI.
-    """
-    base_url = f"{NOMINATIM_URL.rstrip('/')}/search"
-    headers = {"User-Agent": USER_AGENT, "Accept-Language": "pt"}
+async def _run_nominatim(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    key = "nominatim|" + json.dumps(params, sort_keys=True)
+    return await UPSTREAM_FLIGHTS.do(key, lambda: _run_nominatim_upstream(params))
 
-    def _run_nominatim(params: Dict[str, Any]) -> List[Dict[str, Any]]:
-        r = requests.get(base_url, params=params, headers=headers, timeout=15)
+async def _run_nominatim_upstream(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    client = _http()
+    base_url = f"{NOMINATIM_URL.rstrip('/')}/search"
+    headers = {"Accept-Language": "pt"}
+    t0, outcome = time.perf_counter(), "cancelled"
+    try:
+        r = await client.get(base_url, params=params, headers=headers, timeout=15)
         if r.status_code == 429:
+            UPSTREAM_RETRIES.inc("nominatim", base_url, 429)
             retry = int(r.headers.get("Retry-After", "1"))
-            time.sleep(min(retry, 3))
-            r = requests.get(base_url, params=params, headers=headers, timeout=15)
+            await asyncio.sleep(min(retry, 3))
+            r = await client.get(base_url, params=params, headers=headers, timeout=15)
         r.raise_for_status()
-        return r.json()
+        data = r.json()
+        outcome = "ok"
+        return data
+    except Exception as e:
+        outcome = _upstream_outcome(e)
+        raise
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - t0, "nominatim", base_url, outcome)
 
-    def _filter_to_lisbon(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        out = []
-        for it in items:
-            bb = it.get("boundingbox")
-            if isinstance(bb, list) and len(bb) == 4 and _bbox_overlap(bb, LISBON_BBOX):
-                out.append(it); continue
-            try:
-                lat = float(it.get("lat")); lon = float(it.get("lon"))
-                if _point_in_bbox(lat, lon, LISBON_BBOX):
-                    out.append(it)
-            except Exception:
-                continue
-        return out
+def _filter_to_lisbon(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    out = []
+    for it in items:
+        bb = it.get("boundingbox")
+        if isinstance(bb, list) and len(bb) == 4 and _bbox_overlap(bb, LISBON_BBOX):
+            out.append(it); continue
+        try:
+            lat = float(it.get("lat")); lon = float(it.get("lon"))
+            if _point_in_bbox(lat, lon, LISBON_BBOX):
+                out.append(it)
+        except Exception:
+            continue
+    return out
 
-    results_combined: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+# ---------- índice local de nomes (autocomplete sem acentos) ----------
+_PLACEHOLDER_NAME = re.compile(r"^\w+:\w+$")  # "osm:way", "leisure:park" (sem nome real)
 
-    try:
-        # 1) Nominatim (ancorado)
-        params1 = {
-            "q": q,
-            "format": "jsonv2",
-            "polygon_geojson": 1,
-            "addressdetails": 0,
-            "limit": 30,
-            "dedupe": 0,
-            "extratags": 0,
-            "namedetails": 0,
-            "viewbox": VIEWBOX,
-            "bounded": 1,
-            "countrycodes": "pt",
-        }
-        res1 = _run_nominatim(params1)
-        nomi1 = _filter_to_lisbon(res1)
-
-        # 1b) fallback Nominatim “q Lisboa” se vazio
-        nomi_final = nomi1
-        if not nomi_final:
-            params2 = dict(params1)
-            params2.pop("viewbox", None)
-            params2.pop("bounded", None)
-            params2["q"] = f"{q} Lisboa"
-            res2 = _run_nominatim(params2)
-            nomi_final = _filter_to_lisbon(res2)
-
-        for it in nomi_final:
-            gj = _normalize_geojson(it)
-            if not isinstance(gj, dict) or "type" not in gj:
-                continue
-            key = (str(it.get("osm_type") or ""), it.get("osm_id"))
-            if key in results_combined:
-                continue
-            it_copy = dict(it)
-            it_copy["geojson"] = gj
-            it_copy["geometry_type"] = gj.get("type")
-            results_combined[key] = {
-                "osm_id": it_copy.get("osm_id"),
-                "osm_type": it_copy.get("osm_type"),
-                "display_name": it_copy.get("display_name"),
-                "class": it_copy.get("class"),
-                "type": it_copy.get("type"),
-                "geojson": it_copy.get("geojson"),
-                "geometry_type": it_copy.get("geometry_type"),
-            }
+def _fold(text: str) -> str:
+    """Minúsculas, sem acentos e só com letras/dígitos separados por um espaço ("São  Jorge!" -> "sao jorge")."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    plain = "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+    return " ".join(re.sub(r"[\W_]+", " ", plain).split())
+
+def _trigrams(folded: str) -> set:
+    # como o pg_trgm: cada palavra com dois espaços antes e um depois
+    grams = set()
+    for word in folded.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class _NameIndex:
+    """
+    Nomes de lugares já conhecidos (osm_cache, respostas do /geocode, snapshots de categorias),
+    pesquisáveis por prefixo de palavra e por trigramas, sem acentos nem maiúsculas.
+    Limitado a max_entries (sai o mais antigo).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._feats: "OrderedDict[str, Tuple[str, int, Dict[str, Any]]]" = OrderedDict()
+        self._words: List[Tuple[str, str]] = []  # (palavra, chave), ordenado
+        self._grams: Dict[str, set] = {}
+        self._lock = Lock()
+        self.counters = {"searches": 0, "local_answers": 0, "evictions": 0}
+
+    def _unlink(self, key: str, folded: str) -> None:
+        for word in set(folded.split()):
+            i = bisect.bisect_left(self._words, (word, key))
+            if i < len(self._words) and self._words[i] == (word, key):
+                del self._words[i]
+        for g in _trigrams(folded):
+            keys = self._grams.get(g)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[g]
 
-        # 2) Overpass (fallback enriquecedor)
-        if not results_combined or len(results_combined) < 10:
-            ql = _build_overpass_name_query(q)
-            cache_key = f"geocode_overpass|{q}"
-            cached = _cache_get(cache_key)
-            data = cached if cached is not None else _overpass_request(ql)
-            if cached is None:
-                _cache_set(cache_key, data)
-            elements = data.get("elements", [])
-            feats = _elements_to_features_any(elements)
+    def add_many(self, feats: List[Dict[str, Any]]) -> None:
+        # lotes grandes: as palavras novas entram no fim e ordena-se uma vez (merge de dois runs)
+        pending: Optional[List[Tuple[str, str]]] = [] if len(feats) > 64 else None
+        with self._lock:
             for f in feats:
-                key = (str(f.get("osm_type") or ""), f.get("osm_id"))
-                if key not in results_combined:
-                    results_combined[key] = f
+                gj = f.get("geojson")
+                name = (f.get("display_name") or "").split(",")[0].strip()
+                if not isinstance(gj, dict) or not name or _PLACEHOLDER_NAME.match(name):
+                    continue
+                folded = _fold(name)
+                if not folded:
+                    continue
+                key = f"{f.get('osm_type') or ''}/{f.get('osm_id')}"
+                old = self._feats.pop(key, None)
+                if old is not None:
+                    self._unlink(key, old[0])
+                grams = _trigrams(folded)
+                self._feats[key] = (folded, len(grams), {
+                    "osm_id": f.get("osm_id"),
+                    "osm_type": f.get("osm_type"),
+                    "display_name": f.get("display_name"),
+                    "class": f.get("class"),
+                    "type": f.get("type"),
+                    "geojson": gj,
+                    "geometry_type": gj.get("type"),
+                })
+                for word in set(folded.split()):
+                    if pending is None:
+                        bisect.insort(self._words, (word, key))
+                    else:
+                        pending.append((word, key))
+                for g in grams:
+                    self._grams.setdefault(g, set()).add(key)
+                while len(self._feats) > self.max_entries:
+                    old_key, (old_folded, _, _) = self._feats.popitem(last=False)
+                    self._unlink(old_key, old_folded)
+                    self.counters["evictions"] += 1
+            if pending:
+                # descarta o que o próprio lote substituiu ou expulsou
+                live = {(w, k) for w, k in pending if k in self._feats and w in self._feats[k][0].split()}
+                self._words.extend(live)
+                self._words.sort()
 
-        return {"results": list(results_combined.values())[:40]}
+    def _word_range(self, prefix: str) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self._words, (prefix, ""))
+        hi = bisect.bisect_left(self._words, (prefix + "\uffff", ""))
+        return lo, hi
 
-    except requests.exceptions.Timeout:
-        return {"results": [], "error": "Tempo de espera excedido (timeout) ao consultar Nominatim/Overpass."}
-    except requests.exceptions.HTTPError as e:
-        status = getattr(e.response, "status_code", None)
-        msg = f"Erro HTTP {status} em Nominatim/Overpass." if status else "Erro HTTP em Nominatim/Overpass."
-        return {"results": [], "error": msg}
-    except Exception as e:
-        return {"results": [], "error": f"Erro de rede: {str(e)}"}
+    def search(self, q: str, limit: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Devolve (resultados, quantos são exatos/por prefixo); os restantes são aproximados (trigramas)."""
+        qf = _fold(q)
+        if not qf:
+            return [], 0
+        q_words = qf.split()
+        ranked: List[Tuple[float, int, str, Dict[str, Any]]] = []
+        with self._lock:
+            self.counters["searches"] += 1
+            # 1) prefixo: percorre só a palavra da pesquisa com menos ocorrências, verifica as outras
+            ranges = sorted((self._word_range(w) for w in set(q_words)), key=lambda r: r[1] - r[0])
+            lo, hi = ranges[0]
+            seen = set()
+            for _, key in self._words[lo:hi]:
+                if key in seen:
+                    continue
+                seen.add(key)
+                folded, _, feat = self._feats[key]
+                if folded == qf:
+                    tier = 3
+                elif folded.startswith(qf):
+                    tier = 2
+                elif len(q_words) == 1 or all(any(w.startswith(qw) for w in folded.split()) for qw in q_words):
+                    tier = 1
+                else:
+                    continue
+                ranked.append((-tier, len(folded), key, feat))
+            n_prefix = len(ranked)
+
+            # 2) aproximado (erros de escrita): trigramas pouco frequentes, só se o prefixo não chegou
+            if len(ranked) < limit:
+                q_grams = _trigrams(qf)
+                counts: Dict[str, int] = {}
+                for g in q_grams:
+                    keys = self._grams.get(g, ())
+                    if len(keys) > NAME_INDEX_MAX_POSTING:
+                        continue  # trigramas tipo "rua": não distinguem nada
+                    for key in keys:
+                        if key not in seen:
+                            counts[key] = counts.get(key, 0) + 1
+                best = heapq.nlargest(NAME_INDEX_MAX_POSTING // 10 or 1, counts.items(), key=lambda kv: kv[1])
+                for key, _ in best:
+                    folded, n_grams, feat = self._feats[key]
+                    common = len(q_grams & _trigrams(folded))
+                    sim = common / float(len(q_grams) + n_grams - common or 1)
+                    if sim >= NAME_INDEX_MIN_SIMILARITY:
+                        ranked.append((-sim, len(folded), key, feat))
+        return [feat for _, _, _, feat in heapq.nsmallest(limit, ranked, key=lambda r: r[:3])], min(n_prefix, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._feats), "max_entries": self.max_entries, **self.counters}
+
+NAME_INDEX = _NameIndex(NAME_INDEX_MAX)
+
+class _FeatureRegistry:
+    """LRU osm_id -> feature (só Polygon/MultiPolygon) com o que já foi enviado aos clientes."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._feats: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._lock = Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def add_many(self, feats: List[Dict[str, Any]]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for f in feats:
+                gj = f.get("geojson")
+                if not isinstance(gj, dict) or gj.get("type") not in ("Polygon", "MultiPolygon"):
+                    continue
+                try:
+                    osm_id = int(f.get("osm_id"))
+                except (TypeError, ValueError):
+                    continue
+                self._feats[osm_id] = f
+                self._feats.move_to_end(osm_id)
+            while len(self._feats) > self.max_entries:
+                self._feats.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def get(self, osm_id: int, osm_type: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            f = self._feats.get(osm_id)
+            if f is not None and osm_type and f.get("osm_type") and f.get("osm_type") != osm_type:
+                f = None  # way e relation com o mesmo número
+            self.counters["hits" if f is not None else "misses"] += 1
+            return f
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._feats), "max_entries": self.max_entries, **self.counters}
+
+FEATURE_REGISTRY = _FeatureRegistry(FEATURE_REGISTRY_MAX)
+
+def _load_name_index(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT osm_id, osm_type, label, class, type, geojson FROM (
+                SELECT osm_id, osm_type, COALESCE(NULLIF(display_name, ''), name) AS label,
+                       class, type, geojson, updated_at
+                FROM public.osm_cache
+                WHERE geojson IS NOT NULL
+                ORDER BY updated_at DESC NULLS LAST
+                LIMIT %s
+            ) recent
+            ORDER BY updated_at ASC NULLS FIRST  -- os mais recentes ficam no fim do LRU
+            """,
+            (NAME_INDEX_MAX,),
+        )
+        rows = cur.fetchall()
+    feats = [
+        {"osm_id": r[0], "osm_type": r[1], "display_name": r[2], "class": r[3], "type": r[4],
+         "geojson": r[5] if isinstance(r[5], dict) else json.loads(r[5])}
+        for r in rows
+    ]
+    for i in range(0, len(feats), 2000):  # aos bocados, para não prender o lock das pesquisas
+        NAME_INDEX.add_many(feats[i:i + 2000])
+
+@app.on_event("startup")
+async def _preload_name_index():
+    if DATABASE_URL and NAME_INDEX_MAX > 0:
+        try:
+            await run_db(_load_name_index)
+        except Exception as e:
+            print(f"[names] falha a carregar osm_cache: {e!r}")
+
+async def _geocode_nominatim_leg(q: str) -> List[Dict[str, Any]]:
+    # 1) Nominatim (ancorado)
+    params1 = {
+        "q": q,
+        "format": "jsonv2",
+        "polygon_geojson": 1,
+        "addressdetails": 0,
+        "limit": 30,
+        "dedupe": 0,
+        "extratags": 0,
+        "namedetails": 0,
+        "viewbox": VIEWBOX,
+        "bounded": 1,
+        "countrycodes": "pt",
+    }
+    res1 = await _run_nominatim(params1)
+    nomi = _filter_to_lisbon(res1)
+
+    # 1b) fallback Nominatim “q Lisboa” se vazio
+    if not nomi:
+        params2 = dict(params1)
+        params2.pop("viewbox", None)
+        params2.pop("bounded", None)
+        params2["q"] = f"{q} Lisboa"
+        res2 = await _run_nominatim(params2)
+        nomi = _filter_to_lisbon(res2)
+    return nomi
+
+async def _geocode_overpass_leg(q: str) -> List[Dict[str, Any]]:
+    # 2) Overpass (enriquecedor); em cache ficam os features já convertidos, não o JSON do Overpass
+    cache_key = f"geocode_overpass_feats|{q}"
+    cached = await _cache_get(cache_key)
+    if cached is not None:
+        return cached["features"]
+    feats = _dedupe_features_any(await _overpass_request(_build_overpass_name_query(q), _element_to_feature_any))
+    await _cache_set(cache_key, {"features": feats})
+    return feats
+
+def _geocode_error(exc: BaseException) -> str:
+    if isinstance(exc, httpx.TimeoutException):
+        return "Tempo de espera excedido (timeout) ao consultar Nominatim/Overpass."
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = getattr(exc.response, "status_code", None)
+        return f"Erro HTTP {status} em Nominatim/Overpass." if status else "Erro HTTP em Nominatim/Overpass."
+    return f"Erro de rede: {str(exc)}"
+
+def _geocode_cache_key(q: str) -> str:
+    # "Alfama", " alfama " e "ALFAMA" partilham a mesma entrada
+    return f"geocode|{_fold(q)}"
+
+def _geocode_from_longer_query(q: str) -> Optional[Dict[str, Any]]:
+    """
+    Reaproveita a resposta em cache de uma pesquisa mais longa que começa por q
+    ("alfa" -> "alfama"), ficando só com os resultados cujo nome ainda corresponde a q.
+    """
+    qf = _fold(q)
+    if not qf or GEOCODE_PREFIX_MIN_RESULTS <= 0:
+        return None
+    q_words = qf.split()
+    own_key = _geocode_cache_key(q)
+    longer = sorted((k for k in OVERPASS_CACHE.keys_with_prefix(own_key) if k != own_key), key=len)
+    for key in longer[:5]:
+        hit = OVERPASS_CACHE.get(key)
+        if not hit or hit.get("error"):
+            continue
+        matches = []
+        for f in hit.get("results") or []:
+            words = _fold(f.get("display_name") or "").split()
+            if all(any(w.startswith(qw) for w in words) for qw in q_words):
+                matches.append(f)
+        if len(matches) >= GEOCODE_PREFIX_MIN_RESULTS:
+            return {"results": matches}
+    return None
+
+async def _geocode_reply(request: Request, out: Dict[str, Any], zoom: Optional[int]) -> Any:
+    # só respostas completas e não vazias vão para a cache de bytes (as negativas têm TTL curto)
+    if zoom is not None and out.get("results"):
+        out = {**out, "results": await _to_thread(_simplify_features, out["results"], zoom, phase="conversion")}
+    cacheable = bool(out.get("results")) and "partial" not in out and "error" not in out
+    return await _fast_response(request, out, cache=cacheable)
+
+def _keep_in_background(task: "asyncio.Task[Any]") -> None:
+    # deixa a task terminar (e aquecer a cache) sem avisos de exceção não lida
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(lambda t: (_BACKGROUND_TASKS.discard(t), t.cancelled() or t.exception()))
+
+@app.get("/geocode")
+async def geocode(request: Request, q: str = Query(..., min_length=2), zoom: Optional[int] = Query(None, ge=0, le=22)):
+    """
+    Busca combinada. Se o índice local de nomes já tiver NAME_INDEX_MIN_RESULTS resultados exatos ou por
+    prefixo, responde só com ele; caso contrário, o que houver localmente junta-se às duas fontes,
+    consultadas em paralelo e com um prazo global (GEOCODE_DEADLINE_S):
+      1) Nominatim ancorado em Lisboa (+ fallback "q Lisboa"), aceitando Point/Line/Polygon.
+      2) Overpass por nome dentro da área administrativa de Lisboa (enriquecedor).
+    Junta, remove duplicados e devolve geometry_type para a UI. Se alguma fonte não respondeu
+    a tempo (ou falhou), devolve o que houver com "partial": true.
+    """
+    cached = await _cached_response(request)
+    if cached is not None:
+        return cached
+    cache_key = _geocode_cache_key(q)
+    hit = await _cache_get(cache_key)
+    if hit is not None:
+        return await _geocode_reply(request, hit, zoom)
+    local, n_prefix = NAME_INDEX.search(q, 40) if NAME_INDEX_MIN_RESULTS > 0 else ([], 0)
+    if local and n_prefix >= NAME_INDEX_MIN_RESULTS:
+        # os aproximados (trigramas) não contam: "parecido" não garante que o lugar pedido já esteja no índice
+        NAME_INDEX.counters["local_answers"] += 1
+        return await _geocode_reply(request, {"results": local}, zoom)
+    reused = await _cache_call(_geocode_from_longer_query, q)
+    if reused is not None:
+        return await _geocode_reply(request, reused, zoom)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GEOCODE_DEADLINE_S
+    nomi_task = asyncio.ensure_future(_geocode_nominatim_leg(q))
+    over_task = asyncio.ensure_future(_geocode_overpass_leg(q))
+    nomi_items: Optional[List[Dict[str, Any]]] = None
+    over_feats: Optional[List[Dict[str, Any]]] = None
+    errors: List[BaseException] = []
+
+    pending = {nomi_task, over_task}
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for t in done:
+            if t.exception() is not None:
+                errors.append(t.exception())
+            elif t is nomi_task:
+                nomi_items = t.result()
+            else:
+                over_feats = t.result()
+        # o Overpass só enriquece: com >= 10 resultados do Nominatim já não se espera por ele
+        if nomi_items is not None and len(nomi_items) >= 10 and over_task in pending:
+            pending.discard(over_task)
+            _keep_in_background(over_task)
+    for t in pending:
+        _keep_in_background(t)
+
+    if nomi_items is None and over_feats is None and errors:
+        if local:
+            # fontes em baixo: fica o que o índice local tem, sem guardar em cache
+            return await _geocode_reply(request, {"results": local, "partial": True}, zoom)
+        out_err = {"results": [], "error": _geocode_error(errors[0])}
+        await _cache_set(cache_key, out_err, GEOCODE_NEGATIVE_TTL_S)
+        return await _geocode_reply(request, out_err, zoom)
+
+    results_combined: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+    for it in nomi_items or []:
+        gj = _normalize_geojson(it)
+        if not isinstance(gj, dict) or "type" not in gj:
+            continue
+        key = (str(it.get("osm_type") or ""), it.get("osm_id"))
+        if key in results_combined:
+            continue
+        results_combined[key] = {
+            "osm_id": it.get("osm_id"),
+            "osm_type": it.get("osm_type"),
+            "display_name": it.get("display_name"),
+            "class": it.get("class"),
+            "type": it.get("type"),
+            "geojson": gj,
+            "geometry_type": gj.get("type"),
+        }
+    for f in local:
+        results_combined.setdefault((str(f.get("osm_type") or ""), f.get("osm_id")), f)
+    if len(results_combined) < 10:
+        for f in over_feats or []:
+            key = (str(f.get("osm_type") or ""), f.get("osm_id"))
+            if key not in results_combined:
+                results_combined[key] = f
+
+    results = list(results_combined.values())[:40]
+    NAME_INDEX.add_many(results)
+    FEATURE_REGISTRY.add_many(results)
+    out: Dict[str, Any] = {"results": results}
+    if nomi_items is None or (over_feats is None and len(results_combined) < 10):
+        out["partial"] = True
+    else:
+        await _cache_set(cache_key, out, GEOCODE_CACHE_TTL_S if results else GEOCODE_NEGATIVE_TTL_S)
+    return await _geocode_reply(request, out, zoom)
 
 # ===================== CATEGORIAS (Overpass) ===============================
 CATEGORIES: Dict[str, Dict[str, Any]] = {
@@ -581,97 +2428,441 @@ def _build_overpass_ql(filters: List[Tuple[str, str]], bbox: Tuple[float, float,
                 sel_way = f'way["{key}"]({south},{west},{north},{east})(area.searchArea);'
                 sel_rel = f'relation["{key}"]({south},{west},{north},{east})(area.searchArea);'
             else:
-                sel_way = f'way["{key}"="{val}"]({south},{west},{north},{east})(area.searchArea);'
-                sel_rel = f'relation["{key}"="{val}"]({south},{west},{north},{east})(area.searchArea);'
-        selectors.append(sel_way)
-        selectors.append(sel_rel)
-    union = "\n  ".join(selectors)
-    ql = f"""
-[out:json][timeout:45];
-area["name"="Lisboa"]["boundary"="administrative"]["admin_level"~"^(7|8)$"]->.searchArea;
-(
-  {union}
-);
-out tags geom;
-"""
-    return ql.strip()
+                sel_way = f'way["{key}"="{val}"]({south},{west},{north},{east})(area.searchArea);'
+                sel_rel = f'relation["{key}"="{val}"]({south},{west},{north},{east})(area.searchArea);'
+        selectors.append(sel_way)
+        selectors.append(sel_rel)
+    union = "\n  ".join(selectors)
+    ql = f"""
+[out:json][timeout:45];
+area["name"="Lisboa"]["boundary"="administrative"]["admin_level"~"^(7|8)$"]->.searchArea;
+(
+  {union}
+);
+out tags geom;
+"""
+    return ql.strip()
+
+def _coords_to_polygon(coords: List[Dict[str, float]]) -> Optional[List[List[float]]]:
+    if not coords or len(coords) < 4:
+        return None
+    ring = [[pt["lon"], pt["lat"]] for pt in coords]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    if len(ring) < 4:
+        return None
+    return ring
+
+def _element_to_feature(el: Dict[str, Any], primary_keys: List[str]) -> Optional[Dict[str, Any]]:
+    t = el.get("type")
+    if t not in ("way", "relation"):
+        return None
+
+    tags = el.get("tags", {}) or {}
+    cls, typ = None, None
+    for k in primary_keys:
+        if k in tags:
+            cls, typ = k, tags.get(k)
+            break
+    if cls is None:
+        for k in ["building", "amenity", "leisure", "tourism", "historic", "landuse", "place"]:
+            if k in tags:
+                cls, typ = k, tags.get(k)
+                break
+
+    display = tags.get("name") or f"{(cls or 'osm')}:{(typ or 'feature')}"
+    osm_id = el.get("id")
+
+    gj = None
+    if t == "way":
+        geom = el.get("geometry")
+        ring = _coords_to_polygon(geom) if isinstance(geom, list) else None
+        if ring:
+            gj = {"type": "Polygon", "coordinates": [ring]}
+    elif t == "relation":
+        geom = el.get("geometry")
+        if isinstance(geom, list):
+            ring = _coords_to_polygon(geom)
+            if ring:
+                gj = {"type": "Polygon", "coordinates": [ring]}
+        if gj is None:
+            members = el.get("members") or []
+            polys = []
+            for m in members:
+                mg = m.get("geometry")
+                if isinstance(mg, list):
+                    ring = _coords_to_polygon(mg)
+                    if ring:
+                        polys.append(ring)
+            if polys:
+                gj = {"type": "MultiPolygon", "coordinates": [[ring] for ring in polys]}
+
+    if gj is None:
+        return None
+    return {
+        "osm_id": int(osm_id) if isinstance(osm_id, int) else osm_id,
+        "osm_type": t,
+        "display_name": display,
+        "class": cls,
+        "type": typ,
+        "geojson": gj,
+    }
+
+def _element_to_category_pair(el: Dict[str, Any], primary_keys: List[str]) -> Optional[Tuple[Dict[str, Any], Tuple[float, float, float, float]]]:
+    # conversão usada na leitura em streaming: feature + bbox, calculados fora do event loop
+    feat = _element_to_feature(el, primary_keys)
+    if feat is None:
+        return None
+    bb = _geojson_bbox(feat["geojson"])
+    return (feat, bb) if bb is not None else None
+
+# ---------- tiles de categoria (cache quantizado) ----------
+def _geojson_bbox(gj: Dict[str, Any]) -> Optional[Tuple[float, float, float, float]]:
+    # desce até às listas de posições e tira min/max por coluna com zip (em C), não vértice a vértice
+    boxes: List[Tuple[float, float, float, float]] = []
+    stack = [gj.get("coordinates")]
+    while stack:
+        c = stack.pop()
+        if not isinstance(c, list) or not c:
+            continue
+        first = c[0]
+        if isinstance(first, (int, float)):
+            boxes.append((c[0], c[1], c[0], c[1]))
+            continue
+        if isinstance(first, list) and first and isinstance(first[0], (int, float)):
+            try:
+                cols = tuple(zip(*c))
+                boxes.append((min(cols[0]), min(cols[1]), max(cols[0]), max(cols[1])))
+                continue
+            except (TypeError, IndexError):
+                pass  # posições malformadas: segue ponto a ponto
+        stack.extend(c)
+    if not boxes:
+        return None
+    if len(boxes) == 1:
+        return boxes[0]
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def _bbox_intersects(a: Tuple[float, float, float, float], b: Tuple[float, float, float, float]) -> bool:
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+def _clip_to_lisbon(bbox: Tuple[float, float, float, float]) -> Optional[Tuple[float, float, float, float]]:
+    minx = max(bbox[0], LISBON_BBOX[0]); miny = max(bbox[1], LISBON_BBOX[1])
+    maxx = min(bbox[2], LISBON_BBOX[2]); maxy = min(bbox[3], LISBON_BBOX[3])
+    if minx > maxx or miny > maxy:
+        return None
+    return (minx, miny, maxx, maxy)
+
+def _tiles_for_bbox(bbox: Tuple[float, float, float, float]) -> List[Tuple[int, int]]:
+    minx, miny, maxx, maxy = bbox
+    x0 = math.floor(minx / CATEGORY_TILE_DEG); x1 = max(x0, math.ceil(maxx / CATEGORY_TILE_DEG) - 1)
+    y0 = math.floor(miny / CATEGORY_TILE_DEG); y1 = max(y0, math.ceil(maxy / CATEGORY_TILE_DEG) - 1)
+    return [(ix, iy) for iy in range(y0, y1 + 1) for ix in range(x0, x1 + 1)]
+
+def _tile_bbox(tile: Tuple[int, int]) -> Tuple[float, float, float, float]:
+    ix, iy = tile
+    return (ix * CATEGORY_TILE_DEG, iy * CATEGORY_TILE_DEG, (ix + 1) * CATEGORY_TILE_DEG, (iy + 1) * CATEGORY_TILE_DEG)
+
+def _dedupe_pairs(pairs: List[Tuple[Dict[str, Any], Any]]) -> List[Tuple[Dict[str, Any], Any]]:
+    # o mesmo osm_id pode vir repetido na resposta: fica o primeiro
+    by_id: Dict[Any, Tuple[Dict[str, Any], Any]] = {}
+    for f, bb in pairs:
+        by_id.setdefault(f["osm_id"], (f, bb))
+    return list(by_id.values())
+
+def _tile_cache_key(code: str, tile: Tuple[int, int]) -> str:
+    return f"cat_tile|{code}|{CATEGORY_TILE_DEG}|{tile[0]}|{tile[1]}"
+
+async def _category_tiles(
+    code: str, conf: Dict[str, Any], tiles: List[Tuple[int, int]],
+    on_batch: Optional[Callable[[List[Any]], None]] = None,
+) -> Dict[Tuple[int, int], Dict[str, Any]]:
+    """
+    Devolve {tile: {"features": [...], "bboxes": [...]}} para os tiles pedidos.
+    Os tiles em falta são obtidos numa única query Overpass sobre o retângulo que os cobre;
+    todos os tiles desse retângulo ficam em cache (um feature que cruza tiles entra em cada um).
+    on_batch recebe os pares (feature, bbox) à medida que o Overpass os vai enviando.
+    """
+    out: Dict[Tuple[int, int], Dict[str, Any]] = {}
+    missing: List[Tuple[int, int]] = []
+    for t, cached in zip(tiles, await _cache_get_many([_tile_cache_key(code, t) for t in tiles])):
+        if cached is None:
+            missing.append(t)
+        else:
+            out[t] = cached
+    if not missing:
+        return out
+
+    xs = [t[0] for t in missing]; ys = [t[1] for t in missing]
+    cover_tiles = [(ix, iy) for iy in range(min(ys), max(ys) + 1) for ix in range(min(xs), max(xs) + 1)]
+    cover = (
+        min(xs) * CATEGORY_TILE_DEG, min(ys) * CATEGORY_TILE_DEG,
+        (max(xs) + 1) * CATEGORY_TILE_DEG, (max(ys) + 1) * CATEGORY_TILE_DEG,
+    )
+    ql = _build_overpass_ql(conf["filters"], cover, regex=conf["regex"])
+    pairs = await _overpass_request(ql, functools.partial(_element_to_category_pair, primary_keys=conf["primary_keys"]), on_batch)
+    boxed = list(_dedupe_pairs(pairs))
+
+    entries: List[Tuple[str, Dict[str, Any]]] = []
+    for t in cover_tiles:
+        tb = _tile_bbox(t)
+        inside = [(f, bb) for f, bb in boxed if _bbox_intersects(bb, tb)]
+        entry = {"features": [f for f, _ in inside], "bboxes": [list(bb) for _, bb in inside]}
+        entries.append((_tile_cache_key(code, t), entry))
+        if t in missing:
+            out[t] = entry
+    await _cache_set_many(entries)
+    return out
+
+# ---------- snapshot Lisboa-inteira + índice espacial ----------
+class _GridIndex:
+    """Índice espacial em grelha uniforme sobre os bboxes dos features de uma categoria."""
+
+    def __init__(self, feats: List[Dict[str, Any]], cell_deg: float = SNAPSHOT_GRID_DEG):
+        self.cell = cell_deg
+        self.features: List[Dict[str, Any]] = []
+        self.bboxes: List[Tuple[float, float, float, float]] = []
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        for f in feats:
+            bb = _geojson_bbox(f.get("geojson") or {})
+            if bb is None:
+                continue
+            i = len(self.features)
+            self.features.append(f)
+            self.bboxes.append(bb)
+            for c in self._cells_for(bb):
+                self.cells.setdefault(c, []).append(i)
+
+    def _cells_for(self, bb: Tuple[float, float, float, float]) -> List[Tuple[int, int]]:
+        x0 = math.floor(bb[0] / self.cell); x1 = math.floor(bb[2] / self.cell)
+        y0 = math.floor(bb[1] / self.cell); y1 = math.floor(bb[3] / self.cell)
+        return [(ix, iy) for iy in range(y0, y1 + 1) for ix in range(x0, x1 + 1)]
+
+    def query(self, bbox: Tuple[float, float, float, float], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        hits = set()
+        for c in self._cells_for(bbox):
+            hits.update(self.cells.get(c, ()))
+        out: List[Dict[str, Any]] = []
+        for i in sorted(hits):  # ordem estável = ordem do snapshot
+            if _bbox_intersects(self.bboxes[i], bbox):
+                out.append(self.features[i])
+                if limit and len(out) >= int(limit):
+                    break
+        return out
+
+_SNAPSHOTS: Dict[str, _GridIndex] = {}
+_SNAPSHOT_META: Dict[str, float] = {}
+
+async def _fetch_category_snapshot(code: str) -> List[Dict[str, Any]]:
+    conf = CATEGORIES[code]
+    ql = _build_overpass_ql(conf["filters"], LISBON_BBOX, regex=conf["regex"])
+    pairs = await _overpass_request(ql, functools.partial(_element_to_category_pair, primary_keys=conf["primary_keys"]))
+    return [f for f, _ in _dedupe_pairs(pairs)]
+
+def _load_snapshot_file() -> float:
+    """Carrega o snapshot gravado (se existir). Devolve o instante de criação ou 0."""
+    if not CATEGORY_SNAPSHOT_PATH or not os.path.exists(CATEGORY_SNAPSHOT_PATH):
+        return 0.0
+    try:
+        with open(CATEGORY_SNAPSHOT_PATH, "r", encoding="utf-8") as fh:
+            snap = json.load(fh)
+        for code, feats in (snap.get("categories") or {}).items():
+            if code in CATEGORIES:
+                _SNAPSHOTS[code] = _GridIndex(feats)
+                NAME_INDEX.add_many(feats)
+                _SNAPSHOT_META[code] = float(snap.get("created_at") or 0.0)
+        return float(snap.get("created_at") or 0.0)
+    except Exception as e:
+        print(f"[snapshot] falha a ler {CATEGORY_SNAPSHOT_PATH}: {e!r}")
+        return 0.0
+
+def _save_snapshot_file(snap: Dict[str, List[Dict[str, Any]]]) -> None:
+    if not CATEGORY_SNAPSHOT_PATH:
+        return
+    tmp = f"{CATEGORY_SNAPSHOT_PATH}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"created_at": time.time(), "categories": snap}, fh, ensure_ascii=False)
+    os.replace(tmp, CATEGORY_SNAPSHOT_PATH)
+
+async def _refresh_snapshots() -> None:
+    # categoria a categoria: cada índice é trocado atomicamente, o anterior serve até lá
+    fresh: Dict[str, List[Dict[str, Any]]] = {}
+    for code in CATEGORIES:
+        try:
+            feats = await _fetch_category_snapshot(code)
+        except Exception as e:
+            print(f"[snapshot] falha em {code}: {e!r}")
+            continue
+        _SNAPSHOTS[code] = await asyncio.to_thread(_GridIndex, feats)
+        await asyncio.to_thread(NAME_INDEX.add_many, feats)
+        _SNAPSHOT_META[code] = time.time()
+        fresh[code] = feats
+    if len(fresh) == len(CATEGORIES):
+        try:
+            await asyncio.to_thread(_save_snapshot_file, fresh)
+        except Exception as e:
+            print(f"[snapshot] falha a gravar {CATEGORY_SNAPSHOT_PATH}: {e!r}")
+
+async def _snapshot_worker() -> None:
+    created = await asyncio.to_thread(_load_snapshot_file)
+    wait = max(0.0, created + CATEGORY_SNAPSHOT_REFRESH_S - time.time()) if len(_SNAPSHOTS) == len(CATEGORIES) else 0.0
+    while True:
+        await asyncio.sleep(wait)
+        await _refresh_snapshots()
+        complete = len(_SNAPSHOTS) == len(CATEGORIES)
+        wait = CATEGORY_SNAPSHOT_REFRESH_S if complete else min(300, CATEGORY_SNAPSHOT_REFRESH_S)
+
+@app.on_event("startup")
+async def _start_snapshot_worker():
+    if CATEGORY_SNAPSHOT:
+        _keep_in_background(asyncio.create_task(_snapshot_worker()))
+
+# ---------- simplificação por zoom + quantização de coordenadas ----------
+def _zoom_deg_per_px(zoom: int) -> float:
+    return 360.0 / (256 * (2 ** zoom))
+
+def _zoom_decimals(zoom: int) -> int:
+    # casas decimais suficientes para ~1 píxel nesse zoom
+    return max(0, min(7, math.ceil(-math.log10(_zoom_deg_per_px(zoom)))))
+
+def _douglas_peucker(pts: List[List[float]], tol: float) -> List[List[float]]:
+    if len(pts) < 3:
+        return list(pts)
+    keep = [False] * len(pts)
+    keep[0] = keep[-1] = True
+    tol2 = tol * tol
+    stack = [(0, len(pts) - 1)]
+    while stack:
+        i0, i1 = stack.pop()
+        x0, y0 = pts[i0][0], pts[i0][1]
+        x1, y1 = pts[i1][0], pts[i1][1]
+        dx, dy = x1 - x0, y1 - y0
+        seg2 = dx * dx + dy * dy
+        best, best_d = -1, tol2
+        for i in range(i0 + 1, i1):
+            px, py = pts[i][0] - x0, pts[i][1] - y0
+            if seg2 == 0:
+                d = px * px + py * py
+            else:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / seg2))
+                ex, ey = px - t * dx, py - t * dy
+                d = ex * ex + ey * ey
+            if d > best_d:
+                best, best_d = i, d
+        if best >= 0:
+            keep[best] = True
+            stack.append((i0, best))
+            stack.append((best, i1))
+    return [p for p, k in zip(pts, keep) if k]
 
-def _elements_to_features(elements: List[Dict[str, Any]], primary_keys: List[str], limit: Optional[int]) -> List[Dict[str, Any]]:
-    feats: List[Dict[str, Any]] = []
-    seen = set()
+def _segments_cross(a, b, c, d) -> bool:
+    def orient(p, q, r):
+        v = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (v > 0) - (v < 0)
+    o1, o2, o3, o4 = orient(a, b, c), orient(a, b, d), orient(c, d, a), orient(c, d, b)
+    return o1 != o2 and o3 != o4 and 0 not in (o1, o2, o3, o4)
 
-    def _coords_to_polygon(coords: List[Dict[str, float]]) -> Optional[List[List[float]]]:
-        if not coords or len(coords) < 4:
-            return None
-        ring = [[pt["lon"], pt["lat"]] for pt in coords]
-        if ring[0] != ring[-1]:
-            ring.append(ring[0])
-        if len(ring) < 4:
+def _ring_self_intersects(ring: List[List[float]]) -> bool:
+    n = len(ring) - 1
+    for i in range(n):
+        for j in range(i + 2, n):
+            if i == 0 and j == n - 1:
+                continue  # segmentos adjacentes pelo fecho do anel
+            if _segments_cross(ring[i], ring[i + 1], ring[j], ring[j + 1]):
+                return True
+    return False
+
+def _quantize(pts: List[List[float]], decimals: int) -> List[List[float]]:
+    out: List[List[float]] = []
+    for p in pts:
+        q = [round(p[0], decimals), round(p[1], decimals)]
+        if not out or out[-1] != q:
+            out.append(q)
+    return out
+
+def _simplify_ring(ring: List[List[float]], tol: float, decimals: int) -> Optional[List[List[float]]]:
+    """
+    Douglas-Peucker num anel fechado, mantendo-o válido: se colapsar (< 4 pontos) devolve None;
+    se passar a auto-intersetar-se, repete com metade da tolerância (até 3 vezes) e, em último caso,
+    fica só com a quantização.
+    """
+    t = tol
+    for _ in range(4):
+        out = _quantize(_douglas_peucker(ring, t), decimals)
+        if out and out[0] != out[-1]:
+            out.append(out[0])
+        if len(out) < 4:
             return None
-        return ring
+        if len(out) > SIMPLIFY_CHECK_MAX_VERTICES or not _ring_self_intersects(out):
+            return out
+        t /= 2
+    out = _quantize(ring, decimals)
+    if out and out[0] != out[-1]:
+        out.append(out[0])
+    return out if len(out) >= 4 else None
 
-    for el in elements:
-        t = el.get("type")
-        if t not in ("way", "relation"):
-            continue
+def _simplify_geojson(gj: Dict[str, Any], zoom: int) -> Dict[str, Any]:
+    tol = SIMPLIFY_PX * _zoom_deg_per_px(zoom)
+    dec = _zoom_decimals(zoom)
+    typ = gj.get("type")
+    coords = gj.get("coordinates")
 
-        tags = el.get("tags", {}) or {}
-        cls, typ = None, None
-        for k in primary_keys:
-            if k in tags:
-                cls, typ = k, tags.get(k)
-                break
-        if cls is None:
-            for k in ["building", "amenity", "leisure", "tourism", "historic", "landuse", "place"]:
-                if k in tags:
-                    cls, typ = k, tags.get(k)
-                    break
+    def _polygon(rings):
+        out = []
+        for i, ring in enumerate(rings):
+            r = _simplify_ring(ring, tol, dec)
+            if r is None:
+                if i == 0:  # anel exterior abaixo de um píxel: mantém-se só quantizado
+                    r = _quantize(ring, dec)
+                    if r and r[0] != r[-1]:
+                        r.append(r[0])
+                    if len(r) < 4:
+                        r = ring  # a quantização colapsou-o: anel inválido, fica o original
+                else:
+                    continue  # buraco invisível neste zoom
+            out.append(r)
+        return out
 
-        display = tags.get("name") or f"{(cls or 'osm')}:{(typ or 'feature')}"
-        osm_id = el.get("id")
-        if osm_id in seen:
-            continue
+    def _line(line):
+        out = _quantize(_douglas_peucker(line, tol), dec)
+        return out if len(out) >= 2 else _quantize(line, dec)[:2] or out
 
-        gj = None
-        if t == "way":
-            geom = el.get("geometry")
-            ring = _coords_to_polygon(geom) if isinstance(geom, list) else None
-            if ring:
-                gj = {"type": "Polygon", "coordinates": [ring]}
-        elif t == "relation":
-            geom = el.get("geometry")
-            if isinstance(geom, list):
-                ring = _coords_to_polygon(geom)
-                if ring:
-                    gj = {"type": "Polygon", "coordinates": [ring]}
-            if gj is None:
-                members = el.get("members") or []
-                polys = []
-                for m in members:
-                    mg = m.get("geometry")
-                    if isinstance(mg, list):
-                        ring = _coords_to_polygon(mg)
-                        if ring:
-                            polys.append(ring)
-                if polys:
-                    gj = {"type": "MultiPolygon", "coordinates": [[ring] for ring in polys]}
+    if typ == "Point":
+        return {"type": typ, "coordinates": [round(coords[0], dec), round(coords[1], dec)]}
+    if typ == "Polygon":
+        return {"type": typ, "coordinates": _polygon(coords)}
+    if typ == "MultiPolygon":
+        return {"type": typ, "coordinates": [_polygon(p) for p in coords]}
+    if typ == "LineString":
+        return {"type": typ, "coordinates": _line(coords)}
+    if typ == "MultiLineString":
+        return {"type": typ, "coordinates": [_line(l) for l in coords]}
+    return gj
 
-        if gj is None:
-            continue
+SIMPLIFIED_CACHE = _MemoryCache(SIMPLIFY_CACHE_MAX)
 
-        seen.add(osm_id)
-        feat = {
-            "osm_id": int(osm_id) if isinstance(osm_id, int) else osm_id,
-            "osm_type": t,
-            "display_name": display,
-            "class": cls,
-            "type": typ,
-            "geojson": gj,
-        }
-        feats.append(feat)
-        if limit and len(feats) >= int(limit):
-            break
-    return feats
+def _simplify_features(feats: List[Dict[str, Any]], zoom: Optional[int]) -> List[Dict[str, Any]]:
+    """Cópias dos features com geometria simplificada para o zoom; cache por (feature, geometria, zoom)."""
+    if zoom is None:
+        return feats
+    out: List[Dict[str, Any]] = []
+    for f in feats:
+        gj = f.get("geojson")
+        if not isinstance(gj, dict):
+            out.append(f)
+            continue
+        key = None
+        if f.get("osm_id") is not None:
+            # o mesmo elemento chega com geometrias diferentes (/geocode: LineString do Nominatim; /category: way fechado)
+            src = hashlib.sha1(json.dumps(gj, separators=(",", ":")).encode("utf-8")).hexdigest()[:12]
+            key = f"simpl|{f.get('osm_type')}|{f.get('osm_id')}|{src}|{zoom}"
+        simple = SIMPLIFIED_CACHE.get(key) if key else None
+        if simple is None:
+            simple = _simplify_geojson(gj, zoom)
+            if key:
+                SIMPLIFIED_CACHE.set(key, simple, SIMPLIFY_CACHE_TTL_S)
+        out.append({**f, "geojson": simple})
+    return out
 
 # ---------- ENDPOINTS: categorias ----------
 @app.get("/categories")
@@ -683,38 +2874,389 @@ def categories():
         ]
     }
 
+async def _category_feature_batches(
+    code: str, bbox_tuple: Tuple[float, float, float, float], limit: Optional[int],
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Features da categoria que intersetam o bbox, em lotes: do snapshot, se carregado; senão primeiro
+    os tiles já em cache e depois os restantes à medida que o Overpass os envia.
+    """
+    index = _SNAPSHOTS.get(code)
+    if index is not None:
+        feats = index.query(bbox_tuple, limit)
+        FEATURE_REGISTRY.add_many(feats)
+        yield feats
+        return
+    clipped = _clip_to_lisbon(bbox_tuple)
+    if clipped is None:
+        return
+    tiles = _tiles_for_bbox(clipped)
+    area = (_tile_bbox(tiles[0])[0], _tile_bbox(tiles[0])[1], _tile_bbox(tiles[-1])[2], _tile_bbox(tiles[-1])[3])
+    remaining = int(limit) if limit else None
+    seen = set()
+
+    def _take(pairs) -> List[Dict[str, Any]]:
+        # sem duplicar features que cruzam fronteiras de tiles
+        nonlocal remaining
+        out: List[Dict[str, Any]] = []
+        for f, bb in pairs:
+            if remaining is not None and remaining <= 0:
+                break
+            if f["osm_id"] in seen or not _bbox_intersects(tuple(bb), bbox_tuple) or not _bbox_intersects(tuple(bb), area):
+                continue
+            seen.add(f["osm_id"])
+            out.append(f)
+            if remaining is not None:
+                remaining -= 1
+        FEATURE_REGISTRY.add_many(out)
+        return out
+
+    missing: List[Tuple[int, int]] = []
+    for t, entry in zip(tiles, await _cache_get_many([_tile_cache_key(code, t) for t in tiles])):
+        if entry is None:
+            missing.append(t)
+            continue
+        batch = _take(zip(entry["features"], entry["bboxes"]))
+        if batch:
+            yield batch
+        if remaining == 0:
+            return
+    if not missing:
+        return
+
+    arrived: "asyncio.Queue[Optional[List[Any]]]" = asyncio.Queue()
+    task = asyncio.ensure_future(_category_tiles(code, CATEGORIES[code], missing, arrived.put_nowait))
+    task.add_done_callback(lambda _: arrived.put_nowait(None))
+    try:
+        while True:
+            pairs = await arrived.get()
+            if pairs is None:
+                break
+            batch = _take(pairs)
+            if batch:
+                yield batch
+            if remaining == 0:
+                return
+        # quem partilhou a chamada de outro pedido não recebe lotes: fica com o resultado final
+        tile_data = task.result()
+        for t in missing:
+            batch = _take(zip(tile_data[t]["features"], tile_data[t]["bboxes"]))
+            if batch:
+                yield batch
+            if remaining == 0:
+                return
+    finally:
+        _keep_in_background(task)  # se ainda não acabou, termina e guarda os tiles em cache
+
+async def _category_features(code: str, bbox_tuple: Tuple[float, float, float, float], limit: Optional[int]) -> List[Dict[str, Any]]:
+    feats: List[Dict[str, Any]] = []
+    async for batch in _category_feature_batches(code, bbox_tuple, limit):
+        feats.extend(batch)
+    return feats
+
+def _wants_ndjson(request: Request, stream: bool) -> bool:
+    return stream or "application/x-ndjson" in request.headers.get("accept", "")
+
+async def _ndjson_features(batches: AsyncIterator[List[Dict[str, Any]]], zoom: Optional[int]) -> AsyncIterator[bytes]:
+    # um feature por linha; se a fonte falhar a meio, a última linha traz o erro
+    try:
+        async for batch in batches:
+            if zoom is not None:
+                batch = await _to_thread(_simplify_features, batch, zoom, phase="conversion")
+            t0 = time.perf_counter()
+            chunk = b"".join(_dumps(f) + b"\n" for f in batch)
+            _profile_add("serialization", time.perf_counter() - t0)
+            yield chunk
+    except HTTPException as e:
+        yield _dumps({"error": e.detail}) + b"\n"
+    except Exception as e:
+        yield _dumps({"error": f"{type(e).__name__}: {str(e)}"}) + b"\n"
+
 @app.get("/category/{code}")
-def category(code: str, bbox: Optional[str] = None, limit: int = 900):
+async def category(code: str, request: Request, bbox: Optional[str] = None, limit: int = 900, zoom: Optional[int] = Query(None, ge=0, le=22), stream: bool = False):
     if code not in CATEGORIES:
         raise HTTPException(status_code=404, detail="Categoria não encontrada.")
-    conf = CATEGORIES[code]
     bbox_tuple = _parse_bbox(bbox) if bbox else LISBON_BBOX
-    ql = _build_overpass_ql(conf["filters"], bbox_tuple, regex=conf["regex"])
-    cache_key = f"cat|{code}|{bbox_tuple}|{limit}"
-    cached = _cache_get(cache_key)
-    data = cached if cached is not None else _overpass_request(ql)
-    if cached is None:
-        _cache_set(cache_key, data)
-    elements = data.get("elements", [])
-    feats = _elements_to_features(elements, conf["primary_keys"], limit=limit)
-    return {"results": feats}
+    if _wants_ndjson(request, stream):
+        # NDJSON: o mapa pode começar a desenhar antes de a resposta Overpass terminar
+        return StreamingResponse(
+            _ndjson_features(_category_feature_batches(code, bbox_tuple, limit), zoom),
+            media_type="application/x-ndjson",
+        )
+    cached = await _cached_response(request)
+    if cached is not None:
+        return cached
+    feats = await _category_features(code, bbox_tuple, limit)
+    if zoom is not None:
+        feats = await _to_thread(_simplify_features, feats, zoom, phase="conversion")
+    return await _fast_response(request, {"results": feats})
+
+# ===================== TILES VETORIAIS (MVT) ===============================
+def _tile_lonlat_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    n = 2 ** z
+    def _lat(yy: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * yy / n))))
+    return (x / n * 360.0 - 180.0, _lat(y + 1), (x + 1) / n * 360.0 - 180.0, _lat(y))
+
+def _lonlat_to_tile_px(lon: float, lat: float, z: int, x: int, y: int) -> Tuple[float, float]:
+    n = 2 ** z
+    lat_r = math.radians(max(-85.05112878, min(85.05112878, lat)))
+    fx = (lon + 180.0) / 360.0 * n
+    fy = (1.0 - math.log(math.tan(lat_r) + 1.0 / math.cos(lat_r)) / math.pi) / 2.0 * n
+    return ((fx - x) * MVT_EXTENT, (fy - y) * MVT_EXTENT)
+
+def _clip_ring(ring: List[Tuple[float, float]], lo: float, hi: float) -> List[Tuple[float, float]]:
+    # Sutherland-Hodgman contra o retângulo [lo, hi]²
+    def _clip(pts, inside, cross):
+        out = []
+        for i, cur in enumerate(pts):
+            prev = pts[i - 1]
+            if inside(cur):
+                if not inside(prev):
+                    out.append(cross(prev, cur))
+                out.append(cur)
+            elif inside(prev):
+                out.append(cross(prev, cur))
+        return out
+    def _x_at(p, q, xv):
+        t = (xv - p[0]) / (q[0] - p[0]); return (xv, p[1] + t * (q[1] - p[1]))
+    def _y_at(p, q, yv):
+        t = (yv - p[1]) / (q[1] - p[1]); return (p[0] + t * (q[0] - p[0]), yv)
+    pts = ring
+    for inside, cross in (
+        (lambda p: p[0] >= lo, lambda p, q: _x_at(p, q, lo)),
+        (lambda p: p[0] <= hi, lambda p, q: _x_at(p, q, hi)),
+        (lambda p: p[1] >= lo, lambda p, q: _y_at(p, q, lo)),
+        (lambda p: p[1] <= hi, lambda p, q: _y_at(p, q, hi)),
+    ):
+        if not pts:
+            break
+        pts = _clip(pts, inside, cross)
+    return pts
+
+def _clip_line(line: List[Tuple[float, float]], lo: float, hi: float) -> List[List[Tuple[float, float]]]:
+    # Liang-Barsky por segmento; devolve os troços dentro do retângulo
+    parts: List[List[Tuple[float, float]]] = []
+    cur: List[Tuple[float, float]] = []
+    for p, q in zip(line, line[1:]):
+        t0, t1 = 0.0, 1.0
+        dx, dy = q[0] - p[0], q[1] - p[1]
+        ok = True
+        for pk, qk in ((-dx, p[0] - lo), (dx, hi - p[0]), (-dy, p[1] - lo), (dy, hi - p[1])):
+            if pk == 0:
+                if qk < 0:
+                    ok = False; break
+                continue
+            r = qk / pk
+            if pk < 0:
+                t0 = max(t0, r)
+            else:
+                t1 = min(t1, r)
+            if t0 > t1:
+                ok = False; break
+        if not ok:
+            if cur:
+                parts.append(cur); cur = []
+            continue
+        a = (p[0] + t0 * dx, p[1] + t0 * dy)
+        b = (p[0] + t1 * dx, p[1] + t1 * dy)
+        if not cur:
+            cur = [a]
+        cur.append(b)
+        if t1 < 1.0:
+            parts.append(cur); cur = []
+    if cur:
+        parts.append(cur)
+    return parts
+
+def _int_path(pts: List[Tuple[float, float]]) -> List[Tuple[int, int]]:
+    out: List[Tuple[int, int]] = []
+    for px, py in pts:
+        q = (int(round(px)), int(round(py)))
+        if not out or out[-1] != q:
+            out.append(q)
+    return out
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 31)
+
+def _mvt_geometry(kind: int, paths: List[List[Tuple[int, int]]]) -> List[int]:
+    """Comandos MVT (MoveTo/LineTo/ClosePath) com deltas zigzag, a partir de caminhos inteiros."""
+    cmds: List[int] = []
+    cx = cy = 0
+    for path in paths:
+        if kind == 3:
+            path = path[:-1] if len(path) > 1 and path[0] == path[-1] else path
+        if not path:
+            continue
+        for i, (px, py) in enumerate(path):
+            if i == 0:
+                cmds.append((1 & 0x7) | (1 << 3))
+            elif i == 1:
+                cmds.append((2 & 0x7) | ((len(path) - 1) << 3))
+            cmds.append(_zigzag(px - cx)); cmds.append(_zigzag(py - cy))
+            cx, cy = px, py
+        if kind == 3:
+            cmds.append((7 & 0x7) | (1 << 3))
+    return cmds
+
+def _ring_area(path: List[Tuple[int, int]]) -> float:
+    return sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(path, path[1:] + path[:1])) / 2.0
+
+def _feature_to_mvt_geom(gj: Dict[str, Any], z: int, x: int, y: int) -> Optional[Tuple[int, List[int]]]:
+    lo, hi = -MVT_BUFFER, MVT_EXTENT + MVT_BUFFER
+    proj = lambda coords: [_lonlat_to_tile_px(c[0], c[1], z, x, y) for c in coords]
+    typ = gj.get("type")
+    coords = gj.get("coordinates") or []
+    if typ == "Point":
+        px, py = _lonlat_to_tile_px(coords[0], coords[1], z, x, y)
+        if not (lo <= px <= hi and lo <= py <= hi):
+            return None
+        return 1, _mvt_geometry(1, [[(int(round(px)), int(round(py)))]])
+    if typ in ("Polygon", "MultiPolygon"):
+        polys = [coords] if typ == "Polygon" else coords
+        paths: List[List[Tuple[int, int]]] = []
+        for poly in polys:
+            for i, ring in enumerate(poly):
+                path = _int_path(_clip_ring(proj(ring), lo, hi))
+                if len(path) > 1 and path[0] == path[-1]:
+                    path = path[:-1]
+                if len(path) < 3 or _ring_area(path) == 0:
+                    if i == 0:
+                        break  # sem exterior, os buracos deste polígono não contam
+                    continue
+                # exterior com área positiva (sentido horário com y para baixo), buracos negativa
+                if (_ring_area(path) > 0) != (i == 0):
+                    path.reverse()
+                paths.append(path)
+        return (3, _mvt_geometry(3, paths)) if paths else None
+    if typ in ("LineString", "MultiLineString"):
+        lines = [coords] if typ == "LineString" else coords
+        paths = []
+        for line in lines:
+            for part in _clip_line(proj(line), lo, hi):
+                path = _int_path(part)
+                if len(path) >= 2:
+                    paths.append(path)
+        return (2, _mvt_geometry(2, paths)) if paths else None
+    return None
+
+def _pb_varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def _pb_key(field: int, wire: int) -> bytes:
+    return _pb_varint((field << 3) | wire)
+
+def _pb_bytes(field: int, data: bytes) -> bytes:
+    return _pb_key(field, 2) + _pb_varint(len(data)) + data
+
+def _pb_packed(field: int, values: List[int]) -> bytes:
+    return _pb_bytes(field, b"".join(_pb_varint(v) for v in values))
+
+def _mvt_value(v: Any) -> bytes:
+    if isinstance(v, bool):
+        return _pb_key(7, 0) + _pb_varint(int(v))
+    if isinstance(v, int) and v >= 0:
+        return _pb_key(5, 0) + _pb_varint(v)
+    return _pb_bytes(1, str(v).encode("utf-8"))
+
+def _encode_mvt_layer(name: str, feats: List[Dict[str, Any]], z: int, x: int, y: int) -> bytes:
+    keys: Dict[str, int] = {}
+    values: Dict[Any, int] = {}
+    body = bytearray()
+    for f in feats:
+        gj = f.get("geojson")
+        geom = _feature_to_mvt_geom(gj, z, x, y) if isinstance(gj, dict) else None
+        if geom is None:
+            continue
+        kind, cmds = geom
+        tags: List[int] = []
+        for k in ("osm_id", "display_name", "class", "type"):
+            v = f.get(k)
+            if v is None:
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v).__name__, v), len(values)))
+        feat = bytearray()
+        if isinstance(f.get("osm_id"), int) and f["osm_id"] >= 0:
+            feat += _pb_key(1, 0) + _pb_varint(f["osm_id"])
+        feat += _pb_packed(2, tags)
+        feat += _pb_key(3, 0) + _pb_varint(kind)
+        feat += _pb_packed(4, cmds)
+        body += _pb_bytes(2, bytes(feat))
+    if not body:
+        return b""
+    layer = bytearray()
+    layer += _pb_key(15, 0) + _pb_varint(2)
+    layer += _pb_bytes(1, name.encode("utf-8"))
+    layer += body
+    for k in keys:
+        layer += _pb_bytes(3, k.encode("utf-8"))
+    for (_, v) in values:
+        layer += _pb_bytes(4, _mvt_value(v))
+    layer += _pb_key(5, 0) + _pb_varint(MVT_EXTENT)
+    return _pb_bytes(3, bytes(layer))
+
+MVT_CACHE = _MemoryCache(MVT_CACHE_MAX)
+
+async def _category_tile_mvt(code: str, z: int, x: int, y: int) -> bytes:
+    key = f"mvt|{code}|{z}|{x}|{y}"
+    cached = MVT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    data = b""
+    if z >= MVT_MIN_ZOOM:
+        west, south, east, north = _tile_lonlat_bounds(z, x, y)
+        # margem do buffer, para não cortar features que só entram pela borda
+        pad = (east - west) * MVT_BUFFER / MVT_EXTENT
+        feats = await _category_features(code, (west - pad, south - pad, east + pad, north + pad), None)
+        feats = await _to_thread(_simplify_features, feats, z, phase="conversion")
+        data = await _to_thread(_encode_mvt_layer, code, feats, z, x, y, phase="serialization")
+    MVT_CACHE.set(key, data, MVT_CACHE_TTL_S)
+    return data
+
+@app.get("/tiles/{code}/{z}/{x}/{y}.mvt")
+async def category_tile(code: str, z: int, x: int, y: int, request: Request):
+    """Tile vetorial (Mapbox Vector Tile) de uma categoria; camada com o nome do código."""
+    if code not in CATEGORIES:
+        raise HTTPException(status_code=404, detail="Categoria não encontrada.")
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile inválido.")
+    data = await _category_tile_mvt(code, z, x, y)
+    etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+    headers = {"Cache-Control": f"public, max-age={MVT_MAX_AGE_S}", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="application/vnd.mapbox-vector-tile", headers=headers)
 
 # ===================== Limite real de Lisboa (Nominatim) ===================
 _LISBON_CACHE: Dict[str, Any] = {}
 
 @app.get("/lisbon_boundary")
-def lisbon_boundary():
+async def lisbon_boundary():
     if "geojson" in _LISBON_CACHE:
         return {"geojson": _LISBON_CACHE["geojson"]}
+    return await UPSTREAM_FLIGHTS.do("lisbon_boundary", _fetch_lisbon_boundary)
+
+async def _fetch_lisbon_boundary() -> Dict[str, Any]:
+    client = _http()
     url = f"{NOMINATIM_URL.rstrip('/')}/search"
     params = {"q": "Lisboa", "format": "jsonv2", "polygon_geojson": 1, "addressdetails": 0, "limit": 10, "dedupe": 1}
-    headers = {"User-Agent": USER_AGENT, "Accept-Language": "pt"}
+    headers = {"Accept-Language": "pt"}
     try:
-        r = requests.get(url, params=params, headers=headers, timeout=20)
+        r = await client.get(url, params=params, headers=headers, timeout=20)
         if r.status_code == 429:
             retry = int(r.headers.get("Retry-After", "1"))
-            time.sleep(min(retry, 3))
-            r = requests.get(url, params=params, headers=headers, timeout=20)
+            await asyncio.sleep(min(retry, 3))
+            r = await client.get(url, params=params, headers=headers, timeout=20)
         r.raise_for_status()
         results = r.json()
         chosen = None
@@ -738,92 +3280,832 @@ def lisbon_boundary():
             raise HTTPException(status_code=502, detail="Não foi possível obter o limite de Lisboa.")
         _LISBON_CACHE["geojson"] = chosen["geojson"]
         return {"geojson": chosen["geojson"]}
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Timeout ao consultar Nominatim (limite Lisboa).")
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         status = getattr(e.response, "status_code", None)
         raise HTTPException(status_code=502, detail=f"Erro HTTP do Nominatim ({status}).")
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Erro ao obter limite de Lisboa: {str(e)}")
 
 # ===================== SUBMISSÃO ===========================================
+# Seleções OSM podem vir só com osm_id/osm_type (sem geojson): a geometria vem do registo em memória
+# (o que o servidor enviou ao cliente) ou de public.osm_cache; se não estiver em nenhum, o /submit
+# responde com missing_ids e o cliente reenvia só esses com a geometria.
+def _resolve_references(payload: SubmitPayload) -> List[Tuple[str, int]]:
+    """Completa as referências a partir de FEATURE_REGISTRY; devolve (osm_type, osm_id) das que ficaram por resolver."""
+    unresolved: List[Tuple[str, int]] = []
+    for sel in payload.selections:
+        if sel.manual_polygon or sel.osm_id is None or sel.geojson:
+            continue
+        feat = FEATURE_REGISTRY.get(int(sel.osm_id), sel.osm_type)
+        if feat is None:
+            unresolved.append((sel.osm_type or "", int(sel.osm_id)))
+            continue
+        sel.geojson = feat["geojson"]
+        sel.osm_type = sel.osm_type or feat.get("osm_type")
+        sel.display_name = sel.display_name or feat.get("display_name")
+        sel.osm_class = sel.osm_class or feat.get("class")
+        sel.osm_feature_type = sel.osm_feature_type or feat.get("type")
+    return sorted(set(unresolved))
+
+def _missing_references(cur, refs: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    # osm_type vazio aceita qualquer tipo; com tipo, a linha guardada tem de ser do mesmo (way/relation com o mesmo número)
+    cur.execute(
+        "SELECT osm_id, osm_type FROM public.osm_cache WHERE osm_id = ANY(%s::bigint[])"
+        " AND (geom IS NOT NULL OR geojson IS NOT NULL)",
+        (sorted({r[1] for r in refs}),),
+    )
+    stored = dict(cur.fetchall())
+    return [(t, i) for t, i in refs if i not in stored or (t and stored[i] and stored[i] != t)]
+
+def _missing_response(pid: str, missing: List[Tuple[str, int]]) -> Dict[str, Any]:
+    return {"ok": False, "participant_id": pid, "error": "Elementos OSM desconhecidos: reenviar com geojson.",
+            "missing": [{"osm_type": t, "osm_id": i} for t, i in missing],
+            "missing_ids": sorted({i for _, i in missing})}
+
+def _submit_rows(payload: SubmitPayload) -> Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]], List[Dict[str, Any]]]:
+    """Linhas de user_polygons e selections e registos de osm_cache (só Polygon/MultiPolygon)."""
+    pid = payload.participant_id
+    polygon_rows: List[Tuple[Any, ...]] = []
+    selection_rows: List[Tuple[Any, ...]] = []
+    osm_records: List[Dict[str, Any]] = []
+    for sel in payload.selections:
+        if sel.manual_polygon:
+            mp = sel.manual_polygon
+            gj = mp.geojson or {}
+            if gj.get("type") not in ("Polygon", "MultiPolygon"):
+                continue
+            polygon_rows.append(
+                (pid, sel.theme_code, mp.name, int(mp.importance_1_5 or 3), mp.comment, json.dumps(mp.geojson))
+            )
+        else:
+            if sel.osm_id is None:
+                continue
+            if not sel.geojson:
+                # referência por osm_id: a linha já está em osm_cache (verificado antes de gravar)
+                selection_rows.append((pid, sel.theme_code, int(sel.osm_id), int(sel.importance_1_5 or 3), sel.comment))
+                continue
+            if sel.geojson.get("type") not in ("Polygon", "MultiPolygon"):
+                continue
+            osm_records.append({
+                "osm_id": sel.osm_id,
+                "osm_type": sel.osm_type or "",
+                "display_name": sel.display_name or "",
+                "class": sel.osm_class,
+                "type": sel.osm_feature_type,
+                "geojson": sel.geojson,
+            })
+            selection_rows.append((pid, sel.theme_code, int(sel.osm_id), int(sel.importance_1_5 or 3), sel.comment))
+    return polygon_rows, selection_rows, osm_records
+
+def insert_user_polygons_many(cur, rows: List[Tuple[Any, ...]], theme_ids: Dict[str, int]):
+    if not rows:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO public.user_polygons
+          (participant_id, theme_id, name, importance_1_5, comment, geom)
+        VALUES %s
+        """,
+        [(r[0], theme_ids[r[1]], *r[2:]) for r in rows],
+        template="(%s, %s, %s, %s, %s, ST_SetSRID(ST_Multi(ST_GeomFromGeoJSON(%s)), 4326))",
+        page_size=500,
+    )
+
+def insert_selections_many(cur, rows: List[Tuple[Any, ...]], theme_ids: Dict[str, int]):
+    if not rows:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO public.selections
+          (participant_id, theme_id, osm_id, importance_1_5, comment)
+        VALUES %s
+        """,
+        [(r[0], theme_ids[r[1]], *r[2:]) for r in rows],
+        page_size=500,
+    )
+
 @app.post("/submit")
+@_profiled_sync
 def submit(payload: SubmitPayload):
     if not payload.participant_id:
         return {"ok": False, "error": "participant_id em falta"}
     if not payload.selections:
         return {"ok": True, "participant_id": payload.participant_id, "saved": 0}
 
-    saved = 0
+    pid = payload.participant_id
+    unresolved = _resolve_references(payload)
+    polygon_rows, selection_rows, osm_records = _submit_rows(payload)
+
+    if WRITE_BEHIND:
+        if not _valid_participant_id(pid):
+            return {"ok": False, "error": "participant_id inválido"}
+        if unresolved:
+            # sem ir à BD no caminho do pedido: o que o registo não resolve volta com geojson
+            return _missing_response(pid, unresolved)
+        WRITE_JOURNAL.append("submit", pid, payload.model_dump())
+        NAME_INDEX.add_many(osm_records)
+        FEATURE_REGISTRY.add_many(osm_records)
+        return {"ok": True, "participant_id": pid, "saved": len(polygon_rows) + len(selection_rows), "queued": True}
+
+    t0 = time.perf_counter()
+    with get_conn() as conn:
+        DB_TIME.observe(time.perf_counter() - t0, "submit", "acquire")
+        with conn.cursor() as cur:
+            with DB_TIME.time("submit", "participant"):
+                ensure_participant(cur, pid)
+                ensure_profile_min(cur, pid)
+
+            with DB_TIME.time("submit", "themes"):
+                theme_ids, new_themes = THEME_REGISTRY.resolve(cur, [r[1] for r in polygon_rows + selection_rows])
+            with DB_TIME.time("submit", "osm_cache"):
+                changed_osm = upsert_osm_cache_many(cur, osm_records)
+            if unresolved:
+                # depois do upsert, na mesma transação: conta também o que vem com geojson neste envio
+                with DB_TIME.time("submit", "references"):
+                    missing = _missing_references(cur, unresolved)
+                if missing:
+                    conn.rollback()
+                    return _missing_response(pid, missing)
+            if polygon_rows:
+                with DB_TIME.time("submit", "user_polygons"):
+                    insert_user_polygons_many(cur, polygon_rows, theme_ids)
+            if selection_rows:
+                with DB_TIME.time("submit", "selections"):
+                    insert_selections_many(cur, selection_rows, theme_ids)
+            _record_spt_delta(cur, [pid], changed_osm)
+        with DB_TIME.time("submit", "commit"):
+            conn.commit()
+        THEME_REGISTRY.remember(new_themes)
+
+    NAME_INDEX.add_many(osm_records)
+    FEATURE_REGISTRY.add_many(osm_records)
+    return {"ok": True, "participant_id": pid, "saved": len(polygon_rows) + len(selection_rows)}
+
+# ===================== ESCRITA DIFERIDA (write-behind) =====================
+def _valid_participant_id(participant_id: str) -> bool:
+    # participants.id é uuid: um id inválido falharia só mais tarde, já depois de confirmado ao cliente
+    try:
+        uuid.UUID(str(participant_id))
+        return True
+    except ValueError:
+        return False
+
+class _WriteJournal:
+    """
+    Diário local (SQLite WAL, synchronous=FULL: cada entrada está no disco antes da resposta),
+    partilhado pelos workers do mesmo host. A chave de cada entrada (uuid do append) é também gravada
+    na BD na mesma transação que os dados, por isso voltar a entregar a mesma entrada não duplica nada;
+    dois appends com o mesmo conteúdo são escritas distintas (perfil A, B e de novo A fica A).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = 0
+        self._lock = Lock()
+        self.counters = {"appended": 0, "flushed": 0, "duplicates": 0, "failures": 0, "dead": 0, "batches": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, entry_key TEXT NOT NULL, kind TEXT NOT NULL,"
+                " participant_id TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL,"
+                " leased_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0,"
+                " dead INTEGER NOT NULL DEFAULT 0, last_error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS journal_pending ON journal (dead, leased_until, id)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def append(self, kind: str, participant_id: str, payload: Dict[str, Any]) -> str:
+        body = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO journal (entry_key, kind, participant_id, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, kind, participant_id, body, time.time()),
+            )
+            self.counters["appended"] += 1
+        return key
+
+    def lease(self, limit: int) -> List[Tuple[int, str, str, str, Dict[str, Any]]]:
+        """Reserva até limit entradas pendentes (as mais antigas): (id, chave, tipo, participante, payload)."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT id, entry_key, kind, participant_id, payload FROM journal"
+                    " WHERE dead = 0 AND leased_until < ? ORDER BY id LIMIT ?", (now, limit),
+                ).fetchall()
+                if rows:
+                    db.executemany("UPDATE journal SET leased_until = ? WHERE id = ?",
+                                   [(now + WRITE_BEHIND_LEASE_S, r[0]) for r in rows])
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return [(r[0], r[1], r[2], r[3], json.loads(r[4])) for r in rows]
+
+    def done(self, ids: List[int]) -> None:
+        with self._lock:
+            self._db().executemany("DELETE FROM journal WHERE id = ?", [(i,) for i in ids])
+
+    def release(self, ids: List[int], error: str) -> None:
+        # falha transitória (BD em baixo): volta à fila sem contar como tentativa
+        with self._lock:
+            self._db().executemany("UPDATE journal SET leased_until = 0, last_error = ? WHERE id = ?",
+                                   [(error, i) for i in ids])
+
+    def failed(self, entry_id: int, error: str) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "UPDATE journal SET leased_until = 0, attempts = attempts + 1, last_error = ?,"
+                " dead = CASE WHEN attempts + 1 >= ? THEN 1 ELSE 0 END WHERE id = ?",
+                (error, WRITE_BEHIND_MAX_ATTEMPTS, entry_id),
+            )
+            self.counters["failures"] += 1
+            if db.execute("SELECT dead FROM journal WHERE id = ?", (entry_id,)).fetchone() == (1,):
+                self.counters["dead"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending, dead, oldest = self._db().execute(
+                "SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0), MIN(CASE WHEN dead = 0 THEN created_at END)"
+                " FROM journal"
+            ).fetchone()
+        return {
+            "enabled": WRITE_BEHIND, "path": self.path, "pending": pending, "dead_entries": dead,
+            "oldest_pending_s": round(time.time() - oldest, 1) if oldest else 0.0, **self.counters,
+        }
+
+WRITE_JOURNAL = _WriteJournal(WRITE_BEHIND_PATH)
+
+# falhas que não dizem nada sobre a entrada (BD inacessível, pool esgotado): repetir mais tarde
+_TRANSIENT_DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, HTTPException)
+_WRITE_BEHIND_STATE: Dict[str, Any] = {"ddl": False, "task": None}
+
+def _ensure_write_behind_ddl() -> None:
+    # transação própria: não pode ser desfeita pelo rollback de um lote recusado
+    if _WRITE_BEHIND_STATE["ddl"]:
+        return
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS public.write_behind_applied (
+                  entry_key text PRIMARY KEY,
+                  kind text NOT NULL,
+                  participant_id uuid NOT NULL,
+                  applied_at timestamptz NOT NULL DEFAULT now()
+                )
+                """
+            )
+    _WRITE_BEHIND_STATE["ddl"] = True
+
+def _apply_journal_entries(entries: List[Tuple[int, str, str, str, Dict[str, Any]]]) -> int:
+    """Aplica as entradas numa só transação; as que já foram aplicadas (chave conhecida) são ignoradas."""
+    osm_records: List[Dict[str, Any]] = []
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            with DB_TIME.time("write_behind", "keys"):
+                fresh = {
+                    row[0] for row in psycopg2.extras.execute_values(
+                        cur,
+                        "INSERT INTO public.write_behind_applied (entry_key, kind, participant_id) VALUES %s"
+                        " ON CONFLICT (entry_key) DO NOTHING RETURNING entry_key",
+                        list({e[1]: (e[1], e[2], e[3]) for e in entries}.values()),
+                        fetch=True,
+                    )
+                }
+            todo = []
+            for e in entries:
+                if e[1] in fresh:
+                    fresh.discard(e[1])  # a mesma chave duas vezes no lote conta uma
+                    todo.append(e)
+            profiles = {e[3]: e[4] for e in todo if e[2] == "profile"}  # a última de cada participante
+            polygon_rows: List[Tuple[Any, ...]] = []
+            selection_rows: List[Tuple[Any, ...]] = []
+            submit_pids: List[str] = []
+            for e in todo:
+                if e[2] == "submit":
+                    polys, sels, recs = _submit_rows(SubmitPayload(**e[4]))
+                    polygon_rows += polys
+                    selection_rows += sels
+                    osm_records += recs
+                    submit_pids.append(e[3])
+
+            pids = sorted({e[3] for e in todo})
+            with DB_TIME.time("write_behind", "participant"):
+                if pids:
+                    psycopg2.extras.execute_values(
+                        cur, "INSERT INTO public.participants (id) VALUES %s ON CONFLICT (id) DO NOTHING",
+                        [(p,) for p in pids],
+                    )
+                for pid, data in profiles.items():
+                    upsert_profile(cur, pid, data)
+                missing_profile = sorted(set(submit_pids) - set(profiles))
+                if missing_profile:
+                    psycopg2.extras.execute_values(
+                        cur,
+                        "INSERT INTO public.profiles (participant_id, age_band, gender, lives_in_lisbon) VALUES %s"
+                        " ON CONFLICT (participant_id) DO NOTHING",
+                        [(p, "NA", "na", False) for p in missing_profile],
+                    )
+            with DB_TIME.time("write_behind", "themes"):
+                theme_ids, new_themes = THEME_REGISTRY.resolve(cur, [r[1] for r in polygon_rows + selection_rows])
+            with DB_TIME.time("write_behind", "osm_cache"):
+                changed_osm = upsert_osm_cache_many(cur, osm_records)
+            with DB_TIME.time("write_behind", "user_polygons"):
+                insert_user_polygons_many(cur, polygon_rows, theme_ids)
+            with DB_TIME.time("write_behind", "selections"):
+                insert_selections_many(cur, selection_rows, theme_ids)
+            _record_spt_delta(cur, pids, changed_osm)
+        with DB_TIME.time("write_behind", "commit"):
+            conn.commit()
+        THEME_REGISTRY.remember(new_themes)
+    WRITE_JOURNAL.counters["duplicates"] += len(entries) - len(todo)
+    return len(todo)
+
+def _flush_journal_once() -> int:
+    """Passa um lote do diário à BD. Devolve o nº de entradas tratadas; propaga falhas transitórias."""
+    if not DATABASE_URL:
+        return 0  # sem BD configurada as entradas ficam no diário
+    entries = WRITE_JOURNAL.lease(WRITE_BEHIND_BATCH)
+    if not entries:
+        return 0
+    try:
+        _ensure_write_behind_ddl()
+    except Exception as e:
+        WRITE_JOURNAL.release([x[0] for x in entries], repr(e))
+        raise
+    applied = 0
+    try:
+        _apply_journal_entries(entries)
+        WRITE_JOURNAL.done([e[0] for e in entries])
+        applied = len(entries)
+    except _TRANSIENT_DB_ERRORS as e:
+        WRITE_JOURNAL.release([x[0] for x in entries], repr(e))
+        raise
+    except Exception:
+        # alguma entrada com dados que a BD recusa: uma a uma, para não prender as restantes
+        for i, entry in enumerate(entries):
+            try:
+                _apply_journal_entries([entry])
+            except _TRANSIENT_DB_ERRORS as e:
+                WRITE_JOURNAL.release([x[0] for x in entries[i:]], repr(e))
+                WRITE_JOURNAL.counters["flushed"] += applied
+                raise
+            except Exception as e:
+                print(f"[write-behind] entrada {entry[0]} recusada: {e!r}")
+                WRITE_JOURNAL.failed(entry[0], repr(e))
+            else:
+                WRITE_JOURNAL.done([entry[0]])
+                applied += 1
+    WRITE_JOURNAL.counters["flushed"] += applied  # só as que chegaram à BD (recusadas contam em failures)
+    WRITE_JOURNAL.counters["batches"] += 1
+    return len(entries)
+
+async def _write_behind_loop() -> None:
+    delay = WRITE_BEHIND_INTERVAL_S
+    while True:
+        try:
+            n = await asyncio.to_thread(_flush_journal_once)
+            delay = WRITE_BEHIND_INTERVAL_S
+            if n >= WRITE_BEHIND_BATCH:
+                continue  # ainda há fila: segue sem esperar
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = min(60.0, max(delay, WRITE_BEHIND_INTERVAL_S) * 2)
+            print(f"[write-behind] BD indisponível ({e!r}); nova tentativa em {delay:.0f}s")
+        await asyncio.sleep(delay)
+
+@app.on_event("startup")
+async def _start_write_behind():
+    if WRITE_BEHIND and DATABASE_URL:
+        _WRITE_BEHIND_STATE["task"] = asyncio.create_task(_write_behind_loop())
+
+@app.on_event("shutdown")
+async def _stop_write_behind():
+    task, _WRITE_BEHIND_STATE["task"] = _WRITE_BEHIND_STATE["task"], None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await asyncio.to_thread(_flush_journal_once)  # última passagem; o resto fica no diário
+    except Exception as e:
+        print(f"[write-behind] pendente no diário: {e!r}")
+
+# ===================== TABELA DE ANÁLISE INCREMENTAL =======================
+# REFRESH da vista materializada selections_profile_themegeom recalcula a geometria (MakeValid,
+# GeomFromGeoJSON, Transform, área, centróide) de todas as seleções de sempre; aqui a tabela
+# selections_profile_themegeom_inc, com as mesmas colunas, só recalcula as linhas de quem mudou.
+# A definição vem da própria vista materializada (vista normal ..._src), por isso as duas não divergem.
+SPT_TABLE = "public.selections_profile_themegeom_inc"
+SPT_SOURCE = "public.selections_profile_themegeom_src"
+SPT_LOCK_KEY = 7_301_152  # pg_advisory_xact_lock: uma só passagem de cada vez entre workers/hosts
+_SPT_STATE: Dict[str, Any] = {"ddl": False, "table": False, "missed": False, "task": None}
+_SPT_COUNTERS: Dict[str, Any] = {
+    "runs": 0, "deltas": 0, "rows": 0, "full_rebuilds": 0, "busy": 0, "errors": 0, "missed": 0,
+    "last_run_at": None, "last_run_s": None, "last_error": None,
+}
+
+def _record_spt_delta(cur, participant_ids: List[str], osm_ids: Optional[List[int]] = None) -> None:
+    """Regista na transação corrente as linhas da tabela de análise a recalcular."""
+    if not SPT_INCREMENTAL:
+        return
+    if not _SPT_STATE["ddl"]:
+        # spt_delta ainda não confirmada (BD em baixo no arranque): nada de DDL aqui, dentro do pedido;
+        # a próxima passagem deste processo reconstrói a tabela toda
+        _SPT_STATE["missed"] = True
+        _SPT_COUNTERS["missed"] += 1
+        return
+    rows = [(p, None) for p in sorted(set(participant_ids))] + [(None, o) for o in sorted(set(osm_ids or []))]
+    if rows:
+        psycopg2.extras.execute_values(
+            cur, "INSERT INTO public.spt_delta (participant_id, osm_id) VALUES %s", rows, page_size=500,
+        )
+
+def _ensure_spt_ddl() -> None:
+    """Tabelas de registos e do índice hexagonal (baratas); corre no arranque e na task, nunca dentro de um pedido."""
+    if _SPT_STATE["ddl"]:
+        return
     with get_conn() as conn:
         with conn.cursor() as cur:
-            ensure_participant(cur, payload.participant_id)
-            ensure_profile_min(cur, payload.participant_id)
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS public.spt_delta (
+                  id bigserial PRIMARY KEY,
+                  participant_id uuid,
+                  osm_id bigint,
+                  touched_at timestamptz NOT NULL DEFAULT now()
+                )
+                """
+            )
+            _ensure_hex_ddl(cur)
+    _SPT_STATE["ddl"] = True
+
+def _ensure_spt_table(cur) -> bool:
+    """
+    Vista ..._src e tabela de análise, na transação da passagem (já com o advisory lock).
+    Devolve True se a tabela foi criada agora, com carga completa.
+    """
+    cur.execute("SELECT pg_get_viewdef('public.selections_profile_themegeom'::regclass)")
+    viewdef = cur.fetchone()[0].strip().rstrip(";")
+    cur.execute(f"CREATE OR REPLACE VIEW {SPT_SOURCE} AS {viewdef}")
+    cur.execute("SELECT to_regclass(%s)", (SPT_TABLE,))
+    created = cur.fetchone()[0] is None
+    if created:
+        # primeira vez: tabela com os tipos da vista e carga completa
+        cur.execute(f"CREATE TABLE {SPT_TABLE} AS SELECT * FROM {SPT_SOURCE}")
+        cur.execute("DELETE FROM public.spt_delta")
+    for name, cols in [
+        ("uidx", "(source, selection_id)"), ("participant_ix", "(participant_id)"),
+        ("osm_ix", "(osm_id)"), ("theme_ix", "(theme_code)"), ("created_ix", "(created_at)"),
+    ]:
+        unique = "UNIQUE " if name == "uidx" else ""
+        cur.execute(f"CREATE {unique}INDEX IF NOT EXISTS selections_profile_themegeom_inc_{name} ON {SPT_TABLE} {cols}")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS selections_profile_themegeom_inc_gix ON {SPT_TABLE} USING gist (geom)")
+    return created
+
+# ---------- índice de células hexagonais (para /aggregate) ----------
+def _ensure_hex_ddl(cur) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.spt_hex_cells (
+          source text NOT NULL,
+          selection_id text NOT NULL,
+          i integer NOT NULL,
+          j integer NOT NULL,
+          PRIMARY KEY (source, selection_id, i, j)
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS public.spt_theme_versions (
+          theme_code text PRIMARY KEY,
+          version bigint NOT NULL DEFAULT 1,
+          updated_at timestamptz NOT NULL DEFAULT now()
+        )
+        """
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS public.spt_hex_grid"
+        " (id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1), size_m double precision NOT NULL)"
+    )
+
+def _spt_hex_grid_stale(cur) -> bool:
+    # índice por criar ou com outro tamanho de célula (AGGREGATE_HEX_M mudou)
+    cur.execute("SELECT size_m FROM public.spt_hex_grid")
+    row = cur.fetchone()
+    return row is None or row[0] != AGGREGATE_HEX_M
+
+def _spt_themes(cur, where: str, params: Tuple[Any, ...]) -> set:
+    cur.execute(f"SELECT DISTINCT t.theme_code FROM {SPT_TABLE} t WHERE {where}", params)
+    return {r[0] for r in cur.fetchall() if r[0] is not None}
+
+def _spt_index_cells(cur, where: str, params: Tuple[Any, ...]) -> None:
+    # células que intersetam cada polígono, em metros (PT-TM06) para hexágonos regulares
+    cur.execute(
+        f"""
+        INSERT INTO public.spt_hex_cells (source, selection_id, i, j)
+        SELECT t.source, t.selection_id, h.i, h.j
+        FROM {SPT_TABLE} t
+        CROSS JOIN LATERAL (SELECT ST_Transform(t.geom, 3763) AS g) p
+        CROSS JOIN LATERAL ST_HexagonGrid(%s, p.g) h
+        WHERE ({where}) AND ST_Intersects(h.geom, p.g)
+        ON CONFLICT DO NOTHING
+        """,
+        (AGGREGATE_HEX_M, *params),
+    )
+
+def _bump_theme_versions(cur, themes: set) -> None:
+    if themes:
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO public.spt_theme_versions (theme_code) VALUES %s"
+            " ON CONFLICT (theme_code) DO UPDATE SET version = spt_theme_versions.version + 1, updated_at = now()",
+            [(t,) for t in sorted(themes)],
+        )
+
+def _spt_rebuild_cells(cur) -> None:
+    cur.execute("DELETE FROM public.spt_hex_cells")
+    _spt_index_cells(cur, "TRUE", ())
+    cur.execute("SELECT theme_code FROM public.spt_theme_versions")
+    _bump_theme_versions(cur, _spt_themes(cur, "TRUE", ()) | {r[0] for r in cur.fetchall()})
+    cur.execute(
+        "INSERT INTO public.spt_hex_grid (id, size_m) VALUES (1, %s)"
+        " ON CONFLICT (id) DO UPDATE SET size_m = EXCLUDED.size_m",
+        (AGGREGATE_HEX_M,),
+    )
 
-            for sel in payload.selections:
-                theme_id = fetch_theme_id(cur, sel.theme_code)
-                if theme_id is None:
+def _apply_spt_delta(limit: int = SPT_BATCH, full: bool = False) -> Dict[str, Any]:
+    """Uma passagem: consome até limit registos de spt_delta (ou todos, com full) e recalcula as linhas deles."""
+    _ensure_spt_ddl()
+    missed = _SPT_STATE["missed"]
+    full = full or missed  # houve escritas sem registo neste processo
+    t0 = time.perf_counter()
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (SPT_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                _SPT_COUNTERS["busy"] += 1
+                return {"ok": True, "busy": True, "deltas": 0, "rows": 0}
+            created = False
+            if not _SPT_STATE["table"]:
+                with DB_TIME.time("spt", "ddl"):
+                    created = _ensure_spt_table(cur)
+                full = full and not created  # acabada de carregar: não há nada a reconstruir
+                if created or _spt_hex_grid_stale(cur):
+                    with DB_TIME.time("spt", "cells"):
+                        _spt_rebuild_cells(cur)
+            with DB_TIME.time("spt", "delta"):
+                if full:
+                    cur.execute("DELETE FROM public.spt_delta")
+                    deltas = cur.rowcount
+                else:
                     cur.execute(
-                        "INSERT INTO public.themes (code) VALUES (%s) ON CONFLICT (code) DO NOTHING RETURNING id",
-                        (sel.theme_code,),
+                        "DELETE FROM public.spt_delta WHERE id IN"
+                        " (SELECT id FROM public.spt_delta ORDER BY id LIMIT %s) RETURNING participant_id, osm_id",
+                        (limit,),
                     )
-                    row = cur.fetchone()
-                    theme_id = int(row[0]) if row else fetch_theme_id(cur, sel.theme_code)
-
-                if sel.manual_polygon:
-                    mp = sel.manual_polygon
-                    gj = mp.geojson or {}
-                    if gj.get("type") not in ("Polygon", "MultiPolygon"):
-                        continue
+                    touched = cur.fetchall()
+                    deltas = len(touched)
+            if full:
+                with DB_TIME.time("spt", "rebuild"):
+                    # DELETE em vez de TRUNCATE: quem lê continua a ver a versão anterior até ao commit
+                    cur.execute(f"DELETE FROM {SPT_TABLE}")
+                    cur.execute(f"INSERT INTO {SPT_TABLE} SELECT * FROM {SPT_SOURCE}")
+                    rows = cur.rowcount
+                with DB_TIME.time("spt", "cells"):
+                    _spt_rebuild_cells(cur)
+            elif deltas:
+                pids = sorted({str(r[0]) for r in touched if r[0] is not None})
+                oids = sorted({int(r[1]) for r in touched if r[1] is not None})
+                where = "t.participant_id = ANY(%s::uuid[]) OR (t.source = 'osm' AND t.osm_id = ANY(%s::bigint[]))"
+                with DB_TIME.time("spt", "apply"):
+                    themes = _spt_themes(cur, where, (pids, oids))
                     cur.execute(
-                        """
-                        INSERT INTO public.user_polygons
-                          (participant_id, theme_id, name, importance_1_5, comment, geom)
-                        VALUES
-                          (%s, %s, %s, %s, %s,
-                           ST_SetSRID(ST_Multi(ST_GeomFromGeoJSON(%s)), 4326)
-                          )
-                        """,
-                        (
-                            payload.participant_id,
-                            theme_id,
-                            mp.name,
-                            int(mp.importance_1_5 or 3),
-                            mp.comment,
-                            json.dumps(mp.geojson),
-                        ),
+                        f"DELETE FROM public.spt_hex_cells c USING {SPT_TABLE} t"
+                        f" WHERE c.source = t.source AND c.selection_id = t.selection_id AND ({where})", (pids, oids),
                     )
-                    saved += 1
-                else:
-                    if sel.osm_id is None or not sel.geojson or sel.geojson.get("type") not in ("Polygon", "MultiPolygon"):
-                        continue
-                    osm_record = {
-                        "osm_id": sel.osm_id,
-                        "osm_type": sel.osm_type or "",
-                        "display_name": sel.display_name or "",
-                        "class": sel.osm_class,
-                        "type": sel.osm_feature_type,
-                        "geojson": sel.geojson,
-                    }
-                    upsert_osm_cache(cur, osm_record)
+                    cur.execute(f"DELETE FROM {SPT_TABLE} t WHERE {where}", (pids, oids))
+                    cur.execute(f"INSERT INTO {SPT_TABLE} SELECT * FROM {SPT_SOURCE} t WHERE {where}", (pids, oids))
+                    rows = cur.rowcount
+                with DB_TIME.time("spt", "cells"):
+                    _spt_index_cells(cur, where, (pids, oids))
+                    _bump_theme_versions(cur, themes | _spt_themes(cur, where, (pids, oids)))
+            else:
+                rows = 0
+            if created:
+                cur.execute(f"SELECT count(*) FROM {SPT_TABLE}")
+                rows = cur.fetchone()[0]
+            cur.execute("SELECT count(*) FROM public.spt_delta")
+            pending = cur.fetchone()[0]
+        conn.commit()
+    _SPT_STATE["table"] = True
+    if missed:
+        _SPT_STATE["missed"] = False
+    full = full or created
+    elapsed = time.perf_counter() - t0
+    _AGGREGATE_VERSIONS.clear()  # este processo vê já as versões novas
+    _SPT_COUNTERS["runs"] += 1
+    _SPT_COUNTERS["deltas"] += deltas
+    _SPT_COUNTERS["rows"] += rows
+    _SPT_COUNTERS["full_rebuilds"] += int(full)
+    _SPT_COUNTERS["last_run_at"] = time.time()
+    _SPT_COUNTERS["last_run_s"] = round(elapsed, 3)
+    return {"ok": True, "busy": False, "full": full, "deltas": deltas, "rows": rows, "pending": pending,
+            "elapsed_s": round(elapsed, 3)}
+
+def _spt_stats() -> Dict[str, Any]:
+    return {"enabled": SPT_INCREMENTAL, "table": SPT_TABLE, **_SPT_COUNTERS}
+
+async def _spt_loop() -> None:
+    delay = SPT_INTERVAL_S
+    while True:
+        try:
+            res = await asyncio.to_thread(_apply_spt_delta)
+            delay = SPT_INTERVAL_S
+            if res.get("pending"):
+                continue  # ainda há registos: segue sem esperar
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _SPT_COUNTERS["errors"] += 1
+            _SPT_COUNTERS["last_error"] = repr(e)
+            delay = min(600.0, max(delay, SPT_INTERVAL_S) * 2)
+            print(f"[spt] passagem falhou ({e!r}); nova tentativa em {delay:.0f}s")
+        await asyncio.sleep(delay)
+
+@app.on_event("startup")
+async def _start_spt():
+    if SPT_INCREMENTAL and DATABASE_URL:
+        try:
+            await asyncio.to_thread(_ensure_spt_ddl)
+        except Exception as e:
+            print(f"[spt] spt_delta por criar ({e!r}); a task volta a tentar")
+        _SPT_STATE["task"] = asyncio.create_task(_spt_loop())
+
+@app.on_event("shutdown")
+async def _stop_spt():
+    task, _SPT_STATE["task"] = _SPT_STATE["task"], None
+    if task is not None:
+        task.cancel()
+
+@app.post("/spt/refresh")
+async def spt_refresh(request: Request, full: bool = False):
+    if not SPT_SECRET:
+        raise HTTPException(status_code=404, detail="Atualização manual desativada (SPT_SECRET não configurado).")
+    given = request.headers.get("x-spt-secret", "")
+    if not hmac.compare_digest(given.encode(), SPT_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Segredo inválido.")
+    if not SPT_INCREMENTAL:
+        raise HTTPException(status_code=409, detail="Manutenção incremental desativada (SPT_INCREMENTAL=0).")
+    try:
+        return await _to_thread(_apply_spt_delta, SPT_BATCH, full, phase="db")
+    except HTTPException:
+        raise
+    except Exception as e:
+        _SPT_COUNTERS["errors"] += 1
+        _SPT_COUNTERS["last_error"] = repr(e)
+        raise HTTPException(status_code=500, detail=f"Falha ao atualizar a tabela de análise: {e}")
+
+# ===================== AGREGAÇÃO (hexágonos por tema) ======================
+# colunas do perfil presentes na tabela de análise que podem filtrar (?age_band=25-34&age_band=35-44)
+AGGREGATE_FILTERS: Dict[str, type] = {
+    "age_band": str, "gender": str, "ethnicity": str, "nationality": str, "education": str,
+    "income_band": str, "tenure": str, "years_in_lisbon_band": str, "pt_use": str, "main_mode": str,
+    "lives_in_lisbon": bool, "lived_in_lisbon_past": bool, "works_in_lisbon": bool,
+    "studies_in_lisbon": bool, "visitors_regular": bool, "visitors_sporadic": bool,
+}
+AGGREGATE_CACHE = _MemoryCache(AGGREGATE_CACHE_MAX)
+_AGGREGATE_VERSIONS: Dict[str, Tuple[float, int]] = {}  # tema -> (verificada em, versão)
+
+def _aggregate_filters(params) -> Dict[str, List[Any]]:
+    out: Dict[str, List[Any]] = {}
+    for key, value in params.multi_items():
+        kind = AGGREGATE_FILTERS.get(key)
+        if kind is None:
+            raise HTTPException(status_code=400, detail=f"Filtro desconhecido: {key}.")
+        if kind is bool:
+            low = value.strip().lower()
+            if low not in ("true", "false", "1", "0"):
+                raise HTTPException(status_code=400, detail=f"{key} deve ser true ou false.")
+            value = low in ("true", "1")
+        if value not in out.setdefault(key, []):
+            out[key].append(value)
+    return {k: sorted(v) for k, v in sorted(out.items())}
+
+def _fresh_theme_version(theme_code: str) -> Optional[int]:
+    # entre workers a versão vem da BD, lida no máximo a cada AGGREGATE_VERSION_CHECK_S segundos
+    hit = _AGGREGATE_VERSIONS.get(theme_code)
+    if hit is not None and time.time() - hit[0] < AGGREGATE_VERSION_CHECK_S:
+        return hit[1]
+    return None
+
+def _theme_version(cur, theme_code: str) -> int:
+    version = _fresh_theme_version(theme_code)
+    if version is not None:
+        return version
+    now = time.time()
+    cur.execute("SELECT version FROM public.spt_theme_versions WHERE theme_code = %s", (theme_code,))
+    row = cur.fetchone()
+    version = int(row[0]) if row else 0
+    _AGGREGATE_VERSIONS[theme_code] = (now, version)
+    return version
+
+def _aggregate_key(theme_code: str, version: int, filters: Dict[str, List[Any]]) -> str:
+    return f"{theme_code}|{version}|{AGGREGATE_HEX_M:g}|{json.dumps(filters, sort_keys=True)}"
+
+def _aggregate(theme_code: str, filters: Dict[str, List[Any]]) -> Dict[str, Any]:
+    version = _fresh_theme_version(theme_code)
+    if version is not None:
+        hit = AGGREGATE_CACHE.get(_aggregate_key(theme_code, version, filters))
+        if hit is not None:
+            return hit  # versão confirmada há pouco: nem pede ligação
+
+    where = ["t.theme_code = %s"]
+    params: List[Any] = [theme_code]
+    for field, values in filters.items():
+        where.append(f"t.{field} = ANY(%s)")
+        params.append(values)
+    where_sql = " AND ".join(where)
+    try:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                version = _theme_version(cur, theme_code)
+                key = _aggregate_key(theme_code, version, filters)
+                hit = AGGREGATE_CACHE.get(key)
+                if hit is not None:
+                    return hit
+                with DB_TIME.time("aggregate", "cells"):
                     cur.execute(
-                        """
-                        INSERT INTO public.selections
-                          (participant_id, theme_id, osm_id, importance_1_5, comment)
-                        VALUES (%s, %s, %s, %s, %s)
+                        f"""
+                        SELECT c.i, c.j, count(*), count(DISTINCT t.participant_id), avg(t.importance_1_5)::float8,
+                               ST_AsGeoJSON(ST_Transform(ST_SetSRID(ST_Hexagon(%s, c.i, c.j), 3763), 4326), 6)
+                        FROM public.spt_hex_cells c
+                        JOIN {SPT_TABLE} t ON t.source = c.source AND t.selection_id = c.selection_id
+                        WHERE {where_sql}
+                        GROUP BY c.i, c.j
+                        ORDER BY c.i, c.j
                         """,
-                        (
-                            payload.participant_id,
-                            theme_id,
-                            int(sel.osm_id),
-                            int(sel.importance_1_5 or 3),
-                            sel.comment,
-                        ),
+                        (AGGREGATE_HEX_M, *params),
                     )
-                    saved += 1
-        conn.commit()
+                    cells = cur.fetchall()
+                with DB_TIME.time("aggregate", "totals"):
+                    cur.execute(f"SELECT count(*), count(DISTINCT t.participant_id) FROM {SPT_TABLE} t WHERE {where_sql}", params)
+                    n_selections, n_participants = cur.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        # tabelas criadas pela primeira passagem da task SPT
+        raise HTTPException(status_code=503, detail="Tabela de análise ainda em preparação, tente mais tarde.")
+
+    cell_km2 = 3 * math.sqrt(3) / 2 * AGGREGATE_HEX_M ** 2 / 1e6
+    payload = {
+        "type": "FeatureCollection",
+        "theme": theme_code,
+        "filters": filters,
+        "version": version,
+        "hex_m": AGGREGATE_HEX_M,
+        "cell_area_km2": round(cell_km2, 6),
+        "selections": n_selections,
+        "participants": n_participants,
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": json.loads(gj),
+                "properties": {
+                    "i": i, "j": j, "count": n, "participants": people,
+                    "density_km2": round(n / cell_km2, 3),
+                    "mean_importance": round(mean, 3) if mean is not None else None,
+                },
+            }
+            for i, j, n, people, mean, gj in cells
+        ],
+    }
+    AGGREGATE_CACHE.set(key, payload, AGGREGATE_CACHE_TTL_S)
+    return payload
 
-    return {"ok": True, "participant_id": payload.participant_id, "saved": saved}
+@app.get("/aggregate/{theme_code}")
+async def aggregate(theme_code: str, request: Request):
+    if not SPT_INCREMENTAL:
+        raise HTTPException(status_code=409, detail="Agregação indisponível: requer SPT_INCREMENTAL=1.")
+    filters = _aggregate_filters(request.query_params)
+    payload = await _to_thread(_aggregate, theme_code, filters, phase="db")
+    # a chave do RESPONSE_CACHE é só o URL; a versão do tema está na chave da AGGREGATE_CACHE
+    return await _fast_response(request, payload, cache=False)
 
 # ===================== ROTEADOR /api (espelho dos endpoints) ===============
 api = APIRouter(prefix="/api")
@@ -831,6 +4113,20 @@ api = APIRouter(prefix="/api")
 @api.get("/health")
 def api_health(): return health()
 
+@api.get("/stats")
+def api_stats(): return stats()
+
+@api.get("/metrics")
+def api_metrics(): return metrics()
+
+@api.get("/profiles")
+async def api_profiles(request: Request, limit: int = Query(50, ge=1, le=1000)):
+    return await profiles(request, limit)
+
+@api.get("/profiles/{profile_id}")
+async def api_profile_download(profile_id: str, request: Request, format: str = Query("json", pattern="^(json|folded)$")):
+    return await profile_download(profile_id, request, format)
+
 @api.api_route("/consent", methods=["GET", "POST"])
 def api_consent(): return consent()
 
@@ -839,25 +4135,37 @@ async def api_profile(request: Request, participant_id: Optional[str] = Query(No
     return await profile(request, participant_id)
 
 @api.get("/geocode")
-def api_geocode(q: str = Query(..., min_length=2)):
-    return geocode(q)
+async def api_geocode(request: Request, q: str = Query(..., min_length=2), zoom: Optional[int] = Query(None, ge=0, le=22)):
+    return await geocode(request, q, zoom)
 
 @api.get("/categories")
 def api_categories():
     return categories()
 
 @api.get("/category/{code}")
-def api_category(code: str, bbox: Optional[str] = None, limit: int = 900):
-    return category(code, bbox, limit)
+async def api_category(code: str, request: Request, bbox: Optional[str] = None, limit: int = 900, zoom: Optional[int] = Query(None, ge=0, le=22), stream: bool = False):
+    return await category(code, request, bbox, limit, zoom, stream)
+
+@api.get("/tiles/{code}/{z}/{x}/{y}.mvt")
+async def api_category_tile(code: str, z: int, x: int, y: int, request: Request):
+    return await category_tile(code, z, x, y, request)
 
 @api.get("/lisbon_boundary")
-def api_lisbon_boundary():
-    return lisbon_boundary()
+async def api_lisbon_boundary():
+    return await lisbon_boundary()
 
 @api.post("/submit")
 def api_submit(payload: SubmitPayload):
     return submit(payload)
 
+@api.post("/spt/refresh")
+async def api_spt_refresh(request: Request, full: bool = False):
+    return await spt_refresh(request, full)
+
+@api.get("/aggregate/{theme_code}")
+async def api_aggregate(theme_code: str, request: Request):
+    return await aggregate(theme_code, request)
+
 app.include_router(api)
 
 # ===================== Run local ============================================
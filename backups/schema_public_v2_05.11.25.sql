@@ -68,7 +68,8 @@ CREATE TABLE public.osm_cache (
     display_name text,
     class text,
     type text,
-    geojson jsonb
+    geojson jsonb,
+    content_hash text
 );
 
 
@@ -1114,7 +1114,9 @@ const runSearch = async () => {
     }
     if (testMode) { onNext(); return; }
 
-    const payload = {
+    // elementos OSM vão só por referência; o servidor devolve em missing os que não conhece
+    const refKey = (osmType, osmId) => `${osmType || ""}/${osmId}`; // way e relation podem ter o mesmo número
+    const buildPayload = (withGeometry) => ({
       participant_id: participantId,
       selections: items.map(it => {
         if (it.kind === "osm") {
@@ -1127,7 +1129,7 @@ const runSearch = async () => {
             display_name: it.display_name,
             osm_class: it.osm_class,
             osm_feature_type: it.osm_feature_type,
-            geojson: it.geojson
+            ...(withGeometry(it) ? { geojson: it.geojson } : {})
           };
         } else {
           return {
@@ -1141,9 +1143,17 @@ const runSearch = async () => {
           };
         }
       })
-    };
+    });
 
-    try { await axios.post(`${API}/submit`, payload); onNext(); }
+    try {
+      let { data } = await axios.post(`${API}/submit`, buildPayload(() => false));
+      if (data?.ok === false && Array.isArray(data.missing) && data.missing.length) {
+        const missing = new Set(data.missing.map(m => refKey(m.osm_type, m.osm_id)));
+        ({ data } = await axios.post(`${API}/submit`, buildPayload(it => missing.has(refKey(it.osm_type, it.osm_id)))));
+      }
+      if (!data?.ok) throw new Error(data?.error || "Submissão recusada pelo servidor.");
+      onNext();
+    }
     catch (err) {
       console.error(err);
       const proceed = window.confirm("Falha ao guardar as seleções no servidor.\nDeseja continuar para a próxima etapa mesmo assim?");